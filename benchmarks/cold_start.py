@@ -0,0 +1,141 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Profiles the cold start of the service: the -X importtime breakdown of "import main" and the time
+from starting a new python process to the first /test response. Results are compared with
+cold_start_baseline.json and the script exits with an error if any of them is slower than the
+baseline by more than the configured ratio.
+
+Usage (from the repository root):
+  python benchmarks/cold_start.py
+  python benchmarks/cold_start.py --update-baseline
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(REPOSITORY_DIR, "benchmarks", "cold_start_baseline.json")
+DEFAULT_MAX_RATIO = 1.5
+PORT = 8766
+REPETITIONS = 5
+TOP_MODULES = 10
+
+
+def _import_time_breakdown() -> dict:
+  """
+  Runs "import main" with -X importtime in a new process.
+
+  return dictionary with the cumulative microseconds of main and of every package it imports directly
+  """
+  output = subprocess.run(
+    [sys.executable, "-X", "importtime", "-c", "import main"],
+    cwd=REPOSITORY_DIR, capture_output=True, text=True, check=True).stderr
+  breakdown = {}
+  children = {}
+  for line in output.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    _, cumulative, name = line[len("import time:"):].split("|")
+    #Children are printed before their parent, the depth of each module is the indentation of its name
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    if depth == 1:
+      children[name.strip()] = int(cumulative)
+    elif depth == 0:
+      if name.strip() == "main":
+        breakdown = dict(children, main=int(cumulative))
+      children = {}
+  return breakdown
+
+
+def _time_to_first_response() -> float:
+  """
+  Starts the service in a new process and requests /test until it answers.
+
+  return milliseconds from starting the process to the first response
+  """
+  start = time.perf_counter()
+  server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve"], cwd=REPOSITORY_DIR,
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while True:
+      try:
+        urllib.request.urlopen("http://127.0.0.1:" + str(PORT) + "/test", timeout=1).read()
+        return (time.perf_counter() - start) * 1000
+      except OSError:
+        if server.poll() is not None:
+          raise RuntimeError("The service exited before answering /test")
+        time.sleep(0.005)
+  finally:
+    server.terminate()
+    server.wait()
+
+
+def _serve() -> None:
+  sys.path.insert(0, REPOSITORY_DIR)
+  from werkzeug.serving import make_server
+  import main
+  make_server("127.0.0.1", PORT, main.app).serve_forever()
+
+
+def _measure() -> dict:
+  import_times = [_import_time_breakdown() for _ in range(REPETITIONS)]
+  first_responses = [_time_to_first_response() for _ in range(REPETITIONS)]
+  breakdown = {name: statistics.median(times.get(name, 0) for times in import_times) for name in import_times[0]}
+  return {
+    "import_main_ms": round(breakdown["main"] / 1000, 1),
+    "first_test_response_ms": round(statistics.median(first_responses), 1),
+    "imports_ms": {name: round(value / 1000, 1) for name, value in
+      sorted(breakdown.items(), key=lambda item: -item[1])[:TOP_MODULES] if name != "main"}
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--update-baseline", action="store_true")
+  arguments = parser.parse_args()
+  if arguments.serve:
+    _serve()
+    sys.exit(0)
+
+  results = _measure()
+  print("import main: {} ms, first /test response: {} ms".format(results["import_main_ms"], results["first_test_response_ms"]))
+  for name, milliseconds in results["imports_ms"].items():
+    print("  {:<40} {:8.1f} ms".format(name, milliseconds))
+
+  if arguments.update_baseline or not os.path.exists(BASELINE_FILE):
+    results["max_ratio"] = DEFAULT_MAX_RATIO
+    with open(BASELINE_FILE, "w") as baseline_file:
+      json.dump(results, baseline_file, indent=2)
+      baseline_file.write("\n")
+    print("Baseline stored in " + BASELINE_FILE)
+    sys.exit(0)
+
+  with open(BASELINE_FILE) as baseline_file:
+    baseline = json.load(baseline_file)
+  failed = False
+  for metric in ["import_main_ms", "first_test_response_ms"]:
+    ratio = results[metric] / baseline[metric]
+    print("{}: {:.2f}x the baseline".format(metric, ratio))
+    if ratio > baseline.get("max_ratio", DEFAULT_MAX_RATIO):
+      print("Cold start regression in " + metric)
+      failed = True
+  sys.exit(1 if failed else 0)
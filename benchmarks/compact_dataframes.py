@@ -0,0 +1,138 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Measures what "compact_dataframes" saves on an expanded feed. Seeded synthetic products are cross
+joined with the option values, as the cross join stage does, and the local stages of the pipeline
+(condense and enrichment) run on the expanded table with and without BigqueryHelper.compact_dataframe.
+
+The report has the size of the expanded table as counted by pandas, the peak memory allocated by the
+local stages from the read of the table, measured with tracemalloc, and the time of each step. The
+conversion from Arrow already shares repeated strings, so the peak memory is the saving to expect.
+The script exits with an error if the enriched feed is different with compaction.
+
+Usage (from the repository root):
+  python benchmarks/compact_dataframes.py
+  python benchmarks/compact_dataframes.py --products 50000 --option-values 4 --options 2
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import pandas as pd
+import pyarrow as pa
+import main
+from bigquery_helper import BigqueryHelper, bigquery_types_mapper, condense_dataframe
+
+SEED = 20221017
+
+
+def _expanded_feed(products: int, options: int, option_values: int) -> pd.core.frame.DataFrame:
+  generator = random.Random(SEED)
+  words = ["red", "blue", "shoe", "shirt", "sale", "new", "kids", "summer", "cotton", "classic"]
+  dataframe = pd.DataFrame({
+    "offer_id": ["offer-" + str(index) for index in range(products)],
+    "title": [" ".join(generator.choice(words) for _ in range(5)) for _ in range(products)],
+    "description": [" ".join(generator.choice(words) for _ in range(25)) for _ in range(products)],
+    "price": [str(round(generator.uniform(1, 500), 2)) + " EUR" for _ in range(products)],
+    "link": ["https://example.com/products/" + str(index) for index in range(products)],
+    "image_link": ["https://example.com/images/" + str(index) + ".jpg" for index in range(products)],
+  })
+  for option in range(options):
+    values = ["option{}-value{}".format(option, value) for value in range(option_values)]
+    dataframe = dataframe.merge(pd.DataFrame({"option_" + str(option): values}), how="cross")
+  #The rows of a product are consecutive after the cross join, condense picks them at random
+  return dataframe.sample(frac=1, random_state=SEED).reset_index(drop=True)
+
+
+def _run_stages(expanded: pa.Table, compact: bool, config: dict, traced: bool) -> dict:
+  """
+  Runs the local stages on the expanded table, as read from BigQuery. tracemalloc slows every allocation
+  down, so the peak memory and the times are measured in separate runs.
+  """
+  bq = BigqueryHelper("benchmark-project", "benchmark_dataset", compact_dataframes=compact)
+  amount = config["amount_of_rows_to_condense"]
+  gc.collect()
+  if traced:
+    tracemalloc.start()
+  start = time.perf_counter()
+  #The conversion from Arrow allocates the table as the read of the stage does
+  dataframe = expanded.to_pandas(types_mapper=bigquery_types_mapper)
+  read_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  if compact:
+    dataframe = bq.compact_dataframe(dataframe)
+  compact_seconds = time.perf_counter() - start
+  table_bytes = int(dataframe.memory_usage(deep=True).sum())
+  start = time.perf_counter()
+  condensed = condense_dataframe(dataframe, amount, list(dataframe.columns))
+  del dataframe
+  enriched = main._add_studio_required_columns(condensed, config)
+  stages_seconds = time.perf_counter() - start
+  peak_bytes = None
+  if traced:
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return {
+    "table_bytes": table_bytes,
+    "peak_bytes": peak_bytes,
+    "read_seconds": read_seconds,
+    "compact_seconds": compact_seconds,
+    "stages_seconds": stages_seconds,
+    "enriched": enriched.astype(str),
+  }
+
+
+def _run(arguments) -> bool:
+  expanded = _expanded_feed(arguments.products, arguments.options, arguments.option_values)
+  config = dict(main._get_params(), amount_of_rows_to_condense=arguments.condensed, reporting_id_column="offer_id",
+    reporting_id_mode=main.REPORTING_ID_MODE_HASHED, process_pool_workers=0)
+  arrow_table = pa.Table.from_pandas(expanded, preserve_index=False)
+  results = {}
+  for mode, compact in [("plain", False), ("compact", True)]:
+    results[mode] = _run_stages(arrow_table, compact, config, traced=False)
+    results[mode]["peak_bytes"] = _run_stages(arrow_table, compact, config, traced=True)["peak_bytes"]
+
+  print("Expanded feed: {} products x {} option combinations = {} rows, {} products per condensed row".format(
+    arguments.products, arguments.option_values ** arguments.options, len(expanded), arguments.condensed))
+  print("{:<8} {:>10} {:>10} {:>8} {:>11} {:>10}".format("mode", "table MB", "peak MB", "read s", "compact s", "stages s"))
+  for mode, result in results.items():
+    print("{:<8} {:>10.1f} {:>10.1f} {:>8.3f} {:>11.3f} {:>10.3f}".format(mode, result["table_bytes"] / 2 ** 20,
+      result["peak_bytes"] / 2 ** 20, result["read_seconds"], result["compact_seconds"], result["stages_seconds"]))
+  plain, compact = results["plain"], results["compact"]
+  print("Compact: {:.1%} of the table memory, {:.1%} of the peak memory".format(
+    compact["table_bytes"] / plain["table_bytes"], compact["peak_bytes"] / plain["peak_bytes"]))
+
+  #condense_dataframe doesn't shuffle, both runs put the same rows in every slot
+  if not plain["enriched"].equals(compact["enriched"]):
+    print("  the enriched feed is different with compact_dataframes")
+    return False
+  return True
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--products", type=int, default=20000)
+  parser.add_argument("--options", type=int, default=2, help="option columns of additional_columns")
+  parser.add_argument("--option-values", type=int, default=3, help="values of every option column")
+  parser.add_argument("--condensed", type=int, default=3, help="products per row, as amount_of_rows_to_condense")
+  arguments = parser.parse_args()
+  sys.exit(0 if _run(arguments) else 1)
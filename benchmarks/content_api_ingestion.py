@@ -0,0 +1,235 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Runs the Content API ingestion against a local HTTP server that serves products.list pages with
+nextPageToken, waits a fixed latency per page and answers a share of the requests with 429 at random.
+The products are loaded through a stand-in of BigQuery that keeps the loaded rows in memory, so the
+paging, retries, filtering and batching code runs unchanged.
+
+The columns and attribute filters are the ones of config.json, so the filters use attributes that
+are not among the loaded columns. The report has the throughput, the retries and the pages requested ahead,
+and the script exits with an error if the loaded products are not exactly the ones that pass the
+filters, if a filtered attribute that is not a column is loaded, or if the next page wasn't requested
+while the current one was being processed.
+
+Usage (from the repository root):
+  python benchmarks/content_api_ingestion.py
+  python benchmarks/content_api_ingestion.py --products 20000 --page-latency 0.05 --error-rate 0.2
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import requests
+import bigquery_helper
+import main
+import merchant_center_helper
+from filtering_functions import AttributeFilter
+
+SEED = 20221017
+PORT = 8768
+MERCHANT_ID = "1234"
+DESTINATION_TABLE = "productsFromMC_benchmark"
+
+
+class ProductsServer(ThreadingHTTPServer):
+  """
+  Serves the products in pages of page_size, the page token is the offset of the page. A random share
+  of the requests is answered with 429. The time every page is requested is recorded, to check that
+  pages are prefetched.
+  """
+
+  def __init__(self, products: list, page_size: int, page_latency: float, error_rate: float):
+    super().__init__(("127.0.0.1", PORT), ProductsHandler)
+    self.products = products
+    self.page_size = page_size
+    self.page_latency = page_latency
+    self.error_rate = error_rate
+    self.random = random.Random(SEED)
+    self.requests = 0
+    self.injected_errors = 0
+    self.pages_served = 0
+    self.request_times = {}
+    self._lock = threading.Lock()
+
+  def get_page(self, page_token: str):
+    with self._lock:
+      self.requests += 1
+      if self.random.random() < self.error_rate:
+        self.injected_errors += 1
+        return 429, {"error": {"code": 429, "message": "Injected error"}}
+    offset = int(page_token or 0)
+    self.request_times.setdefault(offset, time.monotonic())
+    time.sleep(self.page_latency)
+    body = {"kind": "content#productsListResponse", "resources": self.products[offset:offset + self.page_size]}
+    if offset + self.page_size < len(self.products):
+      body["nextPageToken"] = str(offset + self.page_size)
+    with self._lock:
+      self.pages_served += 1
+    return 200, body
+
+
+class ProductsHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    if url.path != "/content/v2.1/" + MERCHANT_ID + "/products/":
+      status_code, body = 404, {"error": {"code": 404, "message": "Unknown url " + self.path}}
+    else:
+      status_code, body = self.server.get_page(parse_qs(url.query).get("pageToken", [None])[0])
+    content = json.dumps(body).encode("utf-8")
+    self.send_response(status_code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    return
+
+
+class StandInBigqueryHelper(bigquery_helper.BigqueryHelper):
+  """Keeps the created tables and the loaded rows in memory, waiting a fixed latency per load job."""
+
+  def __init__(self, load_latency: float):
+    super().__init__("stand-in-project", "stand_in_dataset")
+    self.load_latency = load_latency
+    self.columns = {}
+    self.rows = {}
+    self.load_jobs = 0
+    self.append_times = []
+
+  def create_table(self, table_name: str, columns: list, update_if_exist=True, mode="REQUIRED",
+    partition_expiration_days=None) -> None:
+    self.columns[table_name] = list(columns)
+    self.rows[table_name] = []
+
+  def get_batch_writer(self, table_name: str, schema=None, max_rows=bigquery_helper.BATCH_WRITER_MAX_ROWS,
+    max_bytes=bigquery_helper.BATCH_WRITER_MAX_BYTES, max_seconds=bigquery_helper.BATCH_WRITER_MAX_SECONDS):
+    return StandInBatchWriter(self, table_name, schema, max_rows, max_bytes, max_seconds)
+
+
+class StandInBatchWriter(bigquery_helper.BigqueryBatchWriter):
+  """Buffers rows as the BigQuery writer does, and appends them to the stand-in table on flush."""
+
+  def append_rows(self, rows: list) -> None:
+    super().append_rows(rows)
+    #Called once per page, when the page has been processed
+    self.bq.append_times.append(time.monotonic())
+
+  def flush(self) -> None:
+    with self._lock:
+      rows = self._rows
+      self._rows = []
+      self._buffered_bytes = 0
+      self._first_row_time = None
+    if not rows:
+      return
+    time.sleep(self.bq.load_latency)
+    self.bq.load_jobs += 1
+    self.bq.rows[self.table_name] += [json.loads(json.dumps(row, default=str)) for row in rows]
+    self.rows_written += len(rows)
+
+
+def _get_products(count: int) -> list:
+  generator = random.Random(SEED)
+  products = []
+  for index in range(count):
+    products.append({
+      "kind": "content#product",
+      "offerId": "offer-" + str(index),
+      "title": "Product " + str(index),
+      "description": "Description of product " + str(index),
+      "link": "https://example.com/products/" + str(index),
+      "imageLink": "https://example.com/images/" + str(index) + ".jpg",
+      "price": {"value": str(generator.randint(100, 99999) / 100), "currency": "EUR"},
+      "availability": generator.choice(["in stock", "in stock", "out of stock", "preorder"]),
+      "customLabel1": generator.choice(["376", "376", "212", None]),
+    })
+  return products
+
+
+def _run(arguments) -> bool:
+  with open(os.path.join(REPOSITORY_DIR, "config.json")) as config_file:
+    config = json.load(config_file)
+  fields = main._get_content_api_fields(config)
+  attribute_filter = AttributeFilter(config["attribute_filters"])
+  products = _get_products(arguments.products)
+  expected = [product["offerId"] for product in products
+    if product.get("customLabel1") == "376" and product["availability"] == "in stock"]
+
+  #The retries of the session back off for a short time, so the run is short
+  merchant_center_helper.CONTENT_API_BACKOFF_FACTOR = arguments.backoff_factor
+  server = ProductsServer(products, arguments.page_size, arguments.page_latency, arguments.error_rate)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  bq = StandInBigqueryHelper(arguments.load_latency)
+  mc = merchant_center_helper.MerchantCenterHelper(MERCHANT_ID, bq, "Products_" + MERCHANT_ID,
+    base_url="http://127.0.0.1:{}/content/v2.1/MC_ID/products/".format(PORT), session=requests.Session())
+  try:
+    start = time.perf_counter()
+    loaded = mc.ingest_products_from_content_api(DESTINATION_TABLE, fields, attribute_filter, batch_size=arguments.batch_size)
+    seconds = time.perf_counter() - start
+  finally:
+    server.shutdown()
+    server.server_close()
+
+  rows = bq.rows[DESTINATION_TABLE]
+  pages = -(-len(products) // arguments.page_size)
+  #The next page is prefetched when it was requested before the current one was processed
+  request_times = [server.request_times[offset] for offset in sorted(server.request_times)]
+  prefetched_pages = sum(1 for page in range(1, len(request_times))
+    if page - 1 < len(bq.append_times) and request_times[page] < bq.append_times[page - 1])
+  hidden_columns = list(mc.get_content_api_filter_fields(attribute_filter, fields).keys())
+  leaked_columns = sorted({column for row in rows for column in row} - set(fields.keys()))
+  problems = []
+  if loaded != len(expected) or [row["offer_id"] for row in rows] != expected:
+    problems.append("loaded {} products, {} pass the filters".format(loaded, len(expected)))
+  if bq.columns[DESTINATION_TABLE] != list(fields.keys()) or leaked_columns:
+    problems.append("filtered attributes loaded as columns: " + ", ".join(leaked_columns or bq.columns[DESTINATION_TABLE]))
+  if pages > 1 and prefetched_pages == 0:
+    problems.append("no page was requested before the previous one was processed")
+
+  print("Products: {} served in {} pages, {} loaded in {:.2f} seconds ({:.0f} products/s)".format(
+    len(products), server.pages_served, loaded, seconds, len(products) / seconds))
+  print("Filtered attributes read as hidden columns: " + ", ".join(hidden_columns))
+  print("Requests: {}, 429 answers: {}".format(server.requests, server.injected_errors))
+  print("Pages requested ahead: {} of {}, load jobs: {}".format(prefetched_pages, pages - 1, bq.load_jobs))
+  print("Time without prefetching would be at least {:.2f} seconds".format(
+    pages * arguments.page_latency + bq.load_jobs * arguments.load_latency))
+  for problem in problems:
+    print("  " + problem)
+  return not problems
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--products", type=int, default=5000)
+  parser.add_argument("--page-size", type=int, default=merchant_center_helper.MERCHANT_CENTER_MAX_RESULTS)
+  parser.add_argument("--page-latency", type=float, default=0.02, help="seconds the server takes to answer a page")
+  parser.add_argument("--load-latency", type=float, default=0.05, help="seconds per load job of the stand-in")
+  parser.add_argument("--error-rate", type=float, default=0.1, help="share of the requests answered with a 429")
+  parser.add_argument("--batch-size", type=int, default=500)
+  parser.add_argument("--backoff-factor", type=float, default=0.01)
+  arguments = parser.parse_args()
+  sys.exit(0 if _run(arguments) else 1)
@@ -0,0 +1,90 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Measures the latency of the /test health check while the CPU bound enrichment stage runs
+in the same process, with the stage inline and in the process pool.
+
+Usage (from the repository root):
+  python benchmarks/health_check_latency.py --rows 300000 --workers 4
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from werkzeug.serving import make_server
+import main
+import process_executor
+
+PORT = 8765
+
+
+def _build_condensed_dataframe(rows: int) -> pd.core.frame.DataFrame:
+  main._get_params()
+  data = {}
+  for slot in range(1, main.params["amount_of_rows_to_condense"] + 1):
+    data[main.params["reporting_id_column"] + "_" + str(slot)] = ["offer-" + str(slot) + "-" + str(i) for i in range(rows)]
+    data["title_" + str(slot)] = ["Product title " + str(i % 1000) for i in range(rows)]
+  return pd.DataFrame(data)
+
+
+def _measure(rows: int, workers: int) -> list:
+  """
+  Runs the enrichment in a thread and requests /test every 50ms until it finishes.
+
+  return list of latencies in milliseconds
+  """
+  main._get_params()["process_pool_workers"] = workers
+  process_executor.get_executor(workers)
+  dataframe = _build_condensed_dataframe(rows)
+  stage = threading.Thread(target=main._add_studio_required_columns, args=(dataframe, main._get_params()))
+  latencies = []
+  stage.start()
+  while stage.is_alive():
+    start = time.perf_counter()
+    urllib.request.urlopen("http://127.0.0.1:" + str(PORT) + "/test").read()
+    latencies.append((time.perf_counter() - start) * 1000)
+    time.sleep(0.05)
+  stage.join()
+  return latencies
+
+
+def _report(name: str, latencies: list) -> None:
+  latencies = sorted(latencies) or [0]
+  p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+  print("{:<10} requests={:<5} p50={:8.1f}ms p95={:8.1f}ms max={:8.1f}ms".format(
+    name, len(latencies), statistics.median(latencies), p95, latencies[-1]))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=300000)
+  parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+  arguments = parser.parse_args()
+
+  server = make_server("127.0.0.1", PORT, main.app, threaded=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  try:
+    _report("inline", _measure(arguments.rows, 0))
+    _report("processes", _measure(arguments.rows, arguments.workers))
+  finally:
+    server.shutdown()
+    process_executor.get_executor().shutdown()
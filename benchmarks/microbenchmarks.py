@@ -0,0 +1,222 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Microbenchmarks of the pure python functions that run once per row or cell. They use seeded
+synthetic inputs of several sizes and no cloud services. The best time of each benchmark is
+compared with microbenchmarks_baseline.json and the script exits with an error if any of them is
+slower than the baseline by more than the configured ratio. A benchmark over the ratio is measured
+again up to RECHECK_ROUNDS times and its best time of all the rounds is compared, so a single slow
+round caused by the machine doesn't fail the run.
+
+The times of the baseline depend on the machine that measured them. Regenerate it with
+--update-baseline on the machine where the comparison runs before relying on the result.
+
+Usage (from the repository root):
+  python benchmarks/microbenchmarks.py
+  python benchmarks/microbenchmarks.py --filter condense
+  python benchmarks/microbenchmarks.py --update-baseline
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import pandas as pd
+import main
+from bigquery_helper import BigqueryHelper, condense_dataframe
+from filtering_functions import FilteringFunctions
+
+BASELINE_FILE = os.path.join(REPOSITORY_DIR, "benchmarks", "microbenchmarks_baseline.json")
+DEFAULT_MAX_RATIO = 2.0
+#Differences below this are timer noise on the smallest inputs, they never fail the comparison
+MIN_REGRESSION_MS = 1.0
+SEED = 20221017
+REPETITIONS = 5
+RECHECK_ROUNDS = 3
+SIZES = [1000, 10000, 100000]
+
+
+def _words(generator: random.Random, count: int) -> list:
+  return [" ".join(generator.choice(["red", "blue", "shoe", "shirt", "sale", "new", "kids"]) for _ in range(3))
+    for _ in range(count)]
+
+
+def _products_dataframe(generator: random.Random, rows: int, slots: int = 1) -> pd.core.frame.DataFrame:
+  data = {}
+  for slot in range(1, slots + 1):
+    suffix = "_" + str(slot) if slots > 1 else ""
+    data["offer_id" + suffix] = ["offer-" + str(generator.randrange(10 ** 9)) for _ in range(rows)]
+    data["title" + suffix] = _words(generator, rows)
+    data["price" + suffix] = [str(round(generator.uniform(1, 500), 2)) for _ in range(rows)]
+  return pd.DataFrame(data)
+
+
+def _product_jsons(generator: random.Random, count: int) -> list:
+  return [{
+    "offerId": "offer-" + str(index),
+    "title": title,
+    "customLabel1": generator.choice(["237", "238"]),
+    "contentLanguage": generator.choice(["es", "en"]),
+    "price": {"value": str(round(generator.uniform(1, 500), 2)), "currency": "EUR"},
+    "customAttributes": [{"name": "material", "value": "cotton"}]
+  } for index, title in enumerate(_words(generator, count))]
+
+
+def _setup_flatten_list(generator, size):
+  nested = [[generator.randrange(100) for _ in range(generator.randrange(1, 5))] if index % 3 else index
+    for index in range(size)]
+  bq = BigqueryHelper("benchmark-project", "benchmark_dataset")
+  return lambda: bq.flatten_list(nested)
+
+
+def _setup_rename_columns(generator, size):
+  columns = ["column_" + str(index) for index in range(size)]
+  bq = BigqueryHelper("benchmark-project", "benchmark_dataset")
+  return lambda: bq._rename_columns(3, columns)
+
+
+def _setup_reporting_ids(generator, size):
+  dataframe = _products_dataframe(generator, size, slots=3)
+  base_fields = ["offer_id_1", "offer_id_2", "offer_id_3"]
+  return lambda: main._get_df_reporting_ids(base_fields, dataframe)
+
+
+def _setup_hashed_reporting_ids(generator, size):
+  dataframe = _products_dataframe(generator, size, slots=3)
+  base_fields = ["offer_id_1", "offer_id_2", "offer_id_3"]
+  return lambda: main._get_df_hashed_reporting_ids(base_fields, dataframe)
+
+
+def _setup_add_studio_required_columns(generator, size):
+  dataframe = _products_dataframe(generator, size, slots=main.params["amount_of_rows_to_condense"])
+  #The function adds columns to its input, each repetition gets its own copy
+  return lambda: main._add_studio_required_columns(dataframe.copy(), main._get_params())
+
+
+def _setup_transform_config_to_json(generator, size):
+  values = ['"text"', "3", '["a", "b"]', '{"key": [1, 2]}', "not json"]
+  list_of_lists = [["parameter", "value"]] + [["key_" + str(index), generator.choice(values)] for index in range(size)]
+  return lambda: main._transform_config_to_json(list_of_lists)
+
+
+def _setup_transform_json_to_table(generator, size):
+  functions = FilteringFunctions()
+  products = _product_jsons(generator, size)
+  fields = [{"offerId": "['offerId']"}, {"title": "['title']"}, {"customLabel1": "['customLabel1']"},
+    {"priceValue": "['price']['value']"}, {"material": "['customAttributes'][0]['value']"}]
+  filters = {"offerId": functions.return_true, "title": functions.return_true, "customLabel1": functions.content_is_237,
+    "priceValue": functions.return_true, "material": functions.return_true}
+  return lambda: functions.transform_json_to_table_customized(products, fields, filters)
+
+
+def _setup_condense_dataframe(generator, size):
+  dataframe = _products_dataframe(generator, size)
+  columns = list(dataframe.columns)
+  return lambda: condense_dataframe(dataframe, 3, columns)
+
+
+#Every benchmark receives a seeded random generator and the input size, and returns the function to time
+BENCHMARKS = {
+  "flatten_list": _setup_flatten_list,
+  "rename_columns": _setup_rename_columns,
+  "get_df_reporting_ids": _setup_reporting_ids,
+  "get_df_hashed_reporting_ids": _setup_hashed_reporting_ids,
+  "add_studio_required_columns": _setup_add_studio_required_columns,
+  "transform_config_to_json": _setup_transform_config_to_json,
+  "transform_json_to_table_customized": _setup_transform_json_to_table,
+  "condense_dataframe": _setup_condense_dataframe,
+}
+
+
+def _best_time(name: str, size: int) -> float:
+  """
+  Returns the best time in milliseconds of REPETITIONS runs of a benchmark.
+  """
+  function = BENCHMARKS[name](random.Random(SEED), size)
+  times = []
+  for _ in range(REPETITIONS):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return round(min(times) * 1000, 3)
+
+
+def _measure(name_filter: str) -> dict:
+  """
+  Runs every benchmark at every size and returns the best time of each one in milliseconds.
+  """
+  #Row functions run inline, so the results don't depend on the process pool
+  main._get_params()["process_pool_workers"] = 0
+  results = {}
+  for name in BENCHMARKS:
+    if name_filter and name_filter not in name:
+      continue
+    for size in SIZES:
+      results[name + "[" + str(size) + "]"] = _best_time(name, size)
+      print("  {:<50} {:10.3f} ms".format(name + "[" + str(size) + "]", results[name + "[" + str(size) + "]"]))
+  return results
+
+
+def _is_regression(milliseconds: float, baseline_milliseconds: float, max_ratio: float) -> bool:
+  return milliseconds / baseline_milliseconds > max_ratio and milliseconds - baseline_milliseconds > MIN_REGRESSION_MS
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains this text")
+  parser.add_argument("--update-baseline", action="store_true")
+  arguments = parser.parse_args()
+
+  results = _measure(arguments.filter)
+
+  if arguments.update_baseline or not os.path.exists(BASELINE_FILE):
+    baseline = {"max_ratio": DEFAULT_MAX_RATIO, "results_ms": {}}
+    if os.path.exists(BASELINE_FILE):
+      with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline["results_ms"].update(results)
+    with open(BASELINE_FILE, "w") as baseline_file:
+      json.dump(baseline, baseline_file, indent=2)
+      baseline_file.write("\n")
+    print("Baseline stored in " + BASELINE_FILE)
+    sys.exit(0)
+
+  with open(BASELINE_FILE) as baseline_file:
+    baseline = json.load(baseline_file)
+  max_ratio = baseline.get("max_ratio", DEFAULT_MAX_RATIO)
+  failed = False
+  for name, milliseconds in results.items():
+    if name not in baseline["results_ms"]:
+      print("{}: no baseline".format(name))
+      continue
+    baseline_milliseconds = baseline["results_ms"][name]
+    #A slow round is measured again, a regression is slow in every round
+    for _ in range(RECHECK_ROUNDS):
+      if not _is_regression(milliseconds, baseline_milliseconds, max_ratio):
+        break
+      benchmark, size = name[:-1].split("[")
+      milliseconds = min(milliseconds, _best_time(benchmark, int(size)))
+    print("{}: {:.2f}x the baseline".format(name, milliseconds / baseline_milliseconds))
+    if _is_regression(milliseconds, baseline_milliseconds, max_ratio):
+      print("Regression in " + name)
+      failed = True
+  if failed:
+    print("The baseline is specific to the machine that measured it, regenerate it with --update-baseline on this machine")
+  sys.exit(1 if failed else 0)
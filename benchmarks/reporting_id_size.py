@@ -0,0 +1,130 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compares the feed produced with the concatenated and the hashed reporting ids. A condensed feed
+with seeded synthetic products is enriched in both modes with the code of the pipeline, converted to
+csv as for the Google Sheets export, and imported with the shared Sheets client into the local fake
+of the Sheets API of sheets_rate_limit.py.
+
+The report has the size of the reporting_id column and of the whole csv, and the time to enrich,
+convert and import the feed in each mode. The script exits with an error if the hashed reporting ids
+are not unique, or if the hashed feed is not smaller than the concatenated one.
+
+Usage (from the repository root):
+  python benchmarks/reporting_id_size.py
+  python benchmarks/reporting_id_size.py --rows 200000 --condensed 4 --offer-id-length 40
+"""
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import pandas as pd
+import main
+from bigquery_helper import dataframe_to_csv
+from sheets_client import RateLimitedClient, SheetsClient, TokenBucket
+from sheets_rate_limit import FakeSheetsSession
+
+SEED = 20221017
+REPETITIONS = 3
+
+
+def _condensed_feed(rows: int, condensed: int, offer_id_length: int) -> pd.core.frame.DataFrame:
+  generator = random.Random(SEED)
+  alphabet = string.ascii_uppercase + string.digits
+  data = {}
+  for slot in range(1, condensed + 1):
+    suffix = "_" + str(slot)
+    data["offer_id" + suffix] = ["".join(generator.choice(alphabet) for _ in range(offer_id_length)) for _ in range(rows)]
+    data["title" + suffix] = ["Product title " + str(generator.randrange(1000)) for _ in range(rows)]
+    data["price" + suffix] = [str(round(generator.uniform(1, 500), 2)) + " EUR" for _ in range(rows)]
+    data["link" + suffix] = ["https://example.com/p/" + str(generator.randrange(10 ** 6)) for _ in range(rows)]
+  data["variant"] = [generator.choice(["small", "medium", "large"]) for _ in range(rows)]
+  return pd.DataFrame(data)
+
+
+def _measure(feed: pd.core.frame.DataFrame, config: dict) -> dict:
+  start = time.perf_counter()
+  enriched = main._add_studio_required_columns(feed.copy(), config)
+  enrich_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  csv_data = dataframe_to_csv(enriched, True).encode("utf-8")
+  csv_seconds = time.perf_counter() - start
+
+  import_times = []
+  for _ in range(REPETITIONS):
+    #The fake parses the csv into cells, as the import of the Sheets API does
+    session = FakeSheetsSession(requests_per_window=10 ** 6, error_rate=0)
+    sheets = SheetsClient(RateLimitedClient(None, session=session, bucket=TokenBucket(10 ** 6)))
+    start = time.perf_counter()
+    sheets.export_csv("feed", csv_data)
+    import_times.append(time.perf_counter() - start)
+
+  reporting_ids = enriched[main.STUDIO_REPORTING_ID].astype(str)
+  return {
+    "reporting_id_bytes": int(reporting_ids.str.len().sum()),
+    "reporting_id_max_length": int(reporting_ids.str.len().max()),
+    "csv_bytes": len(csv_data),
+    "enrich_seconds": enrich_seconds,
+    "csv_seconds": csv_seconds,
+    "import_seconds": statistics.median(import_times),
+    "unique": not reporting_ids.duplicated().any(),
+  }
+
+
+def _run(arguments) -> bool:
+  feed = _condensed_feed(arguments.rows, arguments.condensed, arguments.offer_id_length)
+  base_config = dict(main._get_params(), amount_of_rows_to_condense=arguments.condensed,
+    reporting_id_column="offer_id", process_pool_workers=0)
+  results = {}
+  for mode in [main.REPORTING_ID_MODE_CONCATENATED, main.REPORTING_ID_MODE_HASHED]:
+    results[mode] = _measure(feed, dict(base_config, reporting_id_mode=mode))
+
+  print("Feed: {} rows, {} products per row, offer ids of {} characters".format(
+    arguments.rows, arguments.condensed, arguments.offer_id_length))
+  print("{:<14} {:>18} {:>12} {:>12} {:>10} {:>10} {:>10}".format(
+    "mode", "reporting_id bytes", "max length", "csv bytes", "enrich s", "csv s", "import s"))
+  for mode, result in results.items():
+    print("{:<14} {:>18} {:>12} {:>12} {:>10.3f} {:>10.3f} {:>10.3f}".format(mode, result["reporting_id_bytes"],
+      result["reporting_id_max_length"], result["csv_bytes"], result["enrich_seconds"], result["csv_seconds"], result["import_seconds"]))
+  concatenated = results[main.REPORTING_ID_MODE_CONCATENATED]
+  hashed = results[main.REPORTING_ID_MODE_HASHED]
+  print("Hashed feed: {:.1%} of the csv bytes, {:.1%} of the reporting_id bytes, {:.1%} of the import time".format(
+    hashed["csv_bytes"] / concatenated["csv_bytes"], hashed["reporting_id_bytes"] / concatenated["reporting_id_bytes"],
+    hashed["import_seconds"] / concatenated["import_seconds"]))
+
+  problems = []
+  if not hashed["unique"]:
+    problems.append("the hashed reporting ids are not unique")
+  if hashed["csv_bytes"] >= concatenated["csv_bytes"]:
+    problems.append("the hashed feed is not smaller than the concatenated one")
+  for problem in problems:
+    print("  " + problem)
+  return not problems
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--rows", type=int, default=100000, help="rows of the condensed feed")
+  parser.add_argument("--condensed", type=int, default=3, help="products per row, as amount_of_rows_to_condense")
+  parser.add_argument("--offer-id-length", type=int, default=24)
+  arguments = parser.parse_args()
+  sys.exit(0 if _run(arguments) else 1)
@@ -0,0 +1,398 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Load test of the service when the scheduler, the config sheet and health checks hit it at the same
+time. The Flask app is served by a server with a fixed pool of threads, as gunicorn with one worker
+and --threads, and /test, /execute and /updateConfig are requested concurrently for a while.
+
+BigQuery, Merchant Center and Google Sheets are replaced by local stand-ins: the helpers keep their
+tables in memory and wait a fixed latency per call, and the condense, enrichment and csv export code
+of the pipeline runs unchanged. Every /updateConfig serves a new version of the configuration, with
+option values tagged with the version number.
+
+The report has the latency percentiles, throughput and errors of every endpoint, and checks that
+the final Google Sheet holds the complete output of a single configuration version, that it matches
+the published table, and that config.json holds the last configuration served. The script exits
+with an error if any request failed or a check didn't pass.
+
+Usage (from the repository root):
+  python benchmarks/service_load.py
+  python benchmarks/service_load.py --seconds 60 --server-threads 2 --execute-interval 1
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import pandas as pd
+from google.cloud import bigquery
+from google.cloud import exceptions as cloud_exceptions
+from werkzeug.serving import BaseWSGIServer
+import bigquery_helper
+import merchant_center_helper
+import sheets_client
+
+PORT = 8767
+TRANSFER_TABLE = "Products_stand_in"
+CONFIG_SHEET = "CartesianConfig"
+OPTION_COLUMN = "variant"
+OPTION_VALUES = 2
+ENDPOINTS = ["/test", "/execute", "/updateConfig"]
+
+
+class StandInStore:
+  """Tables, Google Sheets and served configurations shared by every stand-in helper."""
+
+  def __init__(self, products: int, bigquery_latency: float, sheets_latency: float):
+    self.products = products
+    self.bigquery_latency = bigquery_latency
+    self.sheets_latency = sheets_latency
+    self.tables = {}
+    self.sheets = {}
+    self.config_versions = []
+    self.lock = threading.Lock()
+
+  def get(self, table_name: str):
+    with self.lock:
+      if table_name not in self.tables:
+        raise cloud_exceptions.NotFound(table_name)
+      return self.tables[table_name]
+
+  def put(self, table_name: str, value) -> None:
+    with self.lock:
+      self.tables[table_name] = value
+
+
+store = None
+
+
+class StandInBigqueryHelper(bigquery_helper.BigqueryHelper):
+  """
+  BigqueryHelper whose reads and writes go to the in memory store, waiting the configured latency
+  per call. Methods that only transform dataframes are not replaced.
+  """
+
+  def _wait(self) -> None:
+    time.sleep(store.bigquery_latency)
+
+  def get_bq_table(self, table_name):
+    self._wait()
+    if table_name == TRANSFER_TABLE:
+      fields = ["title", "description", "offer_id", "price", "link", "image_link"]
+      return types.SimpleNamespace(schema=[bigquery.SchemaField(field, "STRING") for field in fields],
+        num_rows=store.products, num_bytes=0, modified=None, labels={})
+    dataframe, modified = store.get(table_name)
+    if isinstance(dataframe, list):
+      #Run manifest, the only table kept as a list of rows
+      return types.SimpleNamespace(schema=[], num_rows=len(dataframe), num_bytes=0, modified=modified, labels={},
+        time_partitioning=True)
+    return types.SimpleNamespace(schema=[], num_rows=len(dataframe), num_bytes=int(dataframe.memory_usage(deep=True).sum()),
+      modified=modified, labels={}, time_partitioning=None)
+
+  def get_latest_partition_id(self, table_name):
+    return "20221017"
+
+  def get_big_query_table_as_df(self, table_name, selected_fields=None, row_restriction=None):
+    self._wait()
+    return store.get(table_name)[0].copy()
+
+  def iterate_table(self, table_name, select='*', where=None, page_size=bigquery_helper.READ_PAGE_SIZE, output="rows"):
+    self._wait()
+    dataframe = store.get(table_name)[0]
+    for start in range(0, len(dataframe), page_size):
+      yield dataframe.iloc[start:start + page_size]
+
+  def upload_dataframe_to_big_query(self, condensed_dataframe, write_disposition, final_joined_table_name):
+    self._wait()
+    store.put(final_joined_table_name, (condensed_dataframe.copy(), datetime.datetime.now(datetime.timezone.utc)))
+
+  def copy_table(self, source_table_name, destination_table_name):
+    self._wait()
+    store.put(destination_table_name, store.get(source_table_name))
+
+  def create_new_table_from_options_cross_join(self, source_table, destination_table, options=None, compiled_options=None):
+    self._wait()
+    dataframe = store.get(source_table)[0]
+    if compiled_options:
+      #Expands the compiled UNNEST clauses, as BigQuery would, instead of the options of the config
+      cross_join, query_parameters = compiled_options
+      values = {parameter.name: parameter.values for parameter in query_parameters}
+      options = {column: values[name] for name, column in re.findall(r"UNNEST\(@(\w+)\) AS `(\w+)`", cross_join)}
+    for column, values in options.items():
+      dataframe = dataframe.merge(pd.DataFrame({column: [str(value) for value in values]}), how="cross")
+    store.put(destination_table, (dataframe, datetime.datetime.now(datetime.timezone.utc)))
+
+  def create_table(self, table_name, columns, update_if_exist=True, mode="REQUIRED", partition_expiration_days=None):
+    self._wait()
+    with store.lock:
+      store.tables.setdefault(table_name, ([], None))
+
+  def insert_single_record(self, table_name, data):
+    self._wait()
+    with store.lock:
+      store.tables[table_name][0].append(dict(data))
+
+  def read_from_table(self, table_name, select='*', limit=None, offset=None, where=None, query_parameters=None):
+    self._wait()
+    rows = store.get(table_name)[0]
+    #Only the run manifest is read with this method, filtered by its query parameters
+    return [row for row in rows if all(row.get(parameter.name) == parameter.value for parameter in query_parameters or [])]
+
+
+class StandInMerchantCenterHelper(merchant_center_helper.MerchantCenterHelper):
+  """MerchantCenterHelper whose transfer and products base tables are generated in memory."""
+
+  def refresh_base_table(self, base_table_name, select_fields, filters_dict, partition_expiration_days=None):
+    time.sleep(store.bigquery_latency)
+    return True
+
+  def copy_base_table(self, destination_table_name, base_table_name, columns, limit=None):
+    self._copy_products(destination_table_name, columns, limit)
+
+  def copy_datatransfer_table(self, destination_table_name, select_fields, filters_dict, limit=None):
+    #Projected fields are either a column or an expression with its alias
+    self._copy_products(destination_table_name, [field.split(" AS ")[-1] for field in select_fields], limit)
+
+  def _copy_products(self, destination_table_name, columns, limit):
+    time.sleep(store.bigquery_latency)
+    rows = min(store.products, limit or store.products)
+    dataframe = pd.DataFrame({column: [column + "-" + str(index) for index in range(rows)] for column in columns})
+    store.put(destination_table_name, (dataframe, datetime.datetime.now(datetime.timezone.utc)))
+
+
+class StandInSheetsClient:
+  """Google Sheets stand-in, /updateConfig reads a new configuration version on every call."""
+
+  def __init__(self, base_config: dict):
+    self.base_config = base_config
+
+  def read_first_worksheet(self, name: str) -> list:
+    time.sleep(store.sheets_latency)
+    with store.lock:
+      version = len(store.config_versions) + 1
+      #The option column is renamed every version, a run that mixes configurations doesn't find it
+      config = dict(self.base_config, additional_columns={
+        OPTION_COLUMN + str(version % 3): ["v{}_{}".format(version, index) for index in range(OPTION_VALUES)]})
+      store.config_versions.append(config)
+    return [["parameter", "value"]] + [[key, json.dumps(value)] for key, value in config.items()]
+
+  def export_csv(self, name: str, data: bytes, share_with=None) -> str:
+    time.sleep(store.sheets_latency)
+    with store.lock:
+      store.sheets[name] = data
+    return name
+
+  def forget(self, name: str) -> None:
+    pass
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+  """
+  Serves every connection in a fixed pool of threads, connections wait while every thread is busy.
+  Same model as gunicorn with the gthread worker.
+  """
+
+  def __init__(self, host: str, port: int, app, threads: int):
+    super().__init__(host, port, app)
+    self.pool = ThreadPoolExecutor(max_workers=threads)
+
+  def process_request(self, request, client_address):
+    self.pool.submit(self._process_request, request, client_address)
+
+  def _process_request(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+
+def _request(path: str, results: dict) -> None:
+  start = time.perf_counter()
+  try:
+    with urllib.request.urlopen("http://127.0.0.1:" + str(PORT) + path, timeout=600) as response:
+      body = response.read().decode("utf-8")
+      error = None if response.status == 200 and "Unsuccesful" not in body and "Not updated" not in body else body.strip()
+  except (urllib.error.URLError, OSError) as exception:
+    error = str(exception)
+  endpoint = path.split("?")[0]
+  with store.lock:
+    results[endpoint]["latencies"].append((time.perf_counter() - start) * 1000)
+    if error:
+      results[endpoint]["errors"].append(error)
+
+
+def _drive(arguments, results: dict) -> float:
+  """
+  Requests /test from the health check clients in a loop, and starts /execute and /updateConfig on
+  their intervals without waiting for the previous ones, as the schedulers do.
+
+  return seconds from the first request until the last one answered
+  """
+  deadline = time.monotonic() + arguments.seconds
+  start = time.perf_counter()
+  threads = []
+
+  def health_check():
+    while time.monotonic() < deadline:
+      _request("/test", results)
+      time.sleep(arguments.test_interval)
+
+  def every(interval: float, path: str):
+    while time.monotonic() < deadline:
+      thread = threading.Thread(target=_request, args=(path, results))
+      thread.start()
+      threads.append(thread)
+      time.sleep(interval)
+
+  drivers = [threading.Thread(target=health_check) for _ in range(arguments.health_clients)]
+  drivers.append(threading.Thread(target=every, args=(arguments.execute_interval, "/execute")))
+  drivers.append(threading.Thread(target=every, args=(arguments.config_interval, "/updateConfig?sheet_name=" + CONFIG_SHEET)))
+  for driver in drivers:
+    driver.start()
+  for driver in drivers:
+    driver.join()
+  for thread in threads:
+    thread.join()
+  return time.perf_counter() - start
+
+
+def _check_output(main_module) -> list:
+  """
+  Returns the problems found in the final output, an empty list if it's consistent.
+  """
+  problems = []
+  params = main_module.params
+  sheet = store.sheets.get(str(params["output_google_sheet_name"]))
+  if sheet is None:
+    return ["no feed was exported to Google Sheets"]
+  feed = pd.read_csv(io.BytesIO(sheet), dtype=str)
+  option_columns = [column for column in feed.columns if column.startswith(OPTION_COLUMN)]
+  versions = {value.split("_")[0] for column in option_columns for value in feed[column].dropna()}
+  if len(versions) != 1:
+    problems.append("the feed mixes rows of configuration versions " + ", ".join(sorted(versions)))
+  elif any(column.split("_")[0] != OPTION_COLUMN + str(int(next(iter(versions))[1:]) % 3) for column in option_columns):
+    problems.append("the option columns don't belong to the configuration version of their values")
+  amount = params["amount_of_rows_to_condense"] or 1
+  expected_rows = store.products * OPTION_VALUES // amount
+  if len(feed) != expected_rows:
+    problems.append("the feed has {} rows instead of {}".format(len(feed), expected_rows))
+  if feed[main_module.STUDIO_ID].astype(int).tolist() != list(range(1, len(feed) + 1)):
+    problems.append("the Studio ids are not consecutive")
+  if feed[main_module.STUDIO_REPORTING_ID].duplicated().any():
+    problems.append("the reporting ids are not unique")
+  #The published table is named after the option columns of its configuration
+  option_tables = "".join(sorted({column.split("_")[0] + "Table" for column in option_columns}))
+  published = [table for name, (table, _) in store.tables.items()
+    if name.endswith(main_module.ENRICHED_SUFFIX) and option_tables in name]
+  if not published or len(published[0]) != len(feed) or \
+    published[0][main_module.STUDIO_REPORTING_ID].astype(str).tolist() != feed[main_module.STUDIO_REPORTING_ID].tolist():
+    problems.append("the Google Sheet and the published table come from different runs")
+  with open("config.json") as config_file:
+    saved_config = json.load(config_file)
+  if store.config_versions and saved_config != store.config_versions[-1]:
+    problems.append("config.json doesn't hold the last configuration served")
+  return problems
+
+
+def _report(results: dict, seconds: float) -> None:
+  for endpoint in ENDPOINTS:
+    latencies = sorted(results[endpoint]["latencies"]) or [0]
+
+    def percentile(share):
+      return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+    print("{:<14} requests={:<5} errors={:<4} throughput={:6.2f}/s p50={:9.1f}ms p95={:9.1f}ms p99={:9.1f}ms max={:9.1f}ms".format(
+      endpoint, len(results[endpoint]["latencies"]), len(results[endpoint]["errors"]),
+      len(results[endpoint]["latencies"]) / seconds, statistics.median(latencies), percentile(0.95), percentile(0.99), latencies[-1]))
+    for error in sorted(set(results[endpoint]["errors"]))[:5]:
+      print("  " + error[:200])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--seconds", type=float, default=30, help="time new requests are started")
+  parser.add_argument("--server-threads", type=int, default=8, help="threads of the server, as gunicorn --threads")
+  parser.add_argument("--health-clients", type=int, default=2)
+  parser.add_argument("--test-interval", type=float, default=0.1)
+  parser.add_argument("--execute-interval", type=float, default=3)
+  parser.add_argument("--config-interval", type=float, default=5)
+  parser.add_argument("--products", type=int, default=20000)
+  parser.add_argument("--bigquery-latency-ms", type=float, default=200)
+  parser.add_argument("--sheets-latency-ms", type=float, default=300)
+  parser.add_argument("--process-pool-workers", type=int, default=0)
+  parser.add_argument("--verbose", action="store_true", help="show the output of the pipeline")
+  arguments = parser.parse_args()
+
+  store = StandInStore(arguments.products, arguments.bigquery_latency_ms / 1000, arguments.sheets_latency_ms / 1000)
+  #/updateConfig rewrites config.json, the service runs on a copy
+  work_directory = tempfile.mkdtemp(prefix="cartesian-load-")
+  with open(os.path.join(REPOSITORY_DIR, "config.json")) as config_file:
+    base_config = json.load(config_file)
+  base_config.update(mc_datatransfer_table=TRANSFER_TABLE, process_pool_workers=arguments.process_pool_workers,
+    output_google_sheet_name="CartesianDCOFeed", additional_columns={OPTION_COLUMN + "0": ["v0_0", "v0_1"]})
+  with open(os.path.join(work_directory, "config.json"), "w") as config_file:
+    json.dump(base_config, config_file)
+  os.chdir(work_directory)
+
+  bigquery_helper.BigqueryHelper = StandInBigqueryHelper
+  merchant_center_helper.MerchantCenterHelper = StandInMerchantCenterHelper
+  stand_in_sheets = StandInSheetsClient(base_config)
+  sheets_client.get_sheets_client = lambda requests_per_minute=None: stand_in_sheets
+  bigquery_helper.get_sheets_client = sheets_client.get_sheets_client
+  import main
+  logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+  server = ThreadPoolWSGIServer("127.0.0.1", PORT, main.app, arguments.server_threads)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  results = {endpoint: {"latencies": [], "errors": []} for endpoint in ENDPOINTS}
+  try:
+    output = sys.stdout if arguments.verbose else io.StringIO()
+    with contextlib.redirect_stdout(output):
+      seconds = _drive(arguments, results)
+  finally:
+    server.shutdown()
+    server.pool.shutdown()
+
+  print("{} seconds, {} server threads, {} configuration versions served".format(
+    round(seconds, 1), arguments.server_threads, len(store.config_versions)))
+  _report(results, seconds)
+  problems = _check_output(main)
+  for problem in problems:
+    print("Inconsistent output: " + problem)
+  if not problems:
+    print("Output is consistent")
+  os.chdir(REPOSITORY_DIR)
+  shutil.rmtree(work_directory, ignore_errors=True)
+  failed = problems or any(results[endpoint]["errors"] for endpoint in ENDPOINTS)
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,183 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Runs the shared Sheets client against a local fake of the Sheets and Drive APIs that enforces a
+per window quota and answers a share of the requests with 429 at random. Several threads export,
+clear and read sheets at the same time, as shard publishing does. The script exits with an error if
+any operation fails, or if the token bucket lets through more requests than the quota allows.
+
+Usage (from the repository root):
+  python benchmarks/sheets_rate_limit.py
+  python benchmarks/sheets_rate_limit.py --error-rate 0.3 --sheets 40
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+import requests
+from gspread import urls
+from sheets_client import RateLimitedClient, SheetsClient, TokenBucket
+
+SEED = 20221017
+#The quota of the fake is counted over windows of this many seconds instead of a minute, so the run is short
+WINDOW_SECONDS = 2
+
+
+class FakeSheetsSession:
+  """
+  Answers the requests gspread makes for open, create, import, share, clear and read, keeping the
+  spreadsheets in memory. Requests over the quota of the current window, and a random share of the
+  others, get a 429.
+  """
+
+  def __init__(self, requests_per_window: int, error_rate: float):
+    self.requests_per_window = requests_per_window
+    self.error_rate = error_rate
+    self.random = random.Random(SEED)
+    self.spreadsheets = {}
+    self.requests = 0
+    self.injected_errors = 0
+    self.quota_errors = 0
+    self.max_requests_in_window = 0
+    self._times = deque()
+    self._lock = threading.Lock()
+
+  def get(self, url, **kwargs):
+    return self._handle("get", url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self._handle("post", url, **kwargs)
+
+  def put(self, url, **kwargs):
+    return self._handle("put", url, **kwargs)
+
+  def _handle(self, method, url, params=None, json=None, data=None, **kwargs):
+    with self._lock:
+      self.requests += 1
+      now = time.monotonic()
+      while self._times and self._times[0] <= now - WINDOW_SECONDS:
+        self._times.popleft()
+      #Only accepted requests count against the quota
+      if len(self._times) >= self.requests_per_window:
+        self.quota_errors += 1
+        return self._response(429, {"error": {"code": 429, "message": "Quota exceeded"}})
+      self._times.append(now)
+      self.max_requests_in_window = max(self.max_requests_in_window, len(self._times))
+      if self.random.random() < self.error_rate:
+        self.injected_errors += 1
+        return self._response(429, {"error": {"code": 429, "message": "Injected error"}})
+      return self._route(method, url, params or {}, json, data)
+
+  def _route(self, method, url, params, body, data):
+    if url == urls.DRIVE_FILES_API_V3_URL and method == "get":
+      name = params["q"].split('name = "')[1].rstrip('"')
+      return self._response(200, {"files": [{"id": key, "name": value["name"]}
+        for key, value in self.spreadsheets.items() if value["name"] == name]})
+    if url == urls.DRIVE_FILES_API_V3_URL and method == "post":
+      spreadsheet_id = uuid.uuid4().hex
+      self.spreadsheets[spreadsheet_id] = {"name": body["name"], "rows": [], "permissions": []}
+      return self._response(200, {"id": spreadsheet_id})
+    if url.startswith(urls.DRIVE_FILES_UPLOAD_API_V2_URL + "/"):
+      spreadsheet = self.spreadsheets.get(url.rsplit("/", 1)[1])
+      if spreadsheet is None:
+        return self._response(404, {"error": {"code": 404, "message": "Not found"}})
+      spreadsheet["rows"] = [line.split(",") for line in data.decode("utf-8").splitlines()]
+      return self._response(200, {})
+    if url.startswith(urls.DRIVE_FILES_API_V3_URL + "/") and url.endswith("/permissions"):
+      self.spreadsheets[url.split("/")[-2]]["permissions"].append(body["emailAddress"])
+      return self._response(200, {})
+    if url.startswith(urls.SPREADSHEETS_API_V4_BASE_URL + "/"):
+      spreadsheet_id = url[len(urls.SPREADSHEETS_API_V4_BASE_URL) + 1:].split("/")[0].split(":")[0]
+      spreadsheet = self.spreadsheets.get(spreadsheet_id)
+      if spreadsheet is None:
+        return self._response(404, {"error": {"code": 404, "message": "Not found"}})
+      if url.endswith(":batchClear"):
+        spreadsheet["rows"] = []
+        return self._response(200, {})
+      if "/values/" in url:
+        return self._response(200, {"range": unquote(url.rsplit("/", 1)[1]), "values": spreadsheet["rows"]})
+      return self._response(200, {"properties": {"title": spreadsheet["name"]}, "sheets": [
+        {"properties": {"sheetId": 0, "title": "Sheet1", "index": 0, "gridProperties": {"rowCount": 1000, "columnCount": 26}}}]})
+    return self._response(404, {"error": {"code": 404, "message": "Unknown url " + url}})
+
+  def _response(self, status_code: int, body: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode("utf-8")
+    return response
+
+
+def _run(arguments) -> bool:
+  requests_per_window = int(arguments.requests_per_minute * WINDOW_SECONDS / 60)
+  session = FakeSheetsSession(requests_per_window, arguments.error_rate)
+  #The bucket uses the same window as the fake
+  bucket = TokenBucket(requests_per_window, window_seconds=WINDOW_SECONDS)
+  client = RateLimitedClient(None, session=session, bucket=bucket, max_attempts=arguments.max_attempts,
+    backoff_seconds=arguments.backoff_seconds)
+  sheets = SheetsClient(client)
+
+  def publish(index: int) -> None:
+    name = "feed_" + str(index % arguments.sheets)
+    rows = "\n".join(",".join([str(index), "offer-" + str(row), "title"]) for row in range(20))
+    sheets.export_csv(name, ("id,offer_id,title\n" + rows).encode("utf-8"), "user@example.com")
+    if index % 5 == 0:
+      sheets.clear(name, ["A1:AZ100000"])
+    if index % 7 == 0:
+      sheets.read_first_worksheet(name)
+
+  start = time.perf_counter()
+  failures = []
+  with ThreadPoolExecutor(max_workers=arguments.threads) as executor:
+    for index, future in enumerate([executor.submit(publish, index) for index in range(arguments.operations)]):
+      try:
+        future.result()
+      except Exception as exception:
+        failures.append("operation {}: {}: {}".format(index, type(exception).__name__, exception))
+  seconds = time.perf_counter() - start
+
+  print("Operations: {} in {:.1f} seconds, {} failed".format(arguments.operations, seconds, len(failures)))
+  print("Requests: {}, retries: {}".format(session.requests, client.retries))
+  print("429 answers: {} injected, {} over the quota".format(session.injected_errors, session.quota_errors))
+  print("Most requests in a {} second window: {} (quota {})".format(WINDOW_SECONDS, session.max_requests_in_window, requests_per_window))
+  print("Spreadsheets: {}, shared {} times".format(len(session.spreadsheets),
+    sum(len(spreadsheet["permissions"]) for spreadsheet in session.spreadsheets.values())))
+  for failure in failures:
+    print("  " + failure)
+  return not failures and session.quota_errors == 0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--requests-per-minute", type=float, default=1200,
+    help="quota of the fake, the bucket of the client is set to the same rate")
+  parser.add_argument("--error-rate", type=float, default=0.1, help="share of the requests answered with a 429")
+  parser.add_argument("--operations", type=int, default=60)
+  parser.add_argument("--sheets", type=int, default=12)
+  parser.add_argument("--threads", type=int, default=4)
+  parser.add_argument("--max-attempts", type=int, default=6)
+  parser.add_argument("--backoff-seconds", type=float, default=0.05)
+  arguments = parser.parse_args()
+  sys.exit(0 if _run(arguments) else 1)
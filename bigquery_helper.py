@@ -13,29 +13,230 @@
 # limitations under the License.
 
 import datetime
+import decimal
+import hashlib
+import io
 import math
 import json
+import re
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 from google.cloud import exceptions as cloud_exceptions
 from typing import Optional, List
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import db_dtypes
 import pandas as pd
-import gspread
+import pyarrow as pa
 from service_account_authenticator import Service_Account_Authenticator
-from typing import Optional
-import google.auth
+from process_executor import ProcessExecutor
+from sheets_client import get_sheets_client
 
 EXPORT_LIMIT_GB = 1
-GOOGLE_SHEETS_AUTH_SCOPES=["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',"https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+BATCH_WRITER_MAX_ROWS = 10000
+BATCH_WRITER_MAX_BYTES = 10 * 1024 * 1024
+BATCH_WRITER_MAX_SECONDS = 60
+READ_PAGE_SIZE = 10000
+STORAGE_READ_MAX_STREAMS = 8
+METADATA_CACHE_TTL_SECONDS = 300
+#What grouped condense does with the last bundle of a group when it has fewer rows than slots:
+#drop it, leave the missing slots empty or fill them repeating the first rows of the group
+CONDENSE_LEFTOVER_POLICIES = ("drop", "pad", "repeat")
+#Text columns with fewer distinct values than this share of their rows are stored as categoricals
+COMPACT_MAX_UNIQUE_RATIO = 0.5
+#Largest values and digits after the decimal point of the NUMERIC type, wider decimals are BIGNUMERIC
+NUMERIC_MAX_VALUE = decimal.Decimal("1e29")
+NUMERIC_MAX_SCALE = 9
 ENRICHED_SUFFIX="Enriched"
 
+def condense_dataframe(dataframe: pd.core.frame.DataFrame, amount_of_rows_to_condense: int, columns: List[str]) -> pd.core.frame.DataFrame:
+  """
+  Condenses every amount_of_rows_to_condense rows of a dataframe into a single row.
+  The first slot takes the first rows, the second slot the following ones and so on, rows that
+  don't complete a condensed row are dropped. Defined at module level so it can run in a worker process.
+
+  Args:
+    dataframe: rows to condense, already shuffled
+    amount_of_rows_to_condense: The amount of rows that will become a single row.
+    columns: List of columns in the dataframe.
+
+  Returns
+    dataframe with the columns of every slot, named column_slot
+  """
+  condensed_rows=len(dataframe)//amount_of_rows_to_condense
+  sample_row_len=len(dataframe.columns)
+  final_columns=columns*amount_of_rows_to_condense
+  temp=[]
+  index_col=1
+  index_ctl=0
+  for col in final_columns:
+    temp.append(col+"_"+str(index_col))
+    index_ctl+=1
+    if index_ctl==sample_row_len:
+      index_col+=1
+      index_ctl=0
+  final_columns=temp
+  slots=[]
+  for i in range(amount_of_rows_to_condense):
+    slot=dataframe.iloc[i*condensed_rows:(i+1)*condensed_rows].reset_index(drop=True)
+    slot.columns=final_columns[i*sample_row_len:(i+1)*sample_row_len]
+    slots.append(slot)
+  return pd.concat(slots, axis=1)
+
+
+def bigquery_types_mapper(arrow_type: pa.DataType):
+  """
+  Returns the pandas dtype of an Arrow column read from BigQuery, as RowIterator.to_dataframe does:
+  INT64 and BOOL columns keep their type when they have NULLs, and DATE and TIME use db-dtypes.
+  Other types use the default conversion. Pass it as types_mapper to Table.to_pandas.
+  """
+  if pa.types.is_int64(arrow_type):
+    return pd.Int64Dtype()
+  if pa.types.is_boolean(arrow_type):
+    return pd.BooleanDtype()
+  if pa.types.is_date32(arrow_type):
+    return db_dtypes.DateDtype()
+  if pa.types.is_time64(arrow_type):
+    return db_dtypes.TimeDtype()
+  return None
+
+
+def dataframe_to_csv(dataframe: pd.core.frame.DataFrame, header: bool) -> str:
+  """
+  Converts a dataframe to csv text. Defined at module level so it can run in a worker process.
+  """
+  return dataframe.to_csv(index=False, header=header)
+
+
+class TableMetadataCache:
+  """
+  Keeps the metadata of BigQuery tables (schema, row count, modification time) and their latest
+  partition, so repeated lookups in a run, and across runs in the same instance, don't need an API call.
+
+  Tables are fetched again after ttl_seconds, or right away when BigqueryHelper writes to them.
+  A cached partition id is kept only while the etag and modification time of its table don't change.
+  """
+
+  def __init__(self, ttl_seconds: Optional[float] = METADATA_CACHE_TTL_SECONDS):
+    self.ttl_seconds = ttl_seconds
+    self._tables = {}
+    self._partitions = {}
+    self._lock = threading.Lock()
+
+  def get_table(self, full_table_name: str, fetch) -> bigquery.Table:
+    """
+    Returns the cached table metadata, or the result of fetch() if it's missing or expired.
+
+    Args:
+      full_table_name: project.dataset.table name, used as cache key
+      fetch: function without parameters that returns the bigquery Table
+    """
+    with self._lock:
+      cached = self._tables.get(full_table_name)
+    if cached and time.monotonic() - cached[0] < self.ttl_seconds:
+      return cached[1]
+    table = fetch()
+    with self._lock:
+      self._tables[full_table_name] = (time.monotonic(), table)
+    return table
+
+  def get_partition_id(self, table: bigquery.Table, fetch) -> Optional[str]:
+    """
+    Returns the cached latest partition of a table, or the result of fetch() if the table changed since.
+
+    Args:
+      table: metadata of the partitioned table
+      fetch: function without parameters that returns the latest partition id
+    """
+    version = (table.etag, table.modified)
+    key = table.full_table_id
+    with self._lock:
+      cached = self._partitions.get(key)
+    if cached and cached[0] == version:
+      return cached[1]
+    partition_id = fetch()
+    with self._lock:
+      self._partitions[key] = (version, partition_id)
+    return partition_id
+
+  def invalidate(self, full_table_name: str) -> None:
+    """Drops the cached metadata of a table that was modified."""
+    with self._lock:
+      self._tables.pop(full_table_name, None)
+
+
+#Shared by every BigqueryHelper of the process, so the metadata survives between runs
+_metadata_cache = TableMetadataCache()
+
+#Clients are thread safe and slow to create (credentials lookup, HTTP sessions), one per project is
+#shared by every BigqueryHelper of the process
+_clients = {}
+_read_client = None
+_clients_lock = threading.Lock()
+
+
+def _get_shard_name(value) -> str:
+  """
+  Returns the part of a shard table name for a value of a shard column. Characters that are not valid
+  in a table name are replaced with "_", and a short hash of the value is then appended, so values that
+  only differ in those characters ("a-b" and "a b") get different names.
+  """
+  name = re.sub(r"\W", "_", str(value))
+  if value is None or name != str(value):
+    name += "_" + hashlib.sha256(repr(value).encode("utf-8")).hexdigest()[:8]
+  return name
+
+
+def get_client(project: Optional[str] = None) -> bigquery.Client:
+  """
+  Returns the BigQuery client of a project shared by the process, creating it on first use.
+
+  Args:
+    project: project that runs the jobs, the project of the credentials if None
+  """
+  with _clients_lock:
+    if project not in _clients:
+      _clients[project] = bigquery.Client(project=project)
+    return _clients[project]
+
+
+def get_read_client() -> bigquery_storage.BigQueryReadClient:
+  """
+  Returns the BigQuery Storage Read API client shared by the process, creating it on first use.
+  """
+  global _read_client
+  with _clients_lock:
+    if _read_client is None:
+      _read_client = bigquery_storage.BigQueryReadClient()
+    return _read_client
+
+
 class BigqueryHelper:
 
-  def __init__(self, gcp_project_id: str, dataset_name: str, bucket_name: Optional[str] = None, table_name_prefix: Optional[str] = None):
+  def __init__(self, gcp_project_id: str, dataset_name: str, bucket_name: Optional[str] = None, table_name_prefix: Optional[str] = None,
+    dry_run: Optional[bool] = False, compact_dataframes: Optional[bool] = False,
+    executor: Optional[ProcessExecutor] = None, metadata_cache: Optional[TableMetadataCache] = None):
     self.gcp_project_id = gcp_project_id
     self.dataset_name = dataset_name
     self.bucket_name = bucket_name
     self.table_name_prefix = table_name_prefix
+    #In dry run mode statements are only validated and priced by BigQuery, no table is created.
+    #Tables that would have been created are kept as inline queries so later stages can reference them.
+    self.dry_run = dry_run
+    self.dry_run_bytes_per_stage = {}
+    self._dry_run_tables = {}
+    self._dry_run_query_parameters = {}
+    #Downloaded dataframes keep repeated text columns dictionary encoded (pandas categoricals)
+    self.compact_dataframes = compact_dataframes
+    #CPU bound local stages run in this executor, by default inline in the calling thread
+    self.executor = executor or ProcessExecutor(max_workers=0)
+    #Table metadata is cached, tables written through this helper are invalidated
+    self.metadata_cache = metadata_cache or _metadata_cache
+    #Tables of the current run expire this many hours after they are written, see set_run
+    self.run_id = None
+    self.run_table_expiration_hours = None
 
   def _get_full_table_name(self, table_name:str) -> str:
     """Generates a full table name by concatenating prefix, project, dataset, and table.
@@ -58,6 +259,109 @@ class BigqueryHelper:
         table_name
       )
 
+  def set_run(self, run_id: str, expiration_hours: float) -> None:
+    """Sets the run whose tables are written through this helper.
+
+    Tables whose name ends with the run id get an expiration as soon as they are written, so
+    BigQuery deletes them even if the run never finishes.
+
+    Args:
+      run_id: Id of the run, the suffix of the names of its tables.
+      expiration_hours: Hours from each write until the table expires.
+    """
+    self.run_id = run_id
+    self.run_table_expiration_hours = expiration_hours
+
+  def _table_written(self, full_table_name: str) -> None:
+    """Invalidates the cached metadata of a table that was written, and sets its expiration if
+    it belongs to the current run.
+
+    Args:
+      full_table_name: Full name of the table.
+    """
+    self.metadata_cache.invalidate(full_table_name)
+    if self.dry_run or not self.run_id or not full_table_name.endswith("_" + self.run_id):
+      return
+    client = get_client(self.gcp_project_id)
+    table = bigquery.Table(full_table_name)
+    table.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=self.run_table_expiration_hours)
+    client.update_table(table, ["expires"])
+
+  def _get_table_reference(self, table_name:str) -> str:
+    """Returns the expression to use for a table in a FROM clause.
+
+    In dry run mode, tables that were not really created are replaced by the
+    query that would have created them, so their cost is still estimated.
+
+    Args:
+      table_name: The name of the table.
+
+    Returns:
+      Quoted full table name or a subquery.
+    """
+    full_table_name = self._get_full_table_name(table_name)
+    if full_table_name in self._dry_run_tables:
+      return "(" + self._dry_run_tables[full_table_name] + ")"
+    return "`" + full_table_name + "`"
+
+  def _register_dry_run_table(self, table_name:str, select_statement: str, query_parameters: Optional[list] = None) -> None:
+    """Stores the query that would have created a table during a dry run.
+
+    Args:
+      table_name: The name of the table that was not created.
+      select_statement: SELECT statement with the contents of the table.
+      query_parameters: Query parameters used by the select statement.
+    """
+    self._dry_run_tables[self._get_full_table_name(table_name)] = select_statement
+    for parameter in query_parameters or []:
+      self._dry_run_query_parameters[parameter.name] = parameter
+
+  def _run_query(self, statement: str, stage: str, job_config: Optional[bigquery.QueryJobConfig] = None,
+    page_size: Optional[int] = None):
+    """Runs a statement in BigQuery, or only estimates its cost in dry run mode.
+
+    Args:
+      statement: The SQL statement to run.
+      stage: Name of the pipeline stage the statement belongs to, used for the cost report.
+      job_config: Optional configuration for the query job.
+      page_size: Optional amount of rows per page when iterating the results.
+
+    Returns:
+      The job results, or None in dry run mode.
+    """
+    client = get_client(self.gcp_project_id)
+    if job_config is None:
+      job_config = bigquery.QueryJobConfig()
+    if self.dry_run:
+      job_config.dry_run = True
+      job_config.use_query_cache = False
+      #Inlined tables may carry query parameters from the statement that would have created them
+      query_parameters = {parameter.name: parameter for parameter in job_config.query_parameters}
+      for name, parameter in self._dry_run_query_parameters.items():
+        if "@" + name in statement and name not in query_parameters:
+          query_parameters[name] = parameter
+      job_config.query_parameters = list(query_parameters.values())
+      query_job = client.query(statement, job_config=job_config)
+      bytes_processed = query_job.total_bytes_processed or 0
+      self.dry_run_bytes_per_stage[stage] = self.dry_run_bytes_per_stage.get(stage, 0) + bytes_processed
+      print("Dry run of stage {} would process {} bytes".format(stage, bytes_processed))
+      return None
+    query_job = client.query(statement, job_config=job_config)
+    return query_job.result(page_size=page_size)
+
+  def get_dry_run_report(self) -> dict:
+    """Returns the bytes that would be processed per stage and for the whole run.
+
+    Returns:
+      Dictionary with the bytes per stage and the total bytes.
+    """
+    total_bytes = sum(self.dry_run_bytes_per_stage.values())
+    return {
+      "stages": dict(self.dry_run_bytes_per_stage),
+      "total_bytes_processed": total_bytes,
+      "total_gb_processed": round(float(total_bytes) / (1024 ** 3), 3)
+    }
+
 
   def upload_dataframe_to_big_query(self,condensed_dataframe:pd.core.frame.DataFrame,write_disposition:str, final_joined_table_name:str):
     """
@@ -68,36 +372,78 @@ class BigqueryHelper:
       write_disposition -> OVERWRITE or APPEND
       final_joined_table_name -> Name of the table in the destination big query
     """
+    if self.dry_run:
+      print("Dry run: skipping upload to {}".format(final_joined_table_name))
+      return
     #Configure Load Job to send dataframe to BQ
     job_config = bigquery.LoadJobConfig(write_disposition=write_disposition)
     table_name = self._get_full_table_name(final_joined_table_name)
-    bqclient = bigquery.Client()
-    job = bqclient.load_table_from_dataframe(condensed_dataframe, table_name, job_config=job_config)  # Make an API request.
+    bqclient = get_client()
+    if any(isinstance(dtype, pd.CategoricalDtype) for dtype in condensed_dataframe.dtypes):
+      #Categorical columns are written as dictionary encoded parquet, so they are never expanded to strings
+      parquet_file = io.BytesIO()
+      condensed_dataframe.to_parquet(parquet_file, index=False)
+      parquet_file.seek(0)
+      job_config.source_format = bigquery.SourceFormat.PARQUET
+      job = bqclient.load_table_from_file(parquet_file, table_name, job_config=job_config)  # Make an API request.
+    else:
+      job = bqclient.load_table_from_dataframe(condensed_dataframe, table_name, job_config=job_config)  # Make an API request.
     job.result()  # Wait for the job to complete.
-    table = bqclient.get_table(table_name)  # Make an API request.
+    self._table_written(table_name)
 
     print(
       "Loaded {} rows and {} columns to {}".format(
-        table.num_rows, len(table.schema), table_name
+        job.output_rows, len(condensed_dataframe.columns), table_name
       )
     )
     return
 
-  def create_table(self, table_name:str, columns: list, update_if_exist: Optional[bool] = True) -> None:
+  def upload_parquet_file_to_big_query(self, parquet_file_path: str, write_disposition: str, table_name: str) -> None:
+    """
+    Loads a local parquet file to a big query table in a single load job
+
+    params:
+      parquet_file_path -> path of the parquet file
+      write_disposition -> WRITE_TRUNCATE or WRITE_APPEND
+      table_name -> Name of the table in the destination big query
+    """
+    if self.dry_run:
+      print("Dry run: skipping upload to {}".format(table_name))
+      return
+    job_config = bigquery.LoadJobConfig(write_disposition=write_disposition, source_format=bigquery.SourceFormat.PARQUET)
+    full_table_name = self._get_full_table_name(table_name)
+    bqclient = get_client(self.gcp_project_id)
+    with open(parquet_file_path, "rb") as parquet_file:
+      job = bqclient.load_table_from_file(parquet_file, full_table_name, job_config=job_config)  # Make an API request.
+    job.result()  # Wait for the job to complete.
+    self._table_written(full_table_name)
+    print("Loaded {} rows to {}".format(job.output_rows, full_table_name))
+
+  def create_table(self, table_name:str, columns: list, update_if_exist: Optional[bool] = True,
+    mode: Optional[str] = "REQUIRED", partition_expiration_days: Optional[int] = None) -> None:
     """Creates a new table with the columns provided.
 
     Args:
       table_name: The name of the table to create.
       columns: A list of strings with column names.
+      update_if_exist: If False, an existing table is deleted and created again empty.
+      mode: Mode of the STRING columns, REQUIRED or NULLABLE.
+      partition_expiration_days: If set, the table is partitioned by ingestion day and its
+        partitions are deleted after this many days.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
+    if self.dry_run:
+      return
+    client = get_client(self.gcp_project_id)
     new_table_schema = []
 
     for column in columns:
-      new_table_schema.append(bigquery.SchemaField(column, "STRING", mode="REQUIRED"))
+      new_table_schema.append(bigquery.SchemaField(column, "STRING", mode=mode))
 
     full_table_name = self._get_full_table_name(table_name)
     table = bigquery.Table(full_table_name, schema=new_table_schema)
+    if partition_expiration_days:
+      table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+        expiration_ms=int(partition_expiration_days * 24 * 3600 * 1000))
 
     try:
       table = client.create_table(table)
@@ -107,26 +453,40 @@ class BigqueryHelper:
       else:
         client.delete_table(table)
         table = client.create_table(table)
+    self._table_written(full_table_name)
 
   def insert_single_record(self, table_name:str, data: dict) -> None:
     """Inserts data into the table.
 
     Data dictionary must have keys named the same as the table's columns.
+    The record is sent as data in a load job, to insert more than a few records
+    use get_batch_writer instead, which sends them all in a single job.
 
     Args:
       table_name: The name of the table to create.
       data: Dict where keys are column names and values are data to insert.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
+    with self.get_batch_writer(table_name) as writer:
+      writer.append(data)
 
-    full_table_name = self._get_full_table_name(table_name)
+  def get_batch_writer(self, table_name: str, schema: Optional[list] = None,
+    max_rows: Optional[int] = BATCH_WRITER_MAX_ROWS, max_bytes: Optional[int] = BATCH_WRITER_MAX_BYTES,
+    max_seconds: Optional[float] = BATCH_WRITER_MAX_SECONDS) -> "BigqueryBatchWriter":
+    """Returns a buffered writer that appends records to a table with load jobs.
 
-    column_names = ', '.join(data.keys())
-    values = '", "'.join(data.values())
-    dml_statement = "INSERT `%s` ( %s ) VALUES ( \"%s\" )" % (full_table_name, column_names, values)
+    Usage:
+      with bq.get_batch_writer("productsFromMC") as writer:
+        for record in records:
+          writer.append(record)
 
-    query_job = client.query(dml_statement)
-    query_job.result()
+    Args:
+      table_name: The name of the table to append the records to.
+      schema: Optional list of bigquery.SchemaField, by default the schema of the existing table is used.
+      max_rows: Amount of buffered rows that triggers a flush.
+      max_bytes: Approximate size in bytes of the buffered rows that triggers a flush.
+      max_seconds: Seconds since the oldest buffered row that trigger a flush on the next append.
+    """
+    return BigqueryBatchWriter(self, table_name, schema, max_rows, max_bytes, max_seconds)
 
   def insert_multiple_records(self, table_name: str, data: list, header: list) -> None:
     """
@@ -139,6 +499,13 @@ class BigqueryHelper:
 
     """
     df = pd.DataFrame(data = data, columns = header)
+    if self.dry_run:
+      #Load jobs can't be dry run, keep the rows as literals for the statements that use this table
+      rows = ", ".join(
+        "STRUCT(" + ", ".join(json.dumps(str(value)) + " AS " + column for value, column in zip(row, header)) + ")"
+        for row in df.itertuples(index=False))
+      self._register_dry_run_table(table_name, "SELECT * FROM UNNEST([" + rows + "])")
+      return
     job_config = bigquery.LoadJobConfig(
       # Optionally, set the write disposition. BigQuery appends loaded rows
       # to an existing table by default, but with WRITE_TRUNCATE write
@@ -148,16 +515,16 @@ class BigqueryHelper:
 
     enriched_table_name = self._get_full_table_name(table_name)
 
-    bqclient = bigquery.Client()
+    bqclient = get_client()
     job = bqclient.load_table_from_dataframe(
       df, enriched_table_name, job_config = job_config
     )  # Make an API request.
     job.result()  # Wait for the job to complete.
+    self._table_written(enriched_table_name)
 
-    table = bqclient.get_table(enriched_table_name)  # Make an API request.
     print(
       "Loaded {} rows and {} columns to {}".format(
-        table.num_rows, len(table.schema), enriched_table_name
+        job.output_rows, len(header), enriched_table_name
       )
     )
 
@@ -170,9 +537,29 @@ class BigqueryHelper:
     Args:
       table_name: The name of the table to delete.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
+    client = get_client(self.gcp_project_id)
     full_table_name = self._get_full_table_name(table_name)
     table = client.delete_table(full_table_name)
+    self.metadata_cache.invalidate(full_table_name)
+
+  def copy_table(self, source_table_name: str, destination_table_name: str) -> None:
+    """Replaces a table with a copy of another one in a single copy job.
+
+    The destination is swapped atomically, readers see either its previous contents or the copy.
+
+    Args:
+      source_table_name: The name of the table to copy.
+      destination_table_name: The name of the table to replace.
+    """
+    if self.dry_run:
+      return
+    client = get_client(self.gcp_project_id)
+    job_config = bigquery.CopyJobConfig(write_disposition="WRITE_TRUNCATE")
+    client.copy_table(
+      self._get_full_table_name(source_table_name),
+      self._get_full_table_name(destination_table_name),
+      job_config=job_config).result()
+    self._table_written(self._get_full_table_name(destination_table_name))
 
   def create_new_table_from_cross_join(
           self,
@@ -187,25 +574,73 @@ class BigqueryHelper:
     if len(tables) == 0:
       logging.getLogger().info('There are not tables to cross join')
       return
-    client = bigquery.Client(project=self.gcp_project_id)
     # Build cross join statements
     cross_join = ""
     for table in tables[1:]:  # skip first table since it goes in the select
-      full_table_name = self._get_full_table_name(table)
-      cross_join += f"CROSS JOIN `{full_table_name}` \n"
+      cross_join += f"CROSS JOIN {self._get_table_reference(table)} \n"
     dml_statement = f"""
       SELECT *
-      FROM `{self._get_full_table_name(tables[0])}`
+      FROM {self._get_table_reference(tables[0])}
       {cross_join}
     """
     full_table_name_destination = self._get_full_table_name(destination_table)
     job_config = bigquery.QueryJobConfig(destination=full_table_name_destination)
     job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
-    query_job = client.query(dml_statement, job_config=job_config)
-    query_job.result()
+    self._run_query(dml_statement, stage="cross_join", job_config=job_config)
+    self._table_written(full_table_name_destination)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table, dml_statement)
+
+  def compile_options_cross_join(self, options: dict) -> tuple:
+    """Compiles the option values to the UNNEST clauses and array query parameters that expand a table.
+
+    Args:
+      options: Dict where keys are the new column names and values the list of values of each column.
+
+    Returns:
+      Tuple with the cross join clauses and the list of query parameters they reference.
+    """
+    cross_join = ""
+    query_parameters = []
+    for index, (column, values) in enumerate(options.items()):
+      parameter_name = "option_" + str(index)
+      cross_join += f"CROSS JOIN UNNEST(@{parameter_name}) AS `{column}` \n"
+      query_parameters.append(bigquery.ArrayQueryParameter(parameter_name, "STRING", [str(value) for value in values]))
+    return cross_join, query_parameters
+
+  def create_new_table_from_options_cross_join(
+          self,
+          source_table: str,
+          destination_table: str,
+          options: Optional[dict] = None,
+          compiled_options: Optional[tuple] = None) -> None:
+    """Creates a new table with every row of a table repeated for each combination of option values.
+
+    Option values are sent as array query parameters and expanded with UNNEST in a single query,
+    so no table is created for them.
+
+    Args:
+      source_table: The table to expand.
+      destination_table: Table where the result will be written.
+      options: Dict where keys are the new column names and values the list of values of each column.
+      compiled_options: Result of compile_options_cross_join, used instead of options when given.
+    """
+    cross_join, query_parameters = compiled_options or self.compile_options_cross_join(options)
+    dml_statement = f"""
+      SELECT *
+      FROM {self._get_table_reference(source_table)}
+      {cross_join}
+    """
+    full_table_name_destination = self._get_full_table_name(destination_table)
+    job_config = bigquery.QueryJobConfig(destination=full_table_name_destination, query_parameters=query_parameters)
+    job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    self._run_query(dml_statement, stage="cross_join", job_config=job_config)
+    self._table_written(full_table_name_destination)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table, dml_statement, query_parameters)
 
   def read_from_table(self, table_name:str, select: Optional[str] = '*', limit: Optional[int] = None,
-    offset: Optional[int] = None, where: Optional[str] = None) -> list:
+    offset: Optional[int] = None, where: Optional[str] = None, query_parameters: Optional[list] = None) -> list:
     """Retrieve results from BigQuery table.
 
     Args:
@@ -214,16 +649,14 @@ class BigqueryHelper:
       where: The where conditions on the query.
       limit: The maximum number of results to return.
       offset: Offset on the query.
+      query_parameters: List of bigquery query parameters referenced in the where condition.
 
     Returns:
       List with table data.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
-    full_table_name = self._get_full_table_name(table_name)
-
     dml_statement = (f"""
       SELECT {select}
-      FROM `{full_table_name}`
+      FROM {self._get_table_reference(table_name)}
       """)
     if where:
       dml_statement += f" WHERE {where}"
@@ -232,35 +665,142 @@ class BigqueryHelper:
     if offset:
       dml_statement += f" OFFSET {offset}"
 
-    query_job = client.query(dml_statement)
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    rows = self._run_query(dml_statement, stage="read_from_table", job_config=job_config)
     result = []
-    for row in query_job.result():
+    for row in rows or []:
       result.append(row)
     return result
 
+  def iterate_table(self, table_name: str, select: Optional[str] = '*', where: Optional[str] = None,
+    page_size: Optional[int] = READ_PAGE_SIZE, output: Optional[str] = "rows"):
+    """Yields the contents of a BigQuery table without collecting them in memory.
+
+    The query result is downloaded one page at a time, so only one page is kept in memory.
+
+    Args:
+      table_name: The name of the table to query.
+      select: The list of fields to retrieve.
+      where: The where conditions on the query.
+      page_size: The amount of rows per page.
+      output: "rows" yields bigquery Row objects, "arrow" yields pyarrow RecordBatches and
+        "dataframe" yields pandas dataframes, one per page.
+
+    Returns:
+      Generator with the rows or chunks of the table.
+    """
+    dml_statement = (f"""
+      SELECT {select}
+      FROM {self._get_table_reference(table_name)}
+      """)
+    if where:
+      dml_statement += f" WHERE {where}"
+
+    rows = self._run_query(dml_statement, stage="iterate_table", page_size=page_size)
+    if rows is None:
+      return
+    if output == "arrow":
+      yield from rows.to_arrow_iterable()
+    elif output == "dataframe":
+      yield from rows.to_dataframe_iterable()
+    else:
+      for page in rows.pages:
+        yield from page
+
+  def iterate_table_by_keyset(self, table_name: str, order_by: str, select: Optional[str] = '*',
+    where: Optional[str] = None, page_size: Optional[int] = READ_PAGE_SIZE):
+    """Yields pages of a BigQuery table using keyset pagination on an ordering column.
+
+    Each page is a separate query that continues after the last key of the previous page,
+    so a page can be requested later without rescanning the rows before it as OFFSET does.
+    The ordering column must be unique and not null, and must be included in select.
+
+    Args:
+      table_name: The name of the table to query.
+      order_by: Unique column used to order and continue the pages.
+      select: The list of fields to retrieve.
+      where: The where conditions on the query.
+      page_size: The amount of rows per page.
+
+    Returns:
+      Generator with one list of rows per page.
+    """
+    last_key = None
+    while True:
+      conditions = [f"({where})"] if where else []
+      query_parameters = []
+      if last_key is not None:
+        conditions.append(f"{order_by} > @last_key")
+        query_parameters.append(self._get_query_parameter("last_key", last_key))
+      dml_statement = (f"""
+        SELECT {select}
+        FROM {self._get_table_reference(table_name)}
+        """)
+      if conditions:
+        dml_statement += " WHERE " + " AND ".join(conditions)
+      dml_statement += f" ORDER BY {order_by} LIMIT {page_size}"
+
+      job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+      rows = self._run_query(dml_statement, stage="iterate_table_by_keyset", job_config=job_config)
+      page = list(rows or [])
+      if not page:
+        return
+      yield page
+      if len(page) < page_size:
+        return
+      last_key = page[-1][order_by]
+
+  def _get_query_parameter(self, name: str, value) -> bigquery.ScalarQueryParameter:
+    """Returns a typed query parameter for a python value.
+
+    Args:
+      name: The name of the parameter.
+      value: The value of the parameter.
+    """
+    if isinstance(value, bool):
+      parameter_type = "BOOL"
+    elif isinstance(value, int):
+      parameter_type = "INT64"
+    elif isinstance(value, float):
+      parameter_type = "FLOAT64"
+    elif isinstance(value, decimal.Decimal):
+      fits_numeric = value.is_finite() and abs(value) < NUMERIC_MAX_VALUE and -value.as_tuple().exponent <= NUMERIC_MAX_SCALE
+      parameter_type = "NUMERIC" if fits_numeric else "BIGNUMERIC"
+    elif isinstance(value, datetime.datetime):
+      parameter_type = "TIMESTAMP"
+    elif isinstance(value, datetime.date):
+      parameter_type = "DATE"
+    else:
+      parameter_type = "STRING"
+    return bigquery.ScalarQueryParameter(name, parameter_type, value)
+
   def count_table_records(self, table_name:str,
-    where: Optional[str] = None) -> int:
+    where: Optional[str] = None, use_metadata: Optional[bool] = False,
+    query_parameters: Optional[list] = None) -> int:
     """Count records from BigQuery table.
 
     Args:
       table_name: The name of the table to query.
       where: The where conditions on the query.
+      use_metadata: If True and there is no where condition, the count is read from the
+        table metadata instead of a COUNT(*) query. Rows in the streaming buffer are not counted.
+      query_parameters: List of bigquery query parameters referenced in the where condition.
 
     Returns:
       Int, amount of records.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
-    full_table_name = self._get_full_table_name(table_name)
-
+    if use_metadata and not where and not self.dry_run:
+      return self.get_bq_table(table_name).num_rows or 0
     dml_statement = (f"""
       SELECT COUNT(*)
-      FROM `{full_table_name}`
+      FROM {self._get_table_reference(table_name)}
       """)
     if where:
       dml_statement += f" WHERE {where}"
 
-    query_job = client.query(dml_statement)
-    for row in query_job.result():
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    rows = self._run_query(dml_statement, stage="count_table_records", job_config=job_config)
+    for row in rows or []:
       return row[0]
     return 0
 
@@ -272,7 +812,9 @@ class BigqueryHelper:
       table_name: The name of the source table.
       bucket_name: The name of the bucket where the csv file will be uploaded to.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
+    if self.dry_run:
+      return
+    client = get_client(self.gcp_project_id)
     table = client.get_table(self._get_full_table_name(table_name))
     if not self.__exceeds_limit(table.num_bytes):
       csv_file_name = f'{table_name}_extract.csv'
@@ -281,12 +823,9 @@ class BigqueryHelper:
       # The size of the exported files will vary.
       csv_file_name = f'{table_name}_extract_*.csv'
     destination_uri = "gs://{}/{}".format(self.bucket_name, csv_file_name)
-    dataset_ref = bigquery.DatasetReference(
-        self.gcp_project_id, self.dataset_name)
-    table_ref = dataset_ref.table(table_name)
-    # Create job to extract the data
+    # Create job to extract the data, the table name includes the table name prefix
     extract_job = client.extract_table(
-        table_ref,
+        self._get_full_table_name(table_name),
         destination_uri
     )  # API request
     response = extract_job.result() # Waits for job to complete.
@@ -299,12 +838,14 @@ class BigqueryHelper:
       for error in response.errors:
         logging.getLogger().error(f'Error: {error["message"]} - Reason: {error["reason"]}')
 
-  def shard_tables_by_columns(self, source_table_name: str, columns: List[str]) -> List[str]:
+  def shard_tables_by_columns(self, source_table_name: str, columns: List[str],
+    table_suffix: Optional[str] = "") -> List[str]:
     """Shards a source table into different tables based on a list of columns.
 
     Args:
       source_table_name: The name of the table to shard.
       columns: A list of columns to use as sharding criteria.
+      table_suffix: Text appended to the name of every created table.
 
     Returns:
       A list of sharded tables based on the provided columns.
@@ -312,10 +853,11 @@ class BigqueryHelper:
     # Group by each column and generate N tables, one per column
     x_join_table_name_list = []
     for column in columns:
-      gb_destination_table_name = f'temp_values_for_{column}'
+      gb_destination_table_name = f'temp_values_for_{column}' + table_suffix
       x_join_table_name_list.append(gb_destination_table_name)
       self.create_or_replace_table_from_select(
-          source_table_name, gb_destination_table_name, column, None, None, None, column)
+          source_table_name, gb_destination_table_name, column, None, None, None, column,
+          stage="shard_tables_by_columns")
 
     # Cross join the N generated tables
     x_join_destination_table_name = "_".join(x_join_table_name_list)  # TODO check for a valid name
@@ -323,28 +865,49 @@ class BigqueryHelper:
       # To avoid existing table error when creating it
       self.create_new_table_from_cross_join(x_join_table_name_list, x_join_destination_table_name)
 
+    if self.dry_run:
+      #The values of the shards are unknown without running the queries. Every shard statement scans
+      #the same columns of the source, so one of them is estimated, the cost per shard.
+      self.create_or_replace_table_from_select(
+          source_table_name, "_".join(columns) + "_shard" + table_suffix, '*', None, None,
+          " AND ".join(f"{column} IS NOT NULL" for column in columns), None, stage="shard_tables_by_columns_per_shard")
+      return []
+
     # Loop through each row in the cross join table and generate a table per combination
-    rows = self.read_from_table(x_join_destination_table_name)
+    # with the rows of the source table that have those values
+    rows = self.iterate_table(x_join_destination_table_name)
     final_table_names = []
+    shard_values = {}
     for row in rows:
       table_names = []
       where_conditions = []
+      query_parameters = []
       for idx, col in enumerate(row):
-        where_conditions.append(f"{columns[idx]}='{col}'")
+        if col is None:
+          where_conditions.append(f"{columns[idx]} IS NULL")
+        else:
+          where_conditions.append(f"{columns[idx]} = @shard_{idx}")
+          query_parameters.append(self._get_query_parameter(f"shard_{idx}", col))
         table_names.append(columns[idx])
-        table_names.append(col)
+        table_names.append(_get_shard_name(col))
       where_clause = " AND ".join(where_conditions)
-      final_table_name = "_".join(table_names)  # TODO check for a valid name
+      final_table_name = "_".join(table_names) + table_suffix
+      if final_table_name in shard_values:
+        raise ValueError(f"Shards {shard_values[final_table_name]} and {tuple(row)} have the same table name {final_table_name}")
+      shard_values[final_table_name] = tuple(row)
       final_table_names.append(final_table_name)
       self.create_or_replace_table_from_select(
-          x_join_destination_table_name, final_table_name, '*', None, None, where_clause, None)
+          source_table_name, final_table_name, '*', None, None, where_clause, None,
+          stage="shard_tables_by_columns", query_parameters=query_parameters)
 
     return final_table_names
 
 
   def create_or_replace_table_from_select(self, source_table_name: str, destination_table_name: str,
     fields: Optional[str] = None, limit: Optional[int] = None, offset: Optional[int] = None,
-    where: Optional[str] = None, group_by: Optional[str] = None) -> None:
+    where: Optional[str] = None, group_by: Optional[str] = None,
+    stage: Optional[str] = "create_or_replace_table_from_select",
+    query_parameters: Optional[list] = None) -> None:
     """ Creates or replaces a table with data from a select statement
 
     Args:
@@ -355,27 +918,184 @@ class BigqueryHelper:
       offset: Offset on the query.
       where: The where conditions on the query.
       group_by: Columns to group by the data.
+      stage: Name of the pipeline stage, used for the dry run cost report.
+      query_parameters: List of bigquery query parameters referenced in the where condition.
     """
-    client = bigquery.Client(project=self.gcp_project_id)
-    full_source_table_name = self._get_full_table_name(source_table_name)
     full_destination_table_name = self._get_full_table_name(destination_table_name)
-    dml_statement = (f"""
-      CREATE OR REPLACE TABLE {full_destination_table_name}
-      AS
+    select_statement = (f"""
       SELECT {fields}
-      FROM `{full_source_table_name}`
+      FROM {self._get_table_reference(source_table_name)}
       """)
     if where:
-      dml_statement += f" WHERE {where}"
+      select_statement += f" WHERE {where}"
     if group_by:
-      dml_statement += f" GROUP BY {group_by}"
+      select_statement += f" GROUP BY {group_by}"
     if limit:
-      dml_statement += f" LIMIT {limit}"
+      select_statement += f" LIMIT {limit}"
     if offset:
-      dml_statement += f" OFFSET {offset}"
+      select_statement += f" OFFSET {offset}"
+    dml_statement = (f"""
+      CREATE OR REPLACE TABLE `{full_destination_table_name}`
+      AS
+      """) + select_statement
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    self._run_query(dml_statement, stage=stage, job_config=job_config)
+    self._table_written(full_destination_table_name)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table_name, select_statement, query_parameters)
+
+  def merge_into_table_from_select(self, source_table_name: str, destination_table_name: str,
+    columns: List[str], key: str, stage: Optional[str] = "merge_into_table_from_select") -> None:
+    """Adds the rows of a table whose key is not yet in another table, creating it if it doesn't exist.
+
+    Rows already in the destination are kept, so the table accumulates the rows of every run. The
+    columns may change between runs: new columns are added to the destination, rows are inserted by
+    column name and columns that are not copied anymore are left NULL.
+
+    Args:
+      source_table_name: The name of the table to get the data from.
+      destination_table_name: The table the new rows are added to.
+      columns: Columns to copy, key must be one of them.
+      key: Column that identifies a row.
+      stage: Name of the pipeline stage, used for the dry run cost report.
+    """
+    full_destination_table_name = self._get_full_table_name(destination_table_name)
+    fields = ", ".join(f"`{column}`" for column in columns)
+    select_statement = f"SELECT {fields} FROM {self._get_table_reference(source_table_name)}"
+    create_statement = f"CREATE TABLE IF NOT EXISTS `{full_destination_table_name}` AS {select_statement} WHERE FALSE"
+    merge_statement = f"""
+      MERGE `{full_destination_table_name}` AS target
+      USING (SELECT DISTINCT {fields} FROM ({select_statement})) AS source
+      ON target.`{key}` = source.`{key}`
+      WHEN NOT MATCHED THEN INSERT ({fields}) VALUES ({", ".join(f"source.`{column}`" for column in columns)})
+    """
+    self._run_query(create_statement, stage=stage)
+    if self.dry_run:
+      #The destination may not exist yet, only the read of the new rows is estimated
+      self._run_query(select_statement, stage=stage)
+      return
+    self._add_missing_columns(source_table_name, full_destination_table_name, columns)
+    self._run_query(merge_statement, stage=stage)
+    self._table_written(full_destination_table_name)
+
+  def _add_missing_columns(self, source_table_name: str, full_destination_table_name: str, columns: List[str]) -> None:
+    """Adds to a table the columns of the source table it doesn't have yet, as NULLABLE columns.
+
+    Args:
+      source_table_name: The table the columns are copied from.
+      full_destination_table_name: Full name of the table that receives the columns.
+      columns: Columns that must be in the destination.
+    """
+    client = get_client(self.gcp_project_id)
+    #Read without the cache, the table may have been created or changed by another run
+    destination = client.get_table(full_destination_table_name)
+    existing_columns = {field.name for field in destination.schema}
+    source_fields = {field.name: field for field in self.get_bq_table(source_table_name).schema}
+    missing_fields = [bigquery.SchemaField(column, source_fields[column].field_type, mode="NULLABLE")
+      for column in columns if column not in existing_columns]
+    if not missing_fields:
+      return
+    destination.schema = list(destination.schema) + missing_fields
+    client.update_table(destination, ["schema"])
+    self.metadata_cache.invalidate(full_destination_table_name)
+    print("Added columns {} to {}".format(", ".join(field.name for field in missing_fields), full_destination_table_name))
+
+  def create_partitioned_table_from_select(self, source_table_name: str, destination_table_name: str,
+    fields: str, partition_field: str, where: Optional[str] = None,
+    cluster_fields: Optional[List[str]] = None, labels: Optional[dict] = None,
+    partition_expiration_days: Optional[int] = None,
+    stage: Optional[str] = "create_partitioned_table_from_select",
+    query_parameters: Optional[list] = None) -> None:
+    """Creates or replaces a table partitioned by day and clustered, with data from a select statement.
+
+    Args:
+      source_table_name: The name of the table to get the data from.
+      destination_table_name: The new partitioned table.
+      fields: The comma separated fields to select, partition_field must be one of them.
+      partition_field: TIMESTAMP column the table is partitioned by, one partition per day.
+      where: The where conditions on the query.
+      cluster_fields: Up to 4 columns the partitions are clustered by.
+      labels: Dictionary with the labels of the table.
+      partition_expiration_days: Days partitions are kept, forever if None.
+      stage: Name of the pipeline stage, used for the dry run cost report.
+      query_parameters: List of bigquery query parameters referenced in the fields or where condition.
+    """
+    full_destination_table_name = self._get_full_table_name(destination_table_name)
+    select_statement = (f"""
+      SELECT {fields}
+      FROM {self._get_table_reference(source_table_name)}
+      """)
+    if where:
+      select_statement += f" WHERE {where}"
+    options = []
+    if partition_expiration_days:
+      options.append(f"partition_expiration_days = {int(partition_expiration_days)}")
+    if labels:
+      options.append("labels = [" + ", ".join(f'("{key}", "{value}")' for key, value in labels.items()) + "]")
+    dml_statement = f"""
+      CREATE OR REPLACE TABLE `{full_destination_table_name}`
+      PARTITION BY DATE(`{partition_field}`)
+      """
+    if cluster_fields:
+      dml_statement += "CLUSTER BY " + ", ".join(f"`{field}`" for field in cluster_fields[:4]) + "\n"
+    if options:
+      dml_statement += "OPTIONS (" + ", ".join(options) + ")\n"
+    dml_statement += "AS " + select_statement
+
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+    self._run_query(dml_statement, stage=stage, job_config=job_config)
+    self._table_written(full_destination_table_name)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table_name, select_statement, query_parameters)
+
+  def replace_partition_from_select(self, source_table_name: str, destination_table_name: str,
+    partition_id: str, fields: str, where: Optional[str] = None,
+    stage: Optional[str] = "replace_partition_from_select",
+    query_parameters: Optional[list] = None) -> None:
+    """Replaces a single partition of a table with data from a select statement.
+
+    The query writes to the partition decorator with WRITE_TRUNCATE, so the partition is swapped
+    atomically and the other partitions are not read nor modified. Running it again is harmless.
+
+    Args:
+      source_table_name: The name of the table to get the data from.
+      destination_table_name: The partitioned table, which must exist.
+      partition_id: Id of the partition to replace (e.g. 20230131), every selected row must belong to it.
+      fields: The comma separated fields to select, in the order of the destination columns.
+      where: The where conditions on the query.
+      stage: Name of the pipeline stage, used for the dry run cost report.
+      query_parameters: List of bigquery query parameters referenced in the fields or where condition.
+    """
+    full_destination_table_name = self._get_full_table_name(destination_table_name)
+    select_statement = (f"""
+      SELECT {fields}
+      FROM {self._get_table_reference(source_table_name)}
+      """)
+    if where:
+      select_statement += f" WHERE {where}"
+    job_config = bigquery.QueryJobConfig(
+      destination=full_destination_table_name + "$" + partition_id,
+      query_parameters=query_parameters or [],
+      write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    self._run_query(select_statement, stage=stage, job_config=job_config)
+    self._table_written(full_destination_table_name)
 
-    query_job = client.query(dml_statement)
-    query_job.result()
+  def set_table_labels(self, table_name: str, labels: dict) -> None:
+    """Adds or replaces labels of a table, the other labels are kept.
+
+    Args:
+      table_name: The name of the table.
+      labels: Dictionary with the label names and values.
+    """
+    if self.dry_run:
+      return
+    client = get_client(self.gcp_project_id)
+    full_table_name = self._get_full_table_name(table_name)
+    table = client.get_table(full_table_name)
+    table.labels = dict(table.labels or {}, **labels)
+    client.update_table(table, ["labels"])
+    self.metadata_cache.invalidate(full_table_name)
 
   def flatten_list(self,_2d_list: list) -> list:
     """
@@ -416,39 +1136,101 @@ class BigqueryHelper:
     """
 
     original_table=self.get_big_query_table_as_df(source_table_name)
-    sample_row_len=0
-    condensed_array=[]
-    while len(original_table) >= amount_of_rows_to_condense:
-      condensed_row=[]
-      for i in range(amount_of_rows_to_condense):
-        #sacamos random sample y borramos del dataframe
-        random_sample=original_table.sample()
-        sample_index=random_sample.index[0]
-        original_table = original_table.drop(sample_index)
-        random_sample_row=None
-        for index,row in random_sample.iterrows():
-          random_sample_row=row
-          if sample_row_len==0:
-            sample_row_len=len(random_sample_row)
-        for element in random_sample_row:
-          condensed_row.append(element)
-      condensed_array.append(self.flatten_list(condensed_row))
-    final_columns=columns*amount_of_rows_to_condense
-    temp=[]
-    index_col=1
-    index_ctl=0
-    for col in final_columns:
-      temp.append(col+"_"+str(index_col))
-      index_ctl+=1
-      if index_ctl==sample_row_len:
-        index_col+=1
-        index_ctl=0
-    final_columns=temp
-    df = pd.DataFrame(condensed_array, columns = final_columns)
+    if self.dry_run:
+      #There is no data to condense in a dry run, later stages see a table with the condensed columns
+      self._register_dry_run_condensed_table(source_table_name, destination_table_name, amount_of_rows_to_condense, columns)
+      return
+    #Shuffle once, then every chunk is condensed in parallel taking consecutive slices for each slot,
+    #which links products randomly without converting rows to python objects
+    original_table=original_table.sample(frac=1).reset_index(drop=True)
+    condensed_chunks=self.executor.map_dataframe(condense_dataframe, original_table, amount_of_rows_to_condense, columns,
+      chunk_multiple=amount_of_rows_to_condense)
+    df = pd.concat(condensed_chunks, ignore_index=True)
     self.upload_dataframe_to_big_query(df,"WRITE_TRUNCATE", destination_table_name)
     return
 
 
+  def _register_dry_run_condensed_table(self, source_table_name: str, destination_table_name: str,
+    amount_of_rows_to_condense: int, columns: List[str]) -> None:
+    """Stands in for a table condensed locally during a dry run, with the same columns and about the
+    same size: BigQuery bills every referenced column once, so reading it costs about the same as
+    reading the source. The statements that read it can then be estimated.
+    """
+    renamed = [column for slot in range(1, amount_of_rows_to_condense + 1) for column in self._rename_columns(slot, columns)]
+    self._register_dry_run_table(destination_table_name,
+      "SELECT " + ", ".join(renamed) + " FROM " + self._get_table_reference(source_table_name))
+
+  def condense_rows_by_group_in_bigquery(self, source_table_name: str, destination_table_name: str,
+    amount_of_rows_to_condense: int, columns: List[str], group_by: str, order_by: Optional[str] = None,
+    descending: Optional[bool] = False, leftover_policy: Optional[str] = "pad") -> None:
+    """Creates a table that condenses rows of the same group into a single one, in a single query.
+
+    Rows are numbered inside each group with window functions, ordered by order_by or randomly,
+    every amount_of_rows_to_condense consecutive rows form a bundle, and each bundle is pivoted
+    into one row with a column per slot, named as in condense_rows_from_table_in_bigquery.
+    The pivot picks the value of each slot with ANY_VALUE, so columns of any type can be condensed.
+
+    Args:
+      source_table_name: The name of the table to get the data from.
+      destination_table_name: The new table created with the condensed rows.
+      amount_of_rows_to_condense: The amount of rows that will become a single row.
+      columns: List of columns in the source table.
+      group_by: Column with the group of each row, only rows of the same group are condensed together.
+      order_by: Column that orders the rows inside each group, random if None.
+      descending: If True order_by is descending.
+      leftover_policy: What to do with the last bundle of a group when it is incomplete,
+        one of CONDENSE_LEFTOVER_POLICIES.
+    """
+    if leftover_policy not in CONDENSE_LEFTOVER_POLICIES:
+      raise ValueError("Unknown leftover policy: " + str(leftover_policy))
+    for column in [group_by, order_by]:
+      if column and column not in columns:
+        raise ValueError("Column {} is not in the condensed columns".format(column))
+    slots = amount_of_rows_to_condense
+    order = (order_by + (" DESC" if descending else " ASC")) if order_by else "RAND()"
+    numbered = f"""
+        SELECT *,
+          ROW_NUMBER() OVER (PARTITION BY TO_JSON_STRING({group_by}) ORDER BY {order}) - 1 AS condense_position,
+          COUNT(*) OVER (PARTITION BY TO_JSON_STRING({group_by})) AS condense_group_size,
+          TO_JSON_STRING({group_by}) AS condense_group
+        FROM {self._get_table_reference(source_table_name)}
+    """
+    if leftover_policy == "repeat":
+      #Every slot of the last bundle points to a row of its group, repeating from the first one
+      slotted = f"""
+        SELECT numbered.*, bundle AS condense_bundle, slot AS condense_slot
+        FROM (SELECT DISTINCT condense_group, condense_group_size FROM numbered) AS group_sizes
+        CROSS JOIN UNNEST(GENERATE_ARRAY(0, DIV(group_sizes.condense_group_size + {slots - 1}, {slots}) - 1)) AS bundle
+        CROSS JOIN UNNEST(GENERATE_ARRAY(0, {slots - 1})) AS slot
+        JOIN numbered
+        ON numbered.condense_group = group_sizes.condense_group
+        AND numbered.condense_position = MOD(bundle * {slots} + slot, group_sizes.condense_group_size)
+      """
+    else:
+      slotted = f"""
+        SELECT *, DIV(condense_position, {slots}) AS condense_bundle, MOD(condense_position, {slots}) AS condense_slot
+        FROM numbered
+      """
+      if leftover_policy == "drop":
+        slotted += f" WHERE DIV(condense_position, {slots}) < DIV(condense_group_size, {slots})"
+    pivoted_columns = ",\n          ".join(
+      f"ANY_VALUE(IF(condense_slot = {slot}, {column}, NULL)) AS {column}_{slot + 1}"
+      for slot in range(slots) for column in columns)
+    select_statement = f"""
+      WITH numbered AS ({numbered}),
+      slotted AS ({slotted})
+      SELECT
+          {pivoted_columns}
+      FROM slotted
+      GROUP BY condense_group, condense_bundle
+    """
+    full_destination_table_name = self._get_full_table_name(destination_table_name)
+    dml_statement = f"CREATE OR REPLACE TABLE `{full_destination_table_name}` AS " + select_statement
+    self._run_query(dml_statement, stage="condense_rows_by_group_in_bigquery")
+    self._table_written(full_destination_table_name)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table_name, select_statement)
+
   def condense_rows_from_table_in_bigquery(self, source_table_name: str, destination_table_name: str,
     amount_of_rows_to_condense: int, columns: List[str]) -> None:
     """Creates a table that condenses multiple rows into a single one.
@@ -476,20 +1258,17 @@ class BigqueryHelper:
            1       2       3       7       8       9
            4       5       6       10      11      12
     """
-    client = bigquery.Client(project=self.gcp_project_id)
-    total_rows = self.count_table_records(source_table_name)
+    total_rows = self.count_table_records(source_table_name, use_metadata=True)
     new_amount_of_rows = math.ceil(total_rows / amount_of_rows_to_condense)
-    full_source_table_name = self._get_full_table_name(source_table_name)
+    full_source_table_name = self._get_table_reference(source_table_name)
     full_destination_table_name = self._get_full_table_name(destination_table_name)
     group_number = 1
     columns_renamed = ",".join(self._rename_columns(group_number, columns))
-    dml_statement = (f"""
-      CREATE OR REPLACE TABLE `{full_destination_table_name}`
-      AS
+    select_statement = (f"""
       WITH group{group_number} AS (
         SELECT {columns_renamed},
         ROW_NUMBER() OVER(ORDER BY 1 ASC) AS row
-        FROM `{full_source_table_name}`
+        FROM {full_source_table_name}
         ORDER BY row ASC
         LIMIT {new_amount_of_rows} OFFSET 0
       )
@@ -504,11 +1283,11 @@ class BigqueryHelper:
       group_number += 1
       offset = new_amount_of_rows * (group_number - 1)
       columns_renamed = ",".join(self._rename_columns(group_number, columns))
-      dml_statement += f"""
+      select_statement += f"""
         , group{group_number} AS (
           SELECT {columns_renamed},
           ROW_NUMBER() OVER(ORDER BY 1 ASC) - {offset} as row
-          FROM `{full_source_table_name}`
+          FROM {full_source_table_name}
           ORDER BY row ASC
           LIMIT {new_amount_of_rows} OFFSET {offset}
         )
@@ -519,12 +1298,15 @@ class BigqueryHelper:
       """
       # Within the while statement, joins are added to the SQL statement with
       # offsets and limits until all groups are considered.
-    dml_statement += f"""
+    select_statement += f"""
         SELECT * EXCEPT (row)
         FROM group1
       """ + dml_joins
-    query_job = client.query(dml_statement)
-    query_job.result()
+    dml_statement = f"CREATE OR REPLACE TABLE `{full_destination_table_name}` AS " + select_statement
+    self._run_query(dml_statement, stage="condense_rows_from_table_in_bigquery")
+    self._table_written(full_destination_table_name)
+    if self.dry_run:
+      self._register_dry_run_table(destination_table_name, select_statement)
 
   def _rename_columns(self, group_number:int, columns: List[str]):
     """Returns an array of columns with aliases including the group number.
@@ -560,48 +1342,111 @@ class BigqueryHelper:
 
 
 
-  def get_big_query_table_as_df(self,table_name : str) -> pd.core.frame.DataFrame:
+  def get_big_query_table_as_df(self, table_name: str, selected_fields: Optional[List[str]] = None,
+    row_restriction: Optional[str] = None) -> pd.core.frame.DataFrame:
     """
-    Selects all from a specified table (table name) only the name is required, the full table name in cloud will be completed within the function
-    After getting the result it fits it into a pandas dataframe and returns it
+    Reads a specified table (table name) only the name is required, the full table name in cloud will be completed within the function
+    The table is read directly with read_table, without running a query job, and returned as a pandas dataframe
 
     Args:
       string: table name
+      selected_fields: List of columns to read, all of them by default.
+      row_restriction: Filter applied to the rows, see read_table.
 
     Returns
       dataframe with the table contents
     """
+    if self.dry_run:
+      #Direct reads don't run a query, there are no bytes to estimate
+      return pd.DataFrame()
+
+    dataframe = self.read_table(table_name, selected_fields, row_restriction, output="dataframe")
+    if self.compact_dataframes:
+      dataframe = self.compact_dataframe(dataframe)
+    return dataframe
+
+  def read_table(self, table_name: str, selected_fields: Optional[List[str]] = None,
+    row_restriction: Optional[str] = None, output: Optional[str] = "dataframe",
+    max_streams: Optional[int] = STORAGE_READ_MAX_STREAMS):
+    """Reads a table with the BigQuery Storage Read API, without running a query job.
 
-    bqclient = bigquery.Client()
-    full_source_table_name = self._get_full_table_name(table_name)
+    The read session is split by BigQuery in up to max_streams streams, which are downloaded in
+    parallel threads as Arrow data. No temporary result table is created, and only the selected
+    columns of the matching rows are read.
 
-    query_string = "SELECT * FROM "+ full_source_table_name
+    Args:
+      table_name: The name of the table to read.
+      selected_fields: List of columns to read, all of them by default.
+      row_restriction: Filter in SQL syntax, for example "availability = 'in stock'". It can't use
+        query parameters, so values must come from the configuration and not from users.
+      output: "dataframe" returns a pandas dataframe and "arrow" a pyarrow Table.
+      max_streams: Maximum amount of streams read in parallel.
 
-    dataframe = (
-    bqclient.query(query_string)
-    .result()
-    .to_dataframe(
-                 # Optionally, explicitly request to use the BigQuery Storage API. As of
-                 # google-cloud-bigquery version 1.26.0 and above, the BigQuery Storage
-                 # API is used by default.
-                 create_bqstorage_client=True,
-                 )
-                )
+    Returns:
+      Table contents in the requested format.
+    """
+    table = bigquery.TableReference.from_string(self._get_full_table_name(table_name))
+    read_client = get_read_client()
+    requested_session = bigquery_storage.types.ReadSession(
+      table=table.to_bqstorage(),
+      data_format=bigquery_storage.types.DataFormat.ARROW,
+      read_options=bigquery_storage.types.ReadSession.TableReadOptions(
+        selected_fields=selected_fields or [],
+        row_restriction=row_restriction or ""
+      )
+    )
+    session = read_client.create_read_session(
+      parent="projects/" + self.gcp_project_id,
+      read_session=requested_session,
+      max_stream_count=max_streams
+    )
+    if session.streams:
+      with ThreadPoolExecutor(max_workers=len(session.streams)) as executor:
+        stream_tables = list(executor.map(
+          lambda stream: read_client.read_rows(stream.name).to_arrow(session), session.streams))
+      arrow_table = pa.concat_tables(stream_tables)
+    else:
+      #Empty tables have no streams, the schema comes with the session
+      arrow_table = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema)).empty_table()
+    if output == "arrow":
+      return arrow_table
+    return arrow_table.to_pandas(types_mapper=bigquery_types_mapper)
+
+  def compact_dataframe(self, dataframe: pd.core.frame.DataFrame,
+    max_unique_ratio: Optional[float] = COMPACT_MAX_UNIQUE_RATIO) -> pd.core.frame.DataFrame:
+    """
+    Converts repeated text columns into pandas categoricals, which store each distinct value once
+    and a small integer code per row. After the cartesian expansion product fields like title or
+    link are repeated once per option combination, so most of them qualify.
+
+    Args:
+      dataframe: dataframe to compact, converted in place
+      max_unique_ratio: columns with fewer distinct values than this share of rows are converted
+
+    Returns
+      dataframe with the repeated columns as categoricals
+    """
+    compacted_columns = []
+    for column in dataframe.columns:
+      if dataframe[column].dtype != object or len(dataframe) == 0:
+        continue
+      try:
+        distinct_values = dataframe[column].nunique(dropna=False)
+      except TypeError:
+        #Repeated fields come as lists, which can't be dictionary encoded
+        continue
+      if distinct_values <= max_unique_ratio * len(dataframe):
+        dataframe[column] = dataframe[column].astype("category")
+        compacted_columns.append(column)
+    logging.getLogger().info("Columns stored as categoricals: " + ", ".join(compacted_columns))
     return dataframe
 
   def clear_table_google_sheets(self,google_sheet_name:str):
     """
     Clear google sheet to avoid issues
     """
-    credentials, project_id = google.auth.default(
-        scopes=GOOGLE_SHEETS_AUTH_SCOPES
-    )
-    client = gspread.authorize(credentials)
+    get_sheets_client().clear(google_sheet_name, ["A1:AZ100000"])
 
-    spreadsheet=client.open(google_sheet_name)
-    worksheet = spreadsheet.get_worksheet(0)
-    worksheet.batch_clear(["A1:AZ100000"])
-    
 
   def send_table_to_google_sheets(self,table_name:str,output_google_sheet_name:str,share_with: str) -> str:
     """
@@ -623,33 +1468,143 @@ class BigqueryHelper:
     bq_helper.send_table_to_google_sheets("tab-name","example","atomas@google.com")
     """
 
-    #Adhoc function to map the BQ return object to a bidimensional matrix ready for sheets
-    def get_info(row):
-      return list(row)
-    #Authenticate with google sheets
-    
-    credentials, project_id = google.auth.default(
-        scopes=GOOGLE_SHEETS_AUTH_SCOPES
+    #get data from table page by page and write it as csv, the import needs the whole file
+    #pages are converted to csv in the executor while the next ones are downloaded
+    csv_chunks = [
+      self.executor.submit(dataframe_to_csv, chunk, index == 0)
+      for index, chunk in enumerate(self.iterate_table(table_name, output="dataframe"))
+    ]
+    sheets_file="".join(chunk.result() for chunk in csv_chunks)
+    #The shared client rate limits and retries the requests, and creates and shares the sheet when needed
+    return get_sheets_client().export_csv(output_google_sheet_name, sheets_file.encode("utf-8"), share_with)
+
+  def get_latest_partition_id(self, table_name: str) -> Optional[str]:
+    """Returns the id of the most recent partition of a table.
+
+    The id is read from INFORMATION_SCHEMA.PARTITIONS, which only reads partition
+    metadata instead of the table data. This query is never dry run since later
+    statements need its result.
+
+    Args:
+      table_name: The name of the partitioned table.
+
+    Returns:
+      The partition id (e.g. 20230131), or None if the table has no partitions.
+    """
+    full_table_name = self._get_full_table_name(table_name)
+    project_and_dataset, short_table_name = full_table_name.rsplit('.', 1)
+    dml_statement = (f"""
+      SELECT MAX(partition_id)
+      FROM `{project_and_dataset}.INFORMATION_SCHEMA.PARTITIONS`
+      WHERE table_name = @table_name
+      AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+      """)
+    job_config = bigquery.QueryJobConfig(
+      query_parameters=[bigquery.ScalarQueryParameter("table_name", "STRING", short_table_name)]
     )
-    client = gspread.authorize(credentials)
-    #get data from table and send to google sheet
-    table_data=self.read_from_table(table_name)
-    data=list(map(get_info,table_data))
-    df = pd.DataFrame(data, columns = table_data[0].keys())
-    sheets_file=df.to_csv(index=False)
-    try:
-      spreadsheet=client.open(output_google_sheet_name)
-    except gspread.exceptions.SpreadsheetNotFound :
-      print("This sheet doesn't exist. Creating one...")
-      spreadsheet=client.create(output_google_sheet_name)
-    client.import_csv(spreadsheet.id,data=sheets_file.encode("utf-8"))
-    spreadsheet.share(share_with, perm_type='user', role='writer')
+    client = get_client(self.gcp_project_id)
+
+    def fetch_partition_id():
+      for row in client.query(dml_statement, job_config=job_config).result():
+        return row[0]
+      return None
+
+    return self.metadata_cache.get_partition_id(self.get_bq_table(table_name), fetch_partition_id)
 
   def get_bq_table(self, table_name):
+    """Returns the metadata of a table, from the metadata cache when it's still valid."""
     full_table_name = self._get_full_table_name(table_name)
 
-    client = bigquery.Client(project=self.gcp_project_id)
-    table = client.get_table(full_table_name)
+    client = get_client(self.gcp_project_id)
+    table = self.metadata_cache.get_table(full_table_name, lambda: client.get_table(full_table_name))
 
     return table
 
+
+class BigqueryBatchWriter:
+  """
+  Collects rows in memory and appends them to a BigQuery table as a single load job
+  when a row count, size or time threshold is reached.
+
+  Rows are sent as newline delimited json data, so values are never interpolated into SQL.
+  Used as a context manager, the remaining rows are flushed on exit.
+  """
+
+  def __init__(self, bq: BigqueryHelper, table_name: str, schema: Optional[list] = None,
+    max_rows: Optional[int] = BATCH_WRITER_MAX_ROWS, max_bytes: Optional[int] = BATCH_WRITER_MAX_BYTES,
+    max_seconds: Optional[float] = BATCH_WRITER_MAX_SECONDS):
+    self.bq = bq
+    self.table_name = table_name
+    self.schema = schema
+    self.max_rows = max_rows
+    self.max_bytes = max_bytes
+    self.max_seconds = max_seconds
+    self.rows_written = 0
+    self._rows = []
+    self._buffered_bytes = 0
+    self._first_row_time = None
+    self._lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.flush()
+    return False
+
+  def append(self, row: dict) -> None:
+    """Adds a row to the buffer, flushing it if any threshold is reached.
+
+    Args:
+      row: Dict where keys are column names and values are data to insert.
+    """
+    with self._lock:
+      if self._first_row_time is None:
+        self._first_row_time = time.monotonic()
+      self._rows.append(row)
+      self._buffered_bytes += len(json.dumps(row, default=str))
+      should_flush = (
+        (self.max_rows and len(self._rows) >= self.max_rows) or
+        (self.max_bytes and self._buffered_bytes >= self.max_bytes) or
+        (self.max_seconds is not None and time.monotonic() - self._first_row_time >= self.max_seconds)
+      )
+    if should_flush:
+      self.flush()
+
+  def append_rows(self, rows: list) -> None:
+    """Adds several rows to the buffer.
+
+    Args:
+      rows: List of dicts where keys are column names and values are data to insert.
+    """
+    for row in rows:
+      self.append(row)
+
+  def flush(self) -> None:
+    """Sends all the buffered rows to the table in a single load job."""
+    with self._lock:
+      rows = self._rows
+      self._rows = []
+      self._buffered_bytes = 0
+      self._first_row_time = None
+    if not rows:
+      return
+    if self.bq.dry_run:
+      print("Dry run: skipping load of {} rows to {}".format(len(rows), self.table_name))
+      return
+
+    client = get_client(self.bq.gcp_project_id)
+    full_table_name = self.bq._get_full_table_name(self.table_name)
+    if self.schema is None:
+      self.schema = self.bq.get_bq_table(self.table_name).schema
+    job_config = bigquery.LoadJobConfig(
+      schema=self.schema,
+      write_disposition="WRITE_APPEND",
+      source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+    )
+    json_rows = [json.loads(json.dumps(row, default=str)) for row in rows]
+    job = client.load_table_from_json(json_rows, full_table_name, job_config=job_config)
+    job.result()
+    self.bq._table_written(full_table_name)
+    self.rows_written += len(rows)
+    print("Loaded {} rows to {}".format(len(rows), full_table_name))
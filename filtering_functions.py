@@ -13,6 +13,17 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import re
+from typing import Optional
+import pandas as pd
+from google.cloud import bigquery
+
+FIELD_ROUTE_KEY = re.compile(r"\[\s*(?:'([^']*)'|\"([^\"]*)\"|(-?\d+))\s*\]")
+#Field names are written in the SQL, only plain and dotted names are accepted
+FILTER_FIELD_NAME = re.compile(r"^[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*$")
+FILTER_COMBINATORS = ("$and", "$or", "$not")
+
+
 class FilteringFunctions:
   """
   The purpose of this class is to define special logic to be used as a filter when obtaining the merchant center feed. For example function "custom_label_one_is_237" fecined below
@@ -74,25 +85,259 @@ class FilteringFunctions:
 
     """
 
+    compiled_fields=self.compile_fields(fields)
     final_matrix=[];
-    for i in range(len(json_list)):
-      filter_control=[]
+    for json_object in json_list:
       additive_row=[]
-      for field in fields:
-        first_key = list(field.keys())[0]
-        filter_function=filters[first_key]
-        parameter_value=None
-        d={"json_list":json_list, "i":i}
-        exec("x=json_list[i]"+field[first_key],d)
-        parameter_value=d['x']
-        additive_row.append(parameter_value)
-        veredict=filters[first_key](parameter_value)
-        filter_control.append(veredict)
-        if not veredict:
+      for first_key, get_value in compiled_fields:
+        parameter_value=get_value(json_object)
+        if not filters[first_key](parameter_value):
           break
-      if(all(filter_control)):
-        final_matrix.append(additive_row)
+        additive_row.append(parameter_value)
       else:
-        continue
+        final_matrix.append(additive_row)
     self.final_matrix=final_matrix
     return final_matrix
+
+  def compile_fields(self, fields: list) -> list:
+    """
+    Parses the access routes of the fields once, so they don't have to be evaluated for every product.
+
+    Args:
+      fields: list of objects with the name of the field as key and the access route as value. Ex: [{"customAttrName":"['customAttributes'][0]['name']"}]
+
+    Return:
+      List of tuples with the name of the field and a function that receives a json object and returns the value of the field,
+      or None if the route doesn't exist in that object
+    """
+    compiled_fields=[]
+    for field in fields:
+      first_key = list(field.keys())[0]
+      compiled_fields.append((first_key, self._compile_route(field[first_key])))
+    return compiled_fields
+
+  def _compile_route(self, route: str):
+    """
+    Transforms an access route like "['customAttributes'][0]['name']" into a function that follows it.
+    """
+    keys=[]
+    for name, quoted_name, index in FIELD_ROUTE_KEY.findall(route):
+      if index:
+        keys.append(int(index))
+      else:
+        keys.append(name or quoted_name)
+    if FIELD_ROUTE_KEY.sub("", route).strip():
+      raise ValueError("Invalid field access route: " + route)
+
+    def get_value(json_object):
+      value=json_object
+      for key in keys:
+        try:
+          value=value[key]
+        except (KeyError, IndexError, TypeError):
+          return None
+      return value
+    return get_value
+
+
+def get_parameter_type(values: list) -> str:
+  """
+  Returns the BigQuery type of a list of filter values. Numbers mixed with decimals are FLOAT64,
+  anything that is not a number or a boolean is sent as a STRING.
+  """
+  if values and all(isinstance(x, bool) for x in values):
+    return "BOOL"
+  if values and all(isinstance(x, int) and not isinstance(x, bool) for x in values):
+    return "INT64"
+  if values and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in values):
+    return "FLOAT64"
+  return "STRING"
+
+
+def _as_text(column: pd.Series) -> pd.Series:
+  return column.astype("string")
+
+
+def _equals_sql(field, value, add_parameter):
+  if value is None:
+    return field + " IS NULL"
+  return field + " = " + add_parameter(value)
+
+def _in_sql(field, values, add_parameter):
+  return field + " IN UNNEST(" + add_parameter(list(values)) + ")"
+
+def _regex_sql(field, pattern, add_parameter):
+  return "REGEXP_CONTAINS(CAST(" + field + " AS STRING), " + add_parameter(str(pattern)) + ")"
+
+def _is_null_sql(field, is_null, add_parameter):
+  return field + (" IS NULL" if is_null else " IS NOT NULL")
+
+def _equals_mask(column, value):
+  if value is None:
+    return column.isna()
+  return _as_text(column) == str(value)
+
+def _number_mask(column, value, operator):
+  numbers = pd.to_numeric(column, errors="coerce")
+  return numbers >= value if operator == "min" else numbers <= value
+
+
+#Operators accepted for a field, with the function that compiles them to SQL and the one that
+#computes the mask of a dataframe column. New operators only need to be added here.
+FILTER_OPERATORS = {
+  "equals": (_equals_sql, _equals_mask),
+  "in": (_in_sql, lambda column, values: _as_text(column).isin([str(x) for x in values])),
+  "min": (lambda field, value, add_parameter: field + " >= " + add_parameter(value),
+    lambda column, value: _number_mask(column, value, "min")),
+  "max": (lambda field, value, add_parameter: field + " <= " + add_parameter(value),
+    lambda column, value: _number_mask(column, value, "max")),
+  "regex": (_regex_sql, lambda column, pattern: _as_text(column).str.contains(str(pattern), regex=True)),
+  "is_null": (_is_null_sql, lambda column, is_null: column.isna() == bool(is_null)),
+}
+
+#Reusable filters, referenced by name with {"filter": name}. Same logic as the FilteringFunctions methods.
+NAMED_FILTERS = {
+  "content_is_spanish": {"equals": "es"},
+  "content_is_237": {"equals": "237"},
+}
+
+
+class AttributeFilter:
+  """
+  Product filter defined declaratively, as in "attribute_filters" of the config file. The same definition
+  compiles to a parameterized where condition, which filters the transfer table in BigQuery, and to a
+  vectorized mask for dataframes, which filters the rows read from the Content API or local tables.
+
+  A definition is a dictionary where every entry must match. Ex:
+    "availability": ["in stock"]                  value is in the list
+    "is_bundle": false                            value is equal
+    "price.value": {"min": 10, "max": 99.9}       number in the range, both bounds inclusive and optional
+    "title": {"regex": "(?i)shoe"}                regular expression found in the value
+    "gtin": {"is_null": false}                    value is null or not
+    "custom_labels.label_0": {"equals": "sale"}   explicit operator, see FILTER_OPERATORS
+    "content_language": {"filter": "content_is_spanish"}   filter from NAMED_FILTERS
+    "$or": [definition, ...], "$and": [definition, ...], "$not": definition
+
+  Dotted names address nested columns in BigQuery. In dataframes they match the normalized column
+  name (custom_labels.label_1 -> custom_labels_label_1), filters on missing columns match every row.
+  """
+
+  def __init__(self, definition: Optional[dict] = None):
+    self.definition = definition or {}
+
+  def to_sql(self, parameter_prefix: Optional[str] = "filter"):
+    """
+    Compiles the filter into a where condition where every value is a query parameter.
+
+    Args:
+      parameter_prefix: prefix of the query parameter names
+
+    return where condition ("" if there are no filters), list of query parameters
+    """
+    query_parameters = []
+
+    def add_parameter(value) -> str:
+      name = parameter_prefix + "_" + str(len(query_parameters))
+      if isinstance(value, list):
+        parameter_type = get_parameter_type(value)
+        if parameter_type == "STRING":
+          value = [str(x) for x in value]
+        query_parameters.append(bigquery.ArrayQueryParameter(name, parameter_type, value))
+      else:
+        query_parameters.append(bigquery.ScalarQueryParameter(name, get_parameter_type([value]), value))
+      return "@" + name
+
+    return self._definition_to_sql(self.definition, add_parameter), query_parameters
+
+  def to_mask(self, dataframe: pd.core.frame.DataFrame) -> pd.Series:
+    """
+    Returns a boolean series with the rows of the dataframe that match the filter.
+    """
+    return self._definition_to_mask(self.definition, dataframe)
+
+  def get_fields(self) -> list:
+    """
+    Returns the field names used by the filter, including the ones inside $or, $and and $not.
+    """
+    fields = []
+
+    def add_fields(definition: dict):
+      for key, value in definition.items():
+        if key == "$not":
+          add_fields(value)
+        elif key in FILTER_COMBINATORS:
+          for item in self._get_items(key, value):
+            add_fields(item)
+        elif key not in fields:
+          fields.append(key)
+
+    add_fields(self.definition)
+    return fields
+
+  def _definition_to_sql(self, definition: dict, add_parameter) -> str:
+    conditions = []
+    for key, value in definition.items():
+      if key in FILTER_COMBINATORS:
+        if key == "$not":
+          condition = self._definition_to_sql(value, add_parameter)
+          #Null comparisons don't match, as in the dataframe masks
+          conditions.append("NOT COALESCE((" + (condition or "TRUE") + "), FALSE)")
+        else:
+          conditions.append("(" + (" OR " if key == "$or" else " AND ").join(
+            "(" + (self._definition_to_sql(item, add_parameter) or "TRUE") + ")" for item in self._get_items(key, value)) + ")")
+        continue
+      for operator, operand in self._get_operations(key, value):
+        conditions.append(FILTER_OPERATORS[operator][0](key, operand, add_parameter))
+    return " AND ".join(conditions)
+
+  def _definition_to_mask(self, definition: dict, dataframe: pd.core.frame.DataFrame) -> pd.Series:
+    mask = pd.Series(True, index=dataframe.index)
+    for key, value in definition.items():
+      if key == "$not":
+        mask &= ~self._definition_to_mask(value, dataframe)
+      elif key == "$or":
+        any_mask = pd.Series(False, index=dataframe.index)
+        for item in self._get_items(key, value):
+          any_mask |= self._definition_to_mask(item, dataframe)
+        mask &= any_mask
+      elif key == "$and":
+        for item in self._get_items(key, value):
+          mask &= self._definition_to_mask(item, dataframe)
+      else:
+        column_name = key if key in dataframe.columns else key.replace(".", "_")
+        operations = self._get_operations(key, value)
+        if column_name not in dataframe.columns:
+          continue
+        for operator, operand in operations:
+          mask &= FILTER_OPERATORS[operator][1](dataframe[column_name], operand).fillna(False).astype(bool)
+    return mask
+
+  def _get_items(self, combinator: str, value) -> list:
+    """
+    Returns the definitions combined by $or or $and, which must be a non empty list.
+    """
+    if not isinstance(value, list) or not value:
+      raise ValueError(combinator + " must be a non empty list of filters")
+    return value
+
+  def _get_operations(self, field: str, value) -> list:
+    """
+    Returns the (operator, operand) pairs of a field, expanding the short forms and named filters.
+    """
+    if not FILTER_FIELD_NAME.match(field):
+      raise ValueError("Invalid filter field name: " + field)
+    if isinstance(value, list):
+      return [("in", value)]
+    if not isinstance(value, dict):
+      return [("equals", value)]
+    operations = []
+    for operator, operand in value.items():
+      if operator == "filter":
+        if operand not in NAMED_FILTERS:
+          raise ValueError("Unknown named filter: " + str(operand))
+        operations += self._get_operations(field, NAMED_FILTERS[operand])
+      elif operator in FILTER_OPERATORS:
+        operations.append((operator, operand))
+      else:
+        raise ValueError("Unknown filter operator {} for field {}".format(operator, field))
+    return operations
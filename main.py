@@ -11,18 +11,28 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import annotations
 import os
+import copy
 import json
+import hashlib
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 from flask import Flask, request
-from bigquery_helper import BigqueryHelper
 from utilities import Utilities
-from merchant_center_helper import MerchantCenterHelper
-from service_account_authenticator import Service_Account_Authenticator
-import pandas as pd
-from google.cloud import bigquery
-import gspread
-import google.auth
 
+#pandas, the Google Cloud clients and gspread take most of the cold start time, so they are
+#imported on first use. Only the health check is served without them, the config update loads them
+#to activate the new configuration.
+if TYPE_CHECKING:
+    import pandas as pd
+    from bigquery_helper import BigqueryHelper
+    from merchant_center_helper import MerchantCenterHelper
+    from out_of_core import OutOfCoreProcessor
+    from process_executor import ProcessExecutor
+    from run_manifest import RunManifest
 
 CONDENSED_SUFFIX="Condensed"
 STUDIO_ID="id"
@@ -33,13 +43,177 @@ STRING_TRUE="TRUE"
 STRING_FALSE="FALSE"
 WRITE_DISPOSITION_FINAL_TABLE="WRITE_TRUNCATE" #Could be WRITE_APPEND
 ENRICHED_SUFFIX="Enriched"
+REPORTING_IDS_SUFFIX="ReportingIds"
+#Reporting ids join the Studio id and the offer ids of the row, or are a fixed width hash of them
+REPORTING_ID_MODE_CONCATENATED = "concatenated"
+REPORTING_ID_MODE_HASHED = "hashed"
 PRODUCTS_FROM_MC = "productsFromMC"
-GOOGLE_SHEETS_AUTH_SCOPES=["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',"https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+INGESTION_MODE_CONTENT_API = "content_api"
+FINAL_STAGE = "google_sheets"
+#Options are expanded with UNNEST over array parameters in the cross join query, or stored in their own tables
+OPTION_EXPANSION_UNNEST = "unnest"
+OPTION_EXPANSION_TABLES = "tables"
+RUN_TABLE_EXPIRATION_HOURS = 24
+PRODUCTS_BASE_PARTITION_EXPIRATION_DAYS = 7
+PREVIEW_RUN_PREFIX = "preview_"
+PREVIEW_SAMPLE_PRODUCTS = 1000
+PREVIEW_ROWS = 20
+PREVIEW_TABLE_EXPIRATION_HOURS = 1
+SHARD_TARGET_SHEETS = "sheets"
+SHARD_TARGET_GCS = "gcs"
+SHARD_TARGET_LOCAL = "local"
+SHARD_PUBLISH_CONCURRENCY = 4
+SHARD_PUBLISH_MAX_ATTEMPTS = 3
 
 
 app = Flask(__name__)
-params = Utilities.load_config('config.json')
-merchant_center_fields=params["mc_fields"]
+#Loaded from config.json on first use by _get_params, or replaced by /updateConfig
+params = None
+merchant_center_fields = None
+#Work derived from params that doesn't depend on the products, see _activate_config
+activated_config = None
+#Guards params and activated_config, so they always hold the same configuration
+_config_lock = threading.Lock()
+#Keys every configuration must have
+REQUIRED_CONFIG_KEYS = ["gcp_project_id", "bigquery_dataset", "bucket_name", "table_name_prefix", "mc_id",
+    "mc_datatransfer_table", "mc_fields", "additional_columns", "attribute_filters", "amount_of_rows_to_condense",
+    "reporting_id_column", "output_google_sheet_name", "administrator_email"]
+
+
+def _get_params() -> dict:
+    """
+    Returns the current configuration, reading config.json the first time it's needed.
+    """
+    global params
+    global merchant_center_fields
+    if params is None:
+        params = Utilities.load_config('config.json')
+        merchant_center_fields = params["mc_fields"]
+    return params
+
+
+def _create_helpers(config: dict, dry_run: bool = False, executor: ProcessExecutor = None):
+    """
+    Returns the BigqueryHelper and MerchantCenterHelper of a configuration.
+    executor is the process executor held by the run, without it dataframe functions run inline.
+    """
+    from bigquery_helper import BigqueryHelper
+    from merchant_center_helper import MerchantCenterHelper
+
+    bq = BigqueryHelper(
+        gcp_project_id=str(config["gcp_project_id"]),
+        dataset_name=str(config["bigquery_dataset"]),
+        bucket_name=str(config["bucket_name"]),
+        table_name_prefix=str(config["table_name_prefix"]),
+        dry_run=dry_run,
+        compact_dataframes=bool(config.get("compact_dataframes", False)),
+        executor=executor
+    )
+
+    mc = MerchantCenterHelper(
+        merchant_id=str(config["mc_id"]),
+        bq=bq,
+        table=str(config["mc_datatransfer_table"]),
+        base_url=config.get("content_api_base_url")
+    )
+    return bq, mc
+
+
+def _get_config_fingerprint(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _validate_config(config: dict) -> None:
+    """
+    Checks that a configuration has every required key and that its values can be compiled.
+
+    raises ValueError listing every problem found
+    """
+    from bigquery_helper import CONDENSE_LEFTOVER_POLICIES
+    from filtering_functions import AttributeFilter
+
+    problems = ["missing " + key for key in REQUIRED_CONFIG_KEYS if key not in config]
+    if not isinstance(config.get("mc_fields", []), list) or ("mc_fields" in config and not config["mc_fields"]):
+        problems.append("mc_fields must be a non empty list")
+    else:
+        #Overlaps that depend on the schema, such as price and price.value, are found when the fields are compiled
+        columns = [str(field).replace(".", "_") for field in config.get("mc_fields", [])]
+        duplicated = sorted({column for column in columns if columns.count(column) > 1})
+        if duplicated:
+            problems.append("mc_fields select these columns more than once: " + ", ".join(duplicated))
+    additional_columns = config.get("additional_columns", {})
+    if not isinstance(additional_columns, dict) or not all(isinstance(values, list) for values in additional_columns.values()):
+        problems.append("additional_columns must map every column to a list of values")
+    amount_of_rows_to_condense = config.get("amount_of_rows_to_condense", 0)
+    if amount_of_rows_to_condense is not None and (not isinstance(amount_of_rows_to_condense, int) or amount_of_rows_to_condense < 0):
+        problems.append("amount_of_rows_to_condense must be a non negative integer")
+    allowed_values = {
+        "option_expansion_mode": [OPTION_EXPANSION_UNNEST, OPTION_EXPANSION_TABLES],
+        "reporting_id_mode": [REPORTING_ID_MODE_CONCATENATED, REPORTING_ID_MODE_HASHED],
+        "shard_publish_target": [SHARD_TARGET_SHEETS, SHARD_TARGET_GCS, SHARD_TARGET_LOCAL],
+        "condense_leftover_policy": list(CONDENSE_LEFTOVER_POLICIES),
+    }
+    for key, values in allowed_values.items():
+        if config.get(key) is not None and config[key] not in values:
+            problems.append(key + " must be one of " + ", ".join(values))
+    try:
+        AttributeFilter(config.get("attribute_filters")).to_sql()
+    except Exception as e:
+        problems.append("attribute_filters: " + str(e))
+    if problems:
+        raise ValueError("Invalid configuration: " + "; ".join(problems))
+
+
+def _activate_config(config: dict) -> dict:
+    """
+    Validates a configuration and computes everything the pipeline derives from it that doesn't
+    depend on the products, so /execute only runs the data dependent work. Called by /updateConfig,
+    or by the first run after the configuration changed.
+
+    The schema of the transfer table is read again to compile the mc_fields projection, which also
+    creates the shared BigQuery client and fills the metadata cache of the transfer table.
+
+    The helpers don't take the shared process executor, a rejected configuration doesn't replace
+    its pool. Runs take it from the configuration once it is active.
+
+    returns:
+        Dictionary with a copy of the configuration, its fingerprint, the compiled attribute filter,
+        the product columns and their projection, and the compiled option expansion. Runs read the
+        configuration from the copy, so a configuration update during a run doesn't change it.
+
+    raises ValueError if the configuration is not valid
+    """
+    from filtering_functions import AttributeFilter
+
+    _validate_config(config)
+    bq, mc = _create_helpers(config)
+    activation = {
+        "config": copy.deepcopy(config),
+        "fingerprint": _get_config_fingerprint(config),
+        "attribute_filter": AttributeFilter(config["attribute_filters"]),
+        "compiled_options": bq.compile_options_cross_join(config["additional_columns"]),
+    }
+    if config.get("ingestion_mode") == INGESTION_MODE_CONTENT_API:
+        activation["content_api_fields"] = _get_content_api_fields(config)
+        activation["normalized_fields"] = list(activation["content_api_fields"].keys())
+        activation["normalized_fields_query"] = None
+    else:
+        bq.metadata_cache.invalidate(bq._get_full_table_name(mc.table))
+        activation["normalized_fields"], activation["normalized_fields_query"] = mc.normalize_fields(config["mc_fields"])
+    print("Configuration activated: " + activation["fingerprint"])
+    return activation
+
+
+def _get_activated_config() -> dict:
+    """
+    Returns the activation of the current configuration, activating it if it changed since the last one.
+    """
+    global activated_config
+    with _config_lock:
+        config = _get_params()
+        if activated_config is None or activated_config["fingerprint"] != _get_config_fingerprint(config):
+            activated_config = _activate_config(config)
+        return activated_config
 
 
 def _create_table_for_mc_products(bq:BigqueryHelper, products_from_mc_in_array):
@@ -54,10 +228,32 @@ def _create_table_for_mc_products(bq:BigqueryHelper, products_from_mc_in_array):
     bq.insert_multiple_records(PRODUCTS_FROM_MC, products_from_mc_in_array, merchant_center_fields)
 
 
-def _create_options_tables(bq:BigqueryHelper)-> list:
+def _get_content_api_fields(config: dict = None) -> dict:
+    """
+    Returns the columns to read from the Content API with their access route in the product json.
+    Uses "content_api_fields" from the config file if present, otherwise each field in mc_fields is read
+    from its camel case name in the Content API (offer_id -> ['offerId']).
+
+    Example config:
+    "content_api_fields":{
+      "offer_id":"['offerId']",
+      "price_value":"['price']['value']"
+    }
+    """
+    config = config or params
+    if config.get("content_api_fields"):
+        return config["content_api_fields"]
+    content_api_fields = {}
+    for field in config["mc_fields"]:
+        first_word, *other_words = field.split("_")
+        content_api_fields[field] = "['" + first_word + "".join(word.capitalize() for word in other_words) + "']"
+    return content_api_fields
+
+
+def _create_options_tables(bq:BigqueryHelper, config: dict, run_id: str = None)-> list:
     """
     Reads config file to retrieve options for complementary tables, iterates through them
-    and store values in their own table
+    and store values in their own table, inside the namespace of the run if run_id is given
 
     Returns a list with the table names created in this method, as well as the header list
 
@@ -69,10 +265,11 @@ def _create_options_tables(bq:BigqueryHelper)-> list:
     """
     options = []
     options_table_header_list = []
-    for key,values in params["additional_columns"].items():
+    for key,values in config["additional_columns"].items():
         table_name=key+"Table"
-        bq.create_table(table_name=table_name, columns=[key])
-        bq.insert_multiple_records(table_name,map(lambda x: [x], values),[key])
+        run_table_name=_get_run_table_name(table_name, run_id)
+        bq.create_table(table_name=run_table_name, columns=[key])
+        bq.insert_multiple_records(run_table_name,map(lambda x: [x], values),[key])
         options.append(table_name)
         options_table_header_list.append(key)
 
@@ -103,7 +300,47 @@ def _get_df_reporting_ids(base_fields: list, df: pd.core.frame.DataFrame) -> lis
     return reporting_ids
 
 
-def _add_studio_required_columns(condensed_dataframe: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+def _get_df_hashed_reporting_ids(base_fields: list, df: pd.core.frame.DataFrame) -> list:
+    """
+    Same as _get_df_reporting_ids, but every reporting id is the 16 hex characters of a 64 bit hash of
+    the concatenated fields, whatever the length of the offer ids. The hash uses the fixed key of
+    pandas, so the same fields get the same reporting id in every run.
+
+    The concatenation and the hash are vectorized, so they run in the calling process.
+    """
+    import pandas as pd
+    concatenated = df[base_fields[0]].astype(str)
+    for element in base_fields[1:]:
+        concatenated = concatenated + "_" + df[element].astype(str)
+    hashes = pd.util.hash_array(concatenated.to_numpy(dtype=object))
+    return ["{:016x}".format(value) for value in hashes.tolist()]
+
+
+def _get_reporting_id_columns(config: dict) -> list:
+    """
+    Returns the columns the reporting id is built from: the Studio id and the reporting_id_column
+    of every condensed item.
+    """
+    reporting_id_cols = [STUDIO_ID]
+
+    #If we condensed several items in a row, we need to create a reporting id with data from all
+    #condensed items.
+    if config["amount_of_rows_to_condense"] and config["amount_of_rows_to_condense"] > 1:
+        for i in range(config["amount_of_rows_to_condense"]):
+            reporting_id_cols.append(config["reporting_id_column"] + '_' + str(i+1))
+    elif config["amount_of_rows_to_condense"] and config["amount_of_rows_to_condense"] == 1:
+        reporting_id_cols.append(config["reporting_id_column"])
+    return reporting_id_cols
+
+
+def _get_chunk_reporting_ids(df: pd.core.frame.DataFrame, base_fields: list) -> list:
+    """
+    Same as _get_df_reporting_ids with the dataframe as first parameter, as required to run it in the process pool.
+    """
+    return _get_df_reporting_ids(base_fields, df)
+
+
+def _add_studio_required_columns(condensed_dataframe: pd.core.frame.DataFrame, config: dict, first_id: int = 1, executor: ProcessExecutor = None) -> pd.core.frame.DataFrame:
     """
     Adding Google Studio required cols.
 
@@ -113,83 +350,344 @@ def _add_studio_required_columns(condensed_dataframe: pd.core.frame.DataFrame) -
 
     params:
         condensed_dataframe: Pandas dataframe with all the product data.
+        config: Configuration of the run.
+        first_id: Studio id of the first row, used when the feed is enriched in chunks.
+        executor: ProcessExecutor held by the run, by default the shared one.
 
     returns:
         Pandas dataframe with the same data, plus the additional studio columns.
     """
 
-    condensed_dataframe[STUDIO_ID]=list(range(1,len(condensed_dataframe)+1))
+    condensed_dataframe[STUDIO_ID]=list(range(first_id,first_id+len(condensed_dataframe)))
     condensed_dataframe[STUDIO_ACTIVE]=[STRING_TRUE]*len(condensed_dataframe)
     condensed_dataframe[STUDIO_DEFAULT]=[STRING_FALSE]*len(condensed_dataframe)
-    reporting_id_cols = ["id"]
+    reporting_id_cols = _get_reporting_id_columns(config)
 
-    #If we condensed several items in a row, we need to create a reporting id with data from all
-    #condensed items.
-    if params["amount_of_rows_to_condense"] and params["amount_of_rows_to_condense"] > 1:
-        for i in range(params["amount_of_rows_to_condense"]):
-            reporting_id_cols.append(params["reporting_id_column"] + '_' + str(i+1))
-    elif params["amount_of_rows_to_condense"] and params["amount_of_rows_to_condense"] == 1:
-        reporting_id_cols.append(params["reporting_id_column"])
+    if config.get("reporting_id_mode") == REPORTING_ID_MODE_HASHED:
+        condensed_dataframe[STUDIO_REPORTING_ID] = _get_df_hashed_reporting_ids(reporting_id_cols, condensed_dataframe)
+        return condensed_dataframe
 
-    condensed_dataframe[STUDIO_REPORTING_ID] = _get_df_reporting_ids(reporting_id_cols, condensed_dataframe)
+    #The reporting ids are built row by row, so they are computed in parallel in the process pool
+    if executor is None:
+        from process_executor import get_executor
+        executor = get_executor(config.get("process_pool_workers"))
+    reporting_ids = executor.map_dataframe(_get_chunk_reporting_ids, condensed_dataframe[reporting_id_cols], reporting_id_cols)
+    condensed_dataframe[STUDIO_REPORTING_ID] = [reporting_id for chunk in reporting_ids for reporting_id in chunk]
 
     return condensed_dataframe
 
 
-def main_cartesian():
-    bq = BigqueryHelper(
-        gcp_project_id=str(params["gcp_project_id"]),
-        dataset_name=str(params["bigquery_dataset"]),
-        bucket_name=str(params["bucket_name"]),
-        table_name_prefix=str(params["table_name_prefix"])
-    )
+def main_cartesian(dry_run: bool = False, resume: bool = False, preview_rows: int = None):
+    """
+    Runs the whole pipeline: copies the MC data, adds the option columns, condenses rows,
+    adds the Studio columns, publishes the result table and writes it to Google Sheets.
 
-    mc = MerchantCenterHelper(
-        merchant_id=str(params["mc_id"]),
-        bq=bq,
-        table=str(params["mc_datatransfer_table"])
-    )
+    Tables of a run are suffixed with its run id and expire after run_table_expiration_hours,
+    only the published table keeps a fixed name.
 
+    Every completed stage is recorded in the run manifest. When resuming, stages whose
+    inputs and outputs didn't change since they completed are skipped.
 
-    normalized_fields, normalized_fields_query = mc.normalize_fields(merchant_center_fields)
-    #Makes a copy of the MC table, but only selected columns and rowtable, but only selected columns and rows
-    print("normalized_fields")
-    print(normalized_fields)
-    print("normalized_fields_query")
-    print(normalized_fields_query)
-    mc.copy_datatransfer_table(PRODUCTS_FROM_MC, normalized_fields_query, params["attribute_filters"])
+    params:
+        dry_run: If True, every statement is only validated by BigQuery and no table is created.
+        resume: If True, skips the stages that are still valid from a previous run.
+        preview_rows: If set, runs the stages up to enrichment on a sample of the products, in a
+            separate namespace and without publishing, and returns this many enriched rows.
 
+    returns:
+        In dry run mode, a dictionary with the bytes that would be processed per stage and in total.
+        In preview mode, the dictionary returned by _get_preview_report.
+    """
+    from process_executor import get_executor
 
-    #Creates secondary table with extra options needed to merge into products
-    options_tables,options_table_header_list = _create_options_tables(bq)
+    activation = _get_activated_config()
+    #The run keeps its process pool even if /updateConfig changes process_pool_workers meanwhile
+    executor = get_executor(activation["config"].get("process_pool_workers"), acquire=True)
+    try:
+        bq, mc = _create_helpers(activation["config"], dry_run, executor)
+        return _run_pipeline(bq, mc, activation, dry_run, resume, preview_rows)
+    finally:
+        executor.release()
 
-    #Cross join table products with extra options
-    final_joined_table = _cross_join_tables(options_tables, bq)
 
-    #Appends optional headers into MC header list to be used for condensed table
-    for header in options_table_header_list:
-        normalized_fields.append(header)
+def _run_pipeline(bq: BigqueryHelper, mc: MerchantCenterHelper, activation: dict, dry_run: bool, resume: bool, preview_rows: int):
+    """
+    Runs the stages of main_cartesian with the helpers of the run. Every stage reads the configuration
+    of the activation, not the current one.
+    """
+    from run_manifest import RunManifest
+
+    config = activation["config"]
+    preview = preview_rows is not None and not dry_run
+    manifest = None if dry_run or preview else RunManifest(bq,
+        resumable_hours=config.get("run_table_expiration_hours", RUN_TABLE_EXPIRATION_HOURS), config_fingerprint=activation["fingerprint"])
+    resume = resume and manifest is not None
+    #Every table of the run is suffixed with its run id, so concurrent runs don't overwrite each other.
+    #Resuming continues the namespace of the last run with the same configuration that failed.
+    run_id = (resume and manifest.get_resumable_run_id(FINAL_STAGE)) or _new_run_id()
+    #Previews only read a sample of the products
+    sample_products = config.get("preview_sample_products", PREVIEW_SAMPLE_PRODUCTS) if preview else None
+    if preview:
+        run_id = PREVIEW_RUN_PREFIX + run_id
+    if manifest and not manifest.start(run_id):
+        #Another execution of this instance resumed the same run meanwhile
+        run_id = _new_run_id()
+        manifest.start(run_id)
+    out_of_core = None
+    failed = True
+    try:
+        #Tables of the run are garbage collected by BigQuery, failed runs can be resumed until they expire
+        bq.set_run(run_id, PREVIEW_TABLE_EXPIRATION_HOURS if preview else config.get("run_table_expiration_hours", RUN_TABLE_EXPIRATION_HOURS))
+        print("Run id: " + run_id)
+        #With a memory budget, condense and enrichment spill the table to disk and run chunk by chunk
+        if config.get("spill_memory_budget_mb") and not dry_run and not preview:
+            from out_of_core import OutOfCoreProcessor
+            out_of_core = OutOfCoreProcessor(bq, config["spill_memory_budget_mb"], config.get("spill_directory"))
+
+        products_table = _get_run_table_name(PRODUCTS_FROM_MC, run_id)
+        if config.get("ingestion_mode") == INGESTION_MODE_CONTENT_API:
+            #Reads the products directly from Merchant Center instead of the daily transfer table
+            content_api_fields = activation["content_api_fields"]
+            normalized_fields = list(activation["normalized_fields"])
+            _run_stage(manifest, resume, "ingest_products", [], [content_api_fields, config["attribute_filters"]], products_table,
+                lambda: mc.ingest_products_from_content_api(products_table, content_api_fields, activation["attribute_filter"], limit=sample_products))
+        else:
+            normalized_fields = list(activation["normalized_fields"])
+            normalized_fields_query = activation["normalized_fields_query"]
+            #Makes a copy of the MC table, but only selected columns and rowtable, but only selected columns and rows
+            print("normalized_fields")
+            print(normalized_fields)
+            print("normalized_fields_query")
+            print(normalized_fields_query)
+            #The base table keeps the projected and filtered transfer partitions, only new partitions are read from the transfer table
+            base_table = config.get("products_base_table")
+            if base_table and mc.refresh_base_table(base_table, normalized_fields_query, activation["attribute_filter"],
+                config.get("products_base_partition_expiration_days", PRODUCTS_BASE_PARTITION_EXPIRATION_DAYS)):
+                _run_stage(manifest, resume, "copy_products_base", [base_table], [normalized_fields, config["attribute_filters"]], products_table,
+                    lambda: mc.copy_base_table(products_table, base_table, normalized_fields, limit=sample_products))
+            else:
+                _run_stage(manifest, resume, "copy_datatransfer_table", [mc.table], [normalized_fields_query, config["attribute_filters"]], products_table,
+                    lambda: mc.copy_datatransfer_table(products_table, normalized_fields_query, activation["attribute_filter"], limit=sample_products))
+
+        #Cross join table products with extra options, stored in their own secondary tables
+        options_table_header_list = list(config["additional_columns"].keys())
+        final_joined_table = _get_cross_join_table_name([key + "Table" for key in options_table_header_list])
+        _run_stage(manifest, resume, "cross_join", [products_table], config["additional_columns"], _get_run_table_name(final_joined_table, run_id),
+            lambda: _expand_options(bq, config, run_id, activation["compiled_options"]))
+
+        #Appends optional headers into MC header list to be used for condensed table
+        for header in options_table_header_list:
+            normalized_fields.append(header)
+
+        #Condense tables to get a final table containing merged products with options
+        if config["amount_of_rows_to_condense"] and config["amount_of_rows_to_condense"] > 1:
+            source_table_name = _get_run_table_name(final_joined_table, run_id)
+            final_joined_table = final_joined_table + CONDENSED_SUFFIX
+            condensed_table_name = _get_run_table_name(final_joined_table, run_id)
+            group_by = config.get("condense_group_by")
+            if group_by:
+                #Bundles products of the same group, numbering and pivoting them in a single BigQuery query.
+                #It runs in BigQuery whatever the spill settings, no rows are downloaded
+                grouping = [group_by, config.get("condense_order_by"), bool(config.get("condense_order_descending")),
+                    config.get("condense_leftover_policy", "pad")]
+                condense = lambda source, destination, amount, columns: bq.condense_rows_by_group_in_bigquery(
+                    source, destination, amount, columns, *grouping)
+            else:
+                grouping = None
+                condense = out_of_core.condense_rows if out_of_core else bq.condense_rows_from_table_in_memory
+            _run_stage(manifest, resume, "condense", [source_table_name], [config["amount_of_rows_to_condense"], normalized_fields, grouping], condensed_table_name,
+                lambda: condense(source_table_name, condensed_table_name, config["amount_of_rows_to_condense"], columns = normalized_fields))
+
+        run_joined_table = _get_run_table_name(final_joined_table, run_id)
+        if dry_run:
+            #Enrichment runs locally and publishing are copy jobs, without queries to estimate.
+            #Sharding runs queries on the condensed table, one per shard.
+            if config.get("shard_columns"):
+                bq.shard_tables_by_columns(run_joined_table, config["shard_columns"], table_suffix="_" + run_id)
+            report = bq.get_dry_run_report()
+            print("Dry run report")
+            print(report)
+            return report
+
+        #The enriched table of the run is published under the fixed name read by downstream consumers
+        published_table = final_joined_table + ENRICHED_SUFFIX
+        final_table_with_studio_data = _get_run_table_name(published_table, run_id)
+
+        _run_stage(manifest, resume, "enrich", [run_joined_table], [config["amount_of_rows_to_condense"], config["reporting_id_column"], config.get("reporting_id_mode")], final_table_with_studio_data,
+            lambda: _enrich_table(bq, config, run_joined_table, final_table_with_studio_data, out_of_core))
+
+        if preview:
+            return _get_preview_report(bq, mc, config, run_id, products_table, final_table_with_studio_data, preview_rows)
+
+        #A copy job replaces the published table atomically, readers see either the previous feed or the new one
+        _run_stage(manifest, resume, "publish", [final_table_with_studio_data], published_table, published_table,
+            lambda: bq.copy_table(final_table_with_studio_data, published_table))
+
+        #Hashed reporting ids are decoded with a lookup table published next to the feed
+        if config.get("reporting_id_mode") == REPORTING_ID_MODE_HASHED:
+            reporting_ids_table = final_joined_table + REPORTING_IDS_SUFFIX
+            _run_stage(manifest, resume, "publish_reporting_ids", [final_table_with_studio_data], reporting_ids_table, reporting_ids_table,
+                lambda: _create_reporting_ids_table(bq, config, final_table_with_studio_data, reporting_ids_table))
+
+        output_google_sheet_name=str(config["output_google_sheet_name"])
+        administrator_email=str(config["administrator_email"])
+
+        #Every Sheets request of the instance shares this per minute budget
+        from sheets_client import get_sheets_client
+        get_sheets_client(config.get("sheets_requests_per_minute"))
+
+        def export_to_google_sheets():
+            #Write google sheets from the table of this run, which no other run modifies.
+            #The import replaces the contents of the sheet, it doesn't need to be cleared before.
+            bq.send_table_to_google_sheets(final_table_with_studio_data, output_google_sheet_name, administrator_email)
+
+        #Each shard of the feed is enriched and exported as its own feed, several shards at a time
+        if config.get("shard_columns"):
+            _run_stage(manifest, resume, "publish_shards", [run_joined_table], [config["shard_columns"], config.get("shard_publish_target")], None,
+                lambda: _publish_shards(bq, config, run_joined_table, run_id, out_of_core))
+
+        _run_stage(manifest, resume, FINAL_STAGE, [final_table_with_studio_data], [output_google_sheet_name, administrator_email], None, export_to_google_sheets)
+        failed = False
+    finally:
+        if out_of_core:
+            out_of_core.close()
+        if manifest:
+            manifest.finish(failed)
+    return
 
-    #Condense tables to get a final table containing merged products with options
-    if params["amount_of_rows_to_condense"] and params["amount_of_rows_to_condense"] > 1:
-        condensed_table_name = final_joined_table + CONDENSED_SUFFIX
-        bq.condense_rows_from_table_in_memory(final_joined_table, condensed_table_name, params["amount_of_rows_to_condense"], columns = normalized_fields)
-        final_joined_table = condensed_table_name
 
-    dataframe = bq.get_big_query_table_as_df(final_joined_table)
-    dataframe = _add_studio_required_columns(dataframe)
+def _get_preview_report(bq: BigqueryHelper, mc: MerchantCenterHelper, config: dict, run_id: str, products_table: str, enriched_table: str, preview_rows: int) -> dict:
+    """
+    Returns the first enriched rows of a preview run, and an estimation of the full run made by scaling
+    the sample to the amount of products that pass the filters.
 
-    final_table_with_studio_data = final_joined_table + ENRICHED_SUFFIX
+    The amount of products is only known for the Data Transfer ingestion, with the Content API the
+    estimation is left empty.
+    """
+    sample_products = bq.count_table_records(products_table, use_metadata=True)
+    enriched = bq.get_bq_table(enriched_table)
+    total_products = None
+    if config.get("ingestion_mode") != INGESTION_MODE_CONTENT_API:
+        total_products = mc.count_datatransfer_products(config["attribute_filters"])
+    estimation = {"products": total_products, "feed_rows": None, "feed_bytes": None}
+    if total_products is not None and sample_products:
+        scale = total_products / sample_products
+        estimation["feed_rows"] = round((enriched.num_rows or 0) * scale)
+        estimation["feed_bytes"] = round((enriched.num_bytes or 0) * scale)
+    #Only the returned rows are downloaded
+    rows = bq.read_from_table(enriched_table, limit=preview_rows) if preview_rows else []
+    return {
+        "run_id": run_id,
+        "sample": {"products": sample_products, "feed_rows": enriched.num_rows, "feed_bytes": enriched.num_bytes},
+        "estimated_full_run": estimation,
+        "rows": [dict(row.items()) for row in rows]
+    }
 
-    bq.upload_dataframe_to_big_query(dataframe, WRITE_DISPOSITION_FINAL_TABLE, final_table_with_studio_data)
 
-    output_google_sheet_name=str(params["output_google_sheet_name"])
-    administrator_email=str(params["administrator_email"])
-    #Clear current Google sheet
-    bq.clear_table_google_sheets(output_google_sheet_name)
-    #Write google sheets
-    bq.send_table_to_google_sheets(final_table_with_studio_data, output_google_sheet_name, administrator_email)
-    return
+def _create_reporting_ids_table(bq: BigqueryHelper, config: dict, enriched_table: str, reporting_ids_table: str) -> None:
+    """
+    Adds the hashed reporting ids of the feed to a table that maps them to the Studio id and offer ids
+    they were built from, so reports by reporting id can be joined back to the products. Reporting ids
+    of previous feeds are kept, they may still appear in Campaign Manager reports.
+    """
+    bq.merge_into_table_from_select(enriched_table, reporting_ids_table, [STUDIO_REPORTING_ID] + _get_reporting_id_columns(config),
+        STUDIO_REPORTING_ID, stage="publish_reporting_ids")
+
+
+def _enrich_table(bq: BigqueryHelper, config: dict, source_table: str, destination_table: str, out_of_core: OutOfCoreProcessor = None) -> None:
+    """
+    Adds the Studio columns to a table and writes the result to another one.
+    """
+    if out_of_core:
+        out_of_core.transform_table(source_table, destination_table,
+            lambda chunk, rows_before: _add_studio_required_columns(chunk, config, first_id=rows_before + 1, executor=bq.executor), WRITE_DISPOSITION_FINAL_TABLE)
+        return
+    dataframe = bq.get_big_query_table_as_df(source_table)
+    dataframe = _add_studio_required_columns(dataframe, config, executor=bq.executor)
+    bq.upload_dataframe_to_big_query(dataframe, WRITE_DISPOSITION_FINAL_TABLE, destination_table)
+
+
+def _publish_shards(bq: BigqueryHelper, config: dict, source_table: str, run_id: str, out_of_core: OutOfCoreProcessor = None) -> dict:
+    """
+    Shards a table by the "shard_columns" of the config file and publishes every shard as its own feed:
+    the shard is enriched and exported to a Google Sheet named after the shard, to Cloud Storage
+    or to a local csv file, depending on "shard_publish_target".
+
+    Shards are published concurrently, see ShardPublisher. A failure only stops the run once the
+    retries of the failed shards are exhausted, the other shards are still published.
+
+    returns:
+        Report with the status, attempts and seconds of every shard.
+    """
+    from shard_publisher import ShardPublisher
+
+    run_suffix = "_" + run_id if run_id else ""
+    shards = bq.shard_tables_by_columns(source_table, config["shard_columns"], table_suffix=run_suffix)
+    target = config.get("shard_publish_target", SHARD_TARGET_SHEETS)
+
+    def publish_shard(shard_table):
+        shard_name = shard_table[:len(shard_table) - len(run_suffix)]
+        enriched_table = _get_run_table_name(shard_name + ENRICHED_SUFFIX, run_id)
+        #Out of core processing shares its spill directory, each shard runs in memory
+        _enrich_table(bq, config, shard_table, enriched_table)
+        if target == SHARD_TARGET_GCS:
+            bq.upload_data_to_cloud_storage(enriched_table)
+        elif target == SHARD_TARGET_LOCAL:
+            directory = config.get("shard_local_directory") or "."
+            bq.get_big_query_table_as_df(enriched_table).to_csv(os.path.join(directory, shard_name + ".csv"), index=False)
+        else:
+            sheet_name = str(config["output_google_sheet_name"]) + "_" + shard_name
+            #Creates the sheet of a new shard, and replaces the contents of an existing one
+            bq.send_table_to_google_sheets(enriched_table, sheet_name, str(config["administrator_email"]))
+
+    publisher = ShardPublisher(publish_shard,
+        max_concurrency=config.get("shard_publish_concurrency", SHARD_PUBLISH_CONCURRENCY),
+        requests_per_minute=config.get("shard_publish_requests_per_minute"),
+        max_attempts=config.get("shard_publish_max_attempts", SHARD_PUBLISH_MAX_ATTEMPTS))
+    report = publisher.publish(shards)
+    print(report)
+    if report["failed"]:
+        raise RuntimeError("{} of {} shards could not be published".format(report["failed"], len(shards)))
+    return report
+
+
+def _new_run_id() -> str:
+    """
+    Returns a new run id, made of the UTC time and a random suffix so it's unique and sortable.
+    """
+    return datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:6]
+
+
+def _get_run_table_name(table_name: str, run_id: str) -> str:
+    """
+    Returns the name of a table inside the namespace of a run.
+    """
+    return table_name + "_" + run_id if run_id else table_name
+
+
+def _run_stage(manifest: RunManifest, resume: bool, stage: str, input_tables: list, stage_config, output_table: str, run) -> None:
+    """
+    Runs a pipeline stage and records it in the run manifest, or skips it when resuming
+    and the manifest shows it already completed with the same inputs.
+
+    params:
+        manifest: RunManifest of the run, None to run without checkpoints (dry run)
+        resume: If True, a valid completed stage is skipped.
+        stage: Name of the stage.
+        input_tables: Tables read by the stage.
+        stage_config: Configuration values that change the stage output.
+        output_table: Table written by the stage, None if it doesn't write a table.
+        run: Function without parameters that runs the stage.
+    """
+    if manifest is None:
+        run()
+        return
+    fingerprint = manifest.get_fingerprint(input_tables, stage_config)
+    if resume and manifest.is_complete(stage, fingerprint, output_table):
+        print("Skipping stage " + stage + ", output is still valid")
+        return
+    run()
+    manifest.record(stage, fingerprint, output_table)
 
 def _transform_config_to_json(list_of_lists: list)-> dict:
   """
@@ -224,23 +722,31 @@ def _load_config(input_google_sheet_name:str)-> str:
 
     global params
     global merchant_center_fields
-    credentials, project_id = google.auth.default(
-        scopes=GOOGLE_SHEETS_AUTH_SCOPES
-    )
-    client = gspread.authorize(credentials)
+    global activated_config
+    import gspread
+    from sheets_client import get_sheets_client
+    sheets = get_sheets_client()
     try:
-      spreadsheet=client.open(input_google_sheet_name)
+      #The sheet is looked up again, it may have been replaced since the last update
+      sheets.forget(input_google_sheet_name)
+      list_of_lists = sheets.read_first_worksheet(input_google_sheet_name)
     except gspread.exceptions.SpreadsheetNotFound :
       print("Configuration sheet does not exist!...")
       return "Configuration sheet does not exist!... Not updated"
-    worksheet = spreadsheet.get_worksheet(0)
-    list_of_lists = worksheet.get_all_values()
     config_json=_transform_config_to_json(list_of_lists)
-    params=config_json
-    merchant_center_fields=params["mc_fields"]
-    f = open("config.json", "w")
-    json.dump(config_json, f)
-    f.close()
+    #An invalid configuration is rejected and the current one stays active
+    try:
+      activation=_activate_config(config_json)
+    except ValueError as e:
+      print(e)
+      return str(e) + "... Not updated"
+    with _config_lock:
+      activated_config=activation
+      params=config_json
+      merchant_center_fields=params["mc_fields"]
+      f = open("config.json", "w")
+      json.dump(config_json, f)
+      f.close()
     a_file = open("config.json","r")    
     Lines = a_file.readlines()
     for line in Lines:
@@ -252,10 +758,38 @@ def _load_config(input_google_sheet_name:str)-> str:
 
 @app.route("/execute")
 def deploy():
-    main_cartesian()
+    """
+    Runs the pipeline. With resume=true, stages that completed in a previous run and are still valid are skipped.
+    """
+    resume = request.args.get("resume", "false").lower() == "true"
+    main_cartesian(resume=resume)
     return "Main cartesian executed successfully!\n"
 
 
+@app.route("/dryRun")
+def dry_run():
+    """
+    Estimates the bytes processed by every statement of a run without creating any table.
+    Returns the estimation as a json.
+    """
+    report = main_cartesian(dry_run=True)
+    return json.dumps(report) + "\n"
+
+
+@app.route("/preview")
+def preview():
+    """
+    Runs the pipeline up to enrichment on a sample of the products, without touching the published
+    table or the Google Sheet. Returns the first enriched rows and the estimated size of a full run as a json.
+    """
+    rows = request.args.get("rows", str(PREVIEW_ROWS))
+    if not rows.isdigit():
+        return "rows must be a non negative integer\n", 400
+    rows = int(rows)
+    report = main_cartesian(preview_rows=rows)
+    return json.dumps(report, default=str) + "\n"
+
+
 @app.route("/test")
 def test_deploy():
     return "Project Cartesian deployed successfully!\n"
@@ -276,49 +810,54 @@ def configure():
 
 
 
-def _create_additional_columns_tables(bq:BigqueryHelper) -> list:
-    """
-    Reads config file to retrieve options for complementary tables, iterates through them
-    and store values in their own table
-
+def _expand_options(bq:BigqueryHelper, config: dict, run_id: str = None, compiled_options: tuple = None) -> str:
+    """Adds the option columns from the config file to the product list, repeating every
+        product once per combination of option values
     Args:
-        bq : Instance of BigQueryHelper to help with auxiliar operations
-
+      bq : Instance of BigQueryHelper for auxiliary operations
+      config : Configuration of the run
+      run_id : Run whose namespace contains the tables, None for tables without namespace
+      compiled_options : Option expansion compiled when the config was activated, see BigqueryHelper.compile_options_cross_join
     Return:
-        Returns a list with the table names created in this method
-
-    Example input in config file:
-    "options_table":{
-      "option1":["value1","value2"],
-      "option2":["value3","value4"]
-    }
+      Name of table where products where merged with options specified in config file
     """
-    additional_columns = []
-    for key,values in params["additional_columns"].items():
-        table_name=key+"Table"
-        bq.create_table(table_name=table_name, columns=[key])
-        bq.insert_multiple_records(table_name,map(lambda x: [x], values),[key])
-        additional_columns.append(table_name)
-        additional_columns_header_list.append(key) #Stored in class variable
-
-    return options
-
-def _cross_join_tables(additional_columns_tables:list, bq:BigqueryHelper) -> str:
+    if config.get("option_expansion_mode", OPTION_EXPANSION_UNNEST) == OPTION_EXPANSION_TABLES:
+        return _cross_join_tables(_create_options_tables(bq, config, run_id)[0], bq, run_id)
+    options = config["additional_columns"]
+    destination_table = _get_run_table_name(_get_cross_join_table_name([key + "Table" for key in options]), run_id)
+    if options:
+        bq.create_new_table_from_options_cross_join(_get_run_table_name(PRODUCTS_FROM_MC, run_id), destination_table, options, compiled_options)
+    return destination_table
+
+def _cross_join_tables(additional_columns_tables:list, bq:BigqueryHelper, run_id: str = None) -> str:
     """This method takes a list of the tables created as options and joins them
         with the product list
     Args:
       additional_columns_tables : List of tables names created for the options to add to product table
       bq : Instance of BigQueryHelper for auxiliary operations
+      run_id : Run whose namespace contains the tables, None for tables without namespace
     Return:
       Name of table where products where merged with options specified in config file
     """
     current_table = PRODUCTS_FROM_MC
     for column in additional_columns_tables:
         cross_table = current_table+column
-        bq.create_new_table_from_cross_join(tables=[current_table, column], destination_table=cross_table)
+        bq.create_new_table_from_cross_join(
+            tables=[_get_run_table_name(current_table, run_id), _get_run_table_name(column, run_id)],
+            destination_table=_get_run_table_name(cross_table, run_id))
         current_table = cross_table
 
-    return current_table
+    return _get_run_table_name(current_table, run_id)
+
+
+def _get_cross_join_table_name(additional_columns_tables: list) -> str:
+    """Returns the name of the table created by _cross_join_tables for a list of option tables
+    Args:
+      additional_columns_tables : List of tables names created for the options to add to product table
+    Return:
+      Name of table where products are merged with options
+    """
+    return PRODUCTS_FROM_MC + "".join(additional_columns_tables)
 
 
 if __name__ == "__main__":
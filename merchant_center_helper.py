@@ -15,61 +15,262 @@ limitations under the License.
 """
 
 import requests
+import hashlib
 import json
+import re
 import base64, requests, sys
-from utilities import Utilities
-from filtering_functions import FilteringFunctions
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pandas as pd
+from filtering_functions import AttributeFilter, FilteringFunctions
 from bigquery_helper import BigqueryHelper
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Optional
+from google.cloud import bigquery
+from google.cloud import exceptions as cloud_exceptions
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 
 
-params = Utilities.load_config('config.json')
 MERCHANT_CENTER_MAX_RESULTS = 250
 MERCHANT_CENTER_BASE_URL = "https://shoppingcontent.googleapis.com/content/v2.1/MC_ID/products/?maxResults=" + str(MERCHANT_CENTER_MAX_RESULTS)
+CONTENT_API_SCOPES = ["https://www.googleapis.com/auth/content"]
+CONTENT_API_RETRIES = 5
+CONTENT_API_BACKOFF_FACTOR = 1
+CONTENT_API_RETRY_STATUS = [429, 500, 502, 503, 504]
+CONTENT_API_BATCH_SIZE = 5000
+#Custom labels are nested in the transfer table but flat in the Content API (custom_labels.label_0 -> customLabel0)
+CONTENT_API_CUSTOM_LABEL = re.compile(r"^custom_labels\.label_(\d)$")
+#Segment of a field name in mc_fields: a name with an optional [offset] or [*]
+FIELD_SEGMENT = re.compile(r"^(\w+)(?:\[(\d+|\*)\])?$")
+UNNEST_ITEM = "item"
+#Alias part of a [*], so the joined values don't collide with the first value (shipping[*].country -> shipping_all_country)
+ALL_VALUES_ALIAS = "all"
+REPEATED_VALUES_SEPARATOR = ","
+#The products base table keeps the projected and filtered products of every transfer partition
+BASE_PARTITION_COLUMN = "partition_time"
+BASE_FINGERPRINT_LABEL = "cartesian_base_fingerprint"
+BASE_SOURCE_PARTITION_LABEL = "cartesian_source_partition"
+BASE_PARTITION_EXPIRATION_DAYS = 7
+BASE_CLUSTER_FIELDS = 4
+#Column types BigQuery can cluster by, with their legacy names
+CLUSTERABLE_TYPES = ["STRING", "INTEGER", "INT64", "BOOLEAN", "BOOL", "DATE", "TIMESTAMP", "NUMERIC"]
 
 class MerchantCenterHelper:
 
-  def __init__(self,merchant_id: str, bq: BigqueryHelper, table: str):
+  def __init__(self,merchant_id: str, bq: BigqueryHelper, table: str, base_url: Optional[str] = None,
+    session: Optional[requests.Session] = None):
     self.merchant_center_id=merchant_id
     self.table=table
     self.bq = bq
+    self._latest_partition = None
+    #Content API products.list url, can point to a local server for tests and benchmarks
+    self.base_url = (base_url or MERCHANT_CENTER_BASE_URL).replace("MC_ID", merchant_id)
+    self._session = session
 
   def copy_datatransfer_table(
       self,
       destination_table_name: str,
       select_fields: [str],
-      filters_dict
+      filters_dict,
+      limit: Optional[int] = None
   ) -> None:
     """ Creates or replaces a table with data from a select statement
 
+    Only the most recent partition of the transfer table is read. The partition is resolved
+    up front from the partition metadata and passed as a query parameter, so BigQuery can prune
+    every other partition.
+
     Args:
       destination_table_name: The new table created with data from the filtered source table.
       fields: The comma separated fields to select. It can be * if all the fields will be selected.
-      where: The where conditions on the query.
+      filters_dict: Dictionary with the attribute filters, see AttributeFilter for the accepted values, or an AttributeFilter.
+      limit: Maximum amount of products to copy, all of them if None.
+    """
+
+    where, query_parameters = self._build_where(filters_dict)
+
+    self.bq.create_or_replace_table_from_select(
+      source_table_name= self.table,
+      destination_table_name= destination_table_name,
+      fields= ", ".join(select_fields),
+      where= where,
+      limit= limit,
+      stage= "copy_datatransfer_table",
+      query_parameters= query_parameters
+    )
+
+  def refresh_base_table(
+      self,
+      base_table_name: str,
+      select_fields: [str],
+      filters_dict,
+      partition_expiration_days: Optional[int] = BASE_PARTITION_EXPIRATION_DAYS
+  ) -> bool:
     """
+    Keeps a table with the projected and filtered products of the transfer table, partitioned by the
+    transfer partition they come from and clustered by offer_id and the filtered columns, so runs read
+    a small table instead of the raw transfer output.
+
+    When a new transfer partition lands, only that partition is selected and written to the base table,
+    the older ones are kept until they expire. The table is rebuilt when the projection or the filters
+    change, which is tracked with a label holding their fingerprint.
+
+    Args:
+      base_table_name: Name of the base table.
+      select_fields: Projection of the transfer table, see normalize_fields.
+      filters_dict: Dictionary with the attribute filters, or an AttributeFilter.
+      partition_expiration_days: Days the partitions of the base table are kept.
 
-    #TODO: what happens when the filter is not a string? Ex: a number
-    filters_list = []
-    for key in filters_dict:
-      filters_list.append(key + " IN (" + ', '.join("'{0}'".format(x) for x in filters_dict[key])+ ")")
+    return True if the base table has the latest transfer partition, False if the transfer table has no
+    partition metadata and the base table can't be used
+    """
+    latest_partition = self.get_latest_partition()
+    if latest_partition is None:
+      return False
+    attribute_filter = filters_dict if isinstance(filters_dict, AttributeFilter) else AttributeFilter(filters_dict)
+    source_partition_id = self.bq.get_latest_partition_id(self.table)
+    fingerprint = hashlib.sha256(json.dumps([self.table, select_fields, attribute_filter.definition],
+      sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+    where, query_parameters = self._build_where(attribute_filter)
+    fields = "@latest_partition AS " + BASE_PARTITION_COLUMN + ", " + ", ".join(select_fields)
 
-    where = ' AND '.join(filters_list)
+    try:
+      labels = self.bq.get_bq_table(base_table_name).labels or {}
+    except cloud_exceptions.NotFound:
+      labels = {}
+    if labels.get(BASE_FINGERPRINT_LABEL) != fingerprint:
+      print("Building products base table from partition " + source_partition_id)
+      aliases = [field.rsplit(" AS ", 1)[-1] for field in select_fields]
+      #Only scalar columns of a clusterable type, FLOAT64 columns such as price.value can't be clustered
+      schema = self.bq.get_bq_table(self.table).schema
+      filtered_columns = [name.replace(".", "_") for name in ["offer_id"] + list(attribute_filter.definition)
+        if not name.startswith("$") and self._get_leaf_type(schema, name) in CLUSTERABLE_TYPES]
+      cluster_fields = [column for column in filtered_columns if column in aliases]
+      self.bq.create_partitioned_table_from_select(
+        source_table_name=self.table,
+        destination_table_name=base_table_name,
+        fields=fields,
+        partition_field=BASE_PARTITION_COLUMN,
+        where=where,
+        cluster_fields=list(dict.fromkeys(cluster_fields))[:BASE_CLUSTER_FIELDS],
+        labels={BASE_FINGERPRINT_LABEL: fingerprint, BASE_SOURCE_PARTITION_LABEL: source_partition_id},
+        partition_expiration_days=partition_expiration_days,
+        stage="refresh_products_base",
+        query_parameters=query_parameters
+      )
+    elif labels.get(BASE_SOURCE_PARTITION_LABEL) != source_partition_id:
+      print("Adding partition " + source_partition_id + " to the products base table")
+      self.bq.replace_partition_from_select(
+        source_table_name=self.table,
+        destination_table_name=base_table_name,
+        partition_id=latest_partition.strftime("%Y%m%d"),
+        fields=fields,
+        where=where,
+        stage="refresh_products_base",
+        query_parameters=query_parameters
+      )
+      self.bq.set_table_labels(base_table_name, {BASE_SOURCE_PARTITION_LABEL: source_partition_id})
+    return True
 
-    where = where + ' AND DATE(_PARTITIONTIME) = '
-    where = where + '( DATE((SELECT MAX(_PARTITIONTIME) FROM `'+ self.bq._get_full_table_name(self.table)+'` )));'
+  def _get_leaf_type(self, schema: list, field_name: str) -> Optional[str]:
+    """
+    Returns the type of a dotted field name of the schema, None if it's not a single, not repeated leaf.
+    """
+    fields = schema
+    field = None
+    for name in field_name.split("."):
+      field = next((candidate for candidate in fields if candidate.name == name), None)
+      if field is None or field.mode == "REPEATED":
+        return None
+      fields = field.fields or []
+    return None if field.field_type in ("RECORD", "STRUCT") else field.field_type
 
+  def copy_base_table(
+      self,
+      destination_table_name: str,
+      base_table_name: str,
+      columns: [str],
+      limit: Optional[int] = None
+  ) -> None:
+    """
+    Creates or replaces a table with the products of the latest transfer partition in the base table,
+    see refresh_base_table. Only that partition is read.
 
+    Args:
+      destination_table_name: The new table created with the products.
+      base_table_name: Name of the base table.
+      columns: Columns to copy, the aliases of the base table projection.
+      limit: Maximum amount of products to copy, all of them if None.
+    """
     self.bq.create_or_replace_table_from_select(
-      source_table_name= self.table,
+      source_table_name= base_table_name,
       destination_table_name= destination_table_name,
-      fields= ", ".join(select_fields),
-      where= where
+      fields= ", ".join("`" + column + "`" for column in columns),
+      where= BASE_PARTITION_COLUMN + " = @latest_partition",
+      limit= limit,
+      stage= "copy_products_base",
+      query_parameters= [bigquery.ScalarQueryParameter("latest_partition", "TIMESTAMP", self.get_latest_partition())]
     )
 
+  def count_datatransfer_products(self, filters_dict) -> int:
+    """
+    Counts the products of the latest partition of the transfer table that pass the attribute filters.
+    Only the filtered columns are read.
+    """
+    where, query_parameters = self._build_where(filters_dict)
+    return self.bq.count_table_records(self.table, where=where, query_parameters=query_parameters)
+
+  def _build_where(self, filters_dict):
+    """
+    Returns the where condition and query parameters that select the filtered products of the latest partition.
+    """
+    attribute_filter = filters_dict if isinstance(filters_dict, AttributeFilter) else AttributeFilter(filters_dict)
+    where, query_parameters = attribute_filter.to_sql()
+    filters_list = [where] if where else []
+
+    latest_partition = self.get_latest_partition()
+    if latest_partition:
+      filters_list.append('_PARTITIONTIME = @latest_partition')
+      query_parameters.append(bigquery.ScalarQueryParameter("latest_partition", "TIMESTAMP", latest_partition))
+    else:
+      #No partition metadata available, fall back to resolving the partition in the query
+      filters_list.append('DATE(_PARTITIONTIME) = ( DATE((SELECT MAX(_PARTITIONTIME) FROM `'
+        + self.bq._get_full_table_name(self.table) + '` )))')
+
+    return ' AND '.join(filters_list), query_parameters
+
+  def get_latest_partition(self) -> Optional[datetime]:
+    """
+    Returns the start time of the most recent partition of the transfer table.
+    The value is cached, so the partition metadata is only read once per helper.
+
+    return datetime with the partition time, or None if the table has no partitions
+    """
+    if self._latest_partition is None:
+      partition_id = self.bq.get_latest_partition_id(self.table)
+      if partition_id:
+        partition_format = "%Y%m%d%H" if len(partition_id) == 10 else "%Y%m%d"
+        self._latest_partition = datetime.strptime(partition_id, partition_format).replace(tzinfo=timezone.utc)
+    return self._latest_partition
+
   def normalize_fields(self, select_fields:list):
     """
-    This function takes the column names of the selected fields from Merchant center and changes the composite fields that include "." in the name
-    and changes it to "_" to normalize the selection.
+    This function takes the field names selected from Merchant center and compiles them into a projection
+    of leaf columns against the transfer table schema, so only those columns are read and every later
+    table carries flat string-compatible columns. Nested names use "." and are aliased with "_".
+
+    Accepted field names:
+      title: top level column.
+      price: a RECORD selects all its leaves, at any depth. Ex: price.value AS price_value, price.currency AS price_currency
+      price.value: a single leaf of a RECORD.
+      product_types: a REPEATED field picks its first element. Ex: product_types[SAFE_OFFSET(0)] AS product_types
+      product_types[2]: picks the element at that offset. Ex: product_types[SAFE_OFFSET(2)] AS product_types_2
+      shipping[*].country: joins the values of every element with ",". Only one [*] is allowed per field.
+        Ex: ARRAY_TO_STRING(...) AS shipping_all_country
+
+    Two fields can't produce the same column, for example "price" and "price.value" both select price_value.
 
     Args:
       select_fields: list of fields
@@ -78,21 +279,216 @@ class MerchantCenterHelper:
     """
 
     bq_table = self.bq.get_bq_table(self.table)
-    fields = list(filter(lambda x: x.name in select_fields, bq_table.schema))
-
-    flatten_field = lambda x: field.name + "_" + x.name
-    flatten_field_query = lambda x: field.name + "." + x.name + " AS " + field.name + "_" + x.name
     flattened_fields = []
     flattened_fields_query = []
-    for field in fields:
-      if field.field_type == "RECORD":
-        flattened_fields = flattened_fields + list(map(flatten_field, field.fields))
-        flattened_fields_query = flattened_fields_query + list(map(flatten_field_query, field.fields))
-      else:
-        flattened_fields.append(field.name)
-        flattened_fields_query.append(field.name)
-
+    for select_field in select_fields:
+      for expression, alias in self._compile_field(bq_table.schema, select_field):
+        flattened_fields.append(alias)
+        flattened_fields_query.append(expression if expression == alias else expression + " AS " + alias)
 
+    duplicated = sorted({alias for alias in flattened_fields if flattened_fields.count(alias) > 1})
+    if duplicated:
+      raise ValueError("mc_fields select these columns more than once: " + ", ".join(duplicated))
     return flattened_fields, flattened_fields_query
 
+  def _compile_field(self, schema: list, field_name: str) -> list:
+    """
+    Parses a field name from normalize_fields and compiles it against the table schema.
+
+    return list of (expression, alias) tuples, empty if the field is not in the schema
+    """
+    segments = []
+    for segment in field_name.split("."):
+      match = FIELD_SEGMENT.match(segment)
+      if not match:
+        raise ValueError("Invalid field name: " + field_name)
+      segments.append((match.group(1), match.group(2)))
+    if sum(index == "*" for _, index in segments) > 1:
+      raise ValueError("Only one [*] is allowed per field: " + field_name)
+    projection = self._compile_path(schema, segments, "", [], None)
+    if not projection:
+      print("Field {} is not in the schema of {}, skipping it".format(field_name, self.table))
+    return projection
+
+  def _compile_path(self, fields: list, segments: list, expression: str, alias: list, array: Optional[str]) -> list:
+    """
+    Recursively resolves the remaining segments of a field name in a level of the schema.
+
+    Args:
+      fields: schema fields of the current level
+      segments: remaining (name, index) pairs, an empty list selects every leaf of the level
+      expression: SQL expression of the current level, relative to UNNEST_ITEM when array is set
+      alias: alias parts of the current level
+      array: expression of the array expanded by a [*], None if there is none
+
+    return list of (expression, alias) tuples
+    """
+    if segments:
+      name, index = segments[0]
+      selected = [(field, index) for field in fields if field.name == name]
+    else:
+      selected = [(field, None) for field in fields]
+    projection = []
+    for field, index in selected:
+      field_expression = expression + "." + field.name if expression else field.name
+      field_alias = alias + [field.name]
+      field_array = array
+      if field.mode == "REPEATED":
+        if index == "*":
+          if array:
+            raise ValueError("Only one [*] is allowed per field: " + field.name)
+          field_array = field_expression
+          field_expression = UNNEST_ITEM
+          field_alias.append(ALL_VALUES_ALIAS)
+        else:
+          field_expression += "[SAFE_OFFSET(" + str(int(index or 0)) + ")]"
+          if index is not None:
+            field_alias.append(index)
+      elif index is not None:
+        raise ValueError("Field {} is not REPEATED, it can't have an index".format(field.name))
+
+      if field.field_type in ("RECORD", "STRUCT"):
+        projection += self._compile_path(field.fields, segments[1:], field_expression, field_alias, field_array)
+      elif len(segments) <= 1:
+        if field_array:
+          field_expression = ("ARRAY_TO_STRING(ARRAY(SELECT CAST(" + field_expression + " AS STRING) FROM UNNEST("
+            + field_array + ") AS " + UNNEST_ITEM + "), '" + REPEATED_VALUES_SEPARATOR + "')")
+        projection.append((field_expression, "_".join(field_alias)))
+    return projection
+
+  def ingest_products_from_content_api(
+      self,
+      destination_table_name: str,
+      fields: dict,
+      filters_dict: Optional[dict] = None,
+      batch_size: Optional[int] = CONTENT_API_BATCH_SIZE,
+      limit: Optional[int] = None
+  ) -> int:
+    """
+    Reads the products directly from the Content API instead of the daily Data Transfer, so the feed
+    is as fresh as the Merchant Center data. Pages are filtered as they arrive and loaded to BigQuery in batches,
+    while the next page is already being downloaded.
+
+    Args:
+      destination_table_name: Table that is replaced with the filtered products.
+      fields: Dictionary with the column names as keys and the access route in the product json as values.
+        Ex: {"offer_id": "['offerId']", "price_value": "['price']['value']"}
+      filters_dict: Attribute filters, see AttributeFilter. Dotted names match the column with "_" (price.value -> price_value).
+        Filtered attributes that are not in fields are also read, but they are not loaded.
+      batch_size: Amount of products per load job.
+      limit: Maximum amount of products to load, no more pages are requested once it's reached.
+
+    return amount of products loaded, 0 in dry run mode
+    """
+    columns = list(fields.keys())
+    attribute_filter = filters_dict if isinstance(filters_dict, AttributeFilter) else AttributeFilter(filters_dict)
+    if self.bq.dry_run:
+      #Nothing is downloaded, the next stages are validated against an empty table with the same columns
+      self.bq._register_dry_run_table(destination_table_name,
+        "SELECT " + ", ".join("CAST(NULL AS STRING) AS " + column for column in columns) + " FROM UNNEST([1]) WHERE FALSE")
+      print("Dry run: products are not read from the Content API, the cost of the next stages doesn't include them")
+      return 0
+    filter_fields = self.get_content_api_filter_fields(attribute_filter, fields)
+    page_columns = columns + list(filter_fields.keys())
+    compiled_fields = FilteringFunctions().compile_fields(
+      [{column: fields[column]} for column in columns] + [{column: route} for column, route in filter_fields.items()])
+
+    self.bq.create_table(table_name=destination_table_name, columns=columns, update_if_exist=False, mode="NULLABLE")
+    products_loaded = 0
+    with self.bq.get_batch_writer(destination_table_name, max_rows=batch_size) as writer:
+      for products in self.list_products_pages():
+        page = pd.DataFrame(
+          [[self._to_string(get_value(product)) for _, get_value in compiled_fields] for product in products],
+          columns=page_columns, dtype=object)
+        #The whole page is filtered at once with the same filter definition used in BigQuery
+        page = page[attribute_filter.to_mask(page)][columns]
+        if limit is not None:
+          page = page.iloc[:limit - products_loaded]
+        writer.append_rows(page.where(page.notna(), None).to_dict("records"))
+        products_loaded += len(page)
+        if limit is not None and products_loaded >= limit:
+          break
+    print("Loaded {} products from the Content API".format(writer.rows_written))
+    return writer.rows_written
+
+  def get_content_api_filter_fields(self, attribute_filter: AttributeFilter, fields: dict) -> dict:
+    """
+    Returns the filtered attributes that are not read as columns, with their access route in the product json.
+    Each one is read from the camel case name of its parts (price.value -> ['price']['value']),
+    custom labels from their flat name (custom_labels.label_1 -> ['customLabel1']).
+
+    Args:
+      attribute_filter: Filter applied to the products.
+      fields: Columns read from the Content API, as in ingest_products_from_content_api.
+
+    return dictionary with the normalized column name of each attribute as key and its route as value
+    """
+    filter_fields = {}
+    for field in attribute_filter.get_fields():
+      column = field.replace(".", "_")
+      if field in fields or column in fields:
+        continue
+      custom_label = CONTENT_API_CUSTOM_LABEL.match(field)
+      if custom_label:
+        filter_fields[column] = "['customLabel" + custom_label.group(1) + "']"
+        continue
+      route = ""
+      for part in field.split("."):
+        first_word, *other_words = part.split("_")
+        route += "['" + first_word + "".join(word.capitalize() for word in other_words) + "']"
+      filter_fields[column] = route
+    return filter_fields
+
+  def list_products_pages(self):
+    """
+    Yields the products from products.list one page at a time, following nextPageToken.
+    The request for the next page is sent while the current one is being processed.
+
+    return generator with a list of product jsons per page
+    """
+    session = self._get_content_api_session()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      next_page = executor.submit(self._get_products_page, session, None)
+      while next_page is not None:
+        response = next_page.result()
+        page_token = response.get("nextPageToken")
+        next_page = executor.submit(self._get_products_page, session, page_token) if page_token else None
+        yield response.get("resources", [])
+
+  def _get_products_page(self, session: requests.Session, page_token: Optional[str]) -> dict:
+    """
+    Requests a single page of products.list. Retries and backoff are handled by the session adapter.
+    """
+    params = {"pageToken": page_token} if page_token else None
+    response = session.get(self.base_url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+  def _get_content_api_session(self) -> requests.Session:
+    """
+    Returns a pooled HTTP session authorized for the Content API, that retries with exponential backoff
+    on quota and server errors.
+    """
+    if self._session is None:
+      credentials, project_id = google.auth.default(scopes=CONTENT_API_SCOPES)
+      self._session = AuthorizedSession(credentials)
+    retry = Retry(
+      total=CONTENT_API_RETRIES,
+      backoff_factor=CONTENT_API_BACKOFF_FACTOR,
+      status_forcelist=CONTENT_API_RETRY_STATUS,
+      allowed_methods=["GET"]
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=4)
+    self._session.mount("https://", adapter)
+    self._session.mount("http://", adapter)
+    return self._session
 
+  def _to_string(self, value) -> Optional[str]:
+    """
+    Converts a value from the product json to the STRING columns of the products table.
+    """
+    if value is None or isinstance(value, str):
+      return value
+    if isinstance(value, (dict, list)):
+      return json.dumps(value)
+    return str(value)
@@ -0,0 +1,234 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import math
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bigquery_helper import BigqueryHelper, bigquery_types_mapper, condense_dataframe
+
+DEFAULT_MEMORY_BUDGET_MB = 512
+#Arrow types of the BigQuery columns of an empty table, other types are read as strings
+BIGQUERY_ARROW_TYPES = {
+  "INTEGER": pa.int64(), "INT64": pa.int64(), "FLOAT": pa.float64(), "FLOAT64": pa.float64(),
+  "BOOLEAN": pa.bool_(), "BOOL": pa.bool_(), "DATE": pa.date32(), "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+#Rows expand when converted from Arrow to pandas objects, the budget is divided by this factor
+PANDAS_EXPANSION_FACTOR = 4
+
+
+class OutOfCoreProcessor:
+  """
+  Runs the local condense and enrichment stages without loading the whole table in memory.
+
+  The table is streamed from BigQuery into Arrow IPC files on disk, which are memory mapped and
+  processed one chunk at a time, so only about one chunk is held in memory. The results are
+  appended to a parquet file that is loaded to BigQuery in a single job.
+
+  Usage:
+    with OutOfCoreProcessor(bq, memory_budget_mb=256) as processor:
+      processor.condense_rows(source_table, destination_table, 3, columns)
+  """
+
+  def __init__(self, bq: BigqueryHelper, memory_budget_mb: Optional[int] = DEFAULT_MEMORY_BUDGET_MB,
+    directory: Optional[str] = None):
+    self.bq = bq
+    self.chunk_bytes = max(1, int(memory_budget_mb * 1024 * 1024 / PANDAS_EXPANSION_FACTOR))
+    self.directory = tempfile.mkdtemp(prefix="cartesian-spill-", dir=directory)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+  def close(self) -> None:
+    """Deletes every spilled file."""
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def spill_table(self, table_name: str) -> List[str]:
+    """
+    Streams a BigQuery table into Arrow IPC files of about chunk_bytes each.
+
+    Args:
+      table_name: name of the table to download
+
+    Returns
+      list with the paths of the chunk files
+    """
+    paths = []
+    writer = None
+    written_bytes = 0
+    for batch in self.bq.iterate_table(table_name, output="arrow"):
+      if writer is None or written_bytes >= self.chunk_bytes:
+        if writer is not None:
+          writer.close()
+        paths.append(self._new_path("chunk"))
+        writer = pa.ipc.new_file(paths[-1], batch.schema)
+        written_bytes = 0
+      writer.write_batch(batch)
+      written_bytes += batch.nbytes
+    if writer is not None:
+      writer.close()
+    return paths
+
+  def condense_rows(self, source_table_name: str, destination_table_name: str,
+    amount_of_rows_to_condense: int, columns: List[str]) -> None:
+    """
+    Same result as BigqueryHelper.condense_rows_from_table_in_memory with bounded memory.
+
+    The shuffle is done in two passes: every row is first sent to a random bucket file, then each
+    bucket is shuffled in memory and condensed. Rows that don't complete a condensed row in a bucket
+    are carried to the next one, so at most amount_of_rows_to_condense - 1 rows are dropped as in memory.
+
+    Args:
+      source_table_name: The name of the table to get the data from.
+      destination_table_name: The new table created with the condensed rows.
+      amount_of_rows_to_condense: The amount of rows that will become a single row.
+      columns: List of columns in the source table.
+    """
+    chunk_paths = self.spill_table(source_table_name)
+    total_bytes = sum(os.path.getsize(path) for path in chunk_paths)
+    bucket_paths = self._scatter_to_buckets(chunk_paths, max(1, math.ceil(total_bytes / self.chunk_bytes)))
+
+    output_path = self._new_path("condensed", ".parquet")
+    writer = None
+    carry = None
+    empty = None
+    for bucket_path in bucket_paths:
+      bucket = self._read_file(bucket_path)
+      if carry is not None:
+        bucket = pd.concat([carry, bucket], ignore_index=True)
+      empty = bucket.iloc[:0]
+      bucket = bucket.sample(frac=1).reset_index(drop=True)
+      complete_rows = len(bucket) // amount_of_rows_to_condense * amount_of_rows_to_condense
+      carry = bucket.iloc[complete_rows:]
+      condensed = pd.concat(
+        self.bq.executor.map_dataframe(condense_dataframe, bucket.iloc[:complete_rows], amount_of_rows_to_condense, columns,
+          chunk_multiple=amount_of_rows_to_condense),
+        ignore_index=True)
+      writer = self._write_parquet(writer, output_path, condensed)
+      os.remove(bucket_path)
+    if writer is None:
+      #Without rows, or with fewer than a condensed row, the destination is still replaced, empty and
+      #with the condensed columns, so the next stages don't read the rows of a previous run
+      if empty is None:
+        empty = self._empty_dataframe(source_table_name)
+      self._upload_dataframe(condense_dataframe(empty, amount_of_rows_to_condense, columns), "WRITE_TRUNCATE", destination_table_name)
+      return
+    writer.close()
+    self.bq.upload_parquet_file_to_big_query(output_path, "WRITE_TRUNCATE", destination_table_name)
+
+  def transform_table(self, source_table_name: str, destination_table_name: str, transform,
+    write_disposition: Optional[str] = "WRITE_TRUNCATE") -> None:
+    """
+    Applies a function to a table chunk by chunk and loads the result to another table.
+
+    Args:
+      source_table_name: The name of the table to transform.
+      destination_table_name: The table where the result is written.
+      transform: function that receives a chunk dataframe and the amount of rows in the previous chunks,
+        and returns the transformed dataframe
+      write_disposition: WRITE_TRUNCATE or WRITE_APPEND
+    """
+    output_path = self._new_path("transformed", ".parquet")
+    writer = None
+    rows_before = 0
+    empty = None
+    for chunk_path in self.spill_table(source_table_name):
+      chunk = self._read_file(chunk_path)
+      empty = chunk.iloc[:0]
+      transformed = transform(chunk, rows_before)
+      rows_before += len(chunk)
+      writer = self._write_parquet(writer, output_path, transformed)
+      os.remove(chunk_path)
+    if writer is None:
+      #Nothing was written, the destination is still replaced by an empty table with the transformed columns
+      if empty is None:
+        empty = self._empty_dataframe(source_table_name)
+      self._upload_dataframe(transform(empty, rows_before), write_disposition, destination_table_name)
+      return
+    writer.close()
+    self.bq.upload_parquet_file_to_big_query(output_path, write_disposition, destination_table_name)
+
+  def _empty_dataframe(self, table_name: str) -> pd.core.frame.DataFrame:
+    """Returns a dataframe without rows with the columns of a BigQuery table."""
+    schema = pa.schema([(field.name, BIGQUERY_ARROW_TYPES.get(field.field_type, pa.string()))
+      for field in self.bq.get_bq_table(table_name).schema])
+    return schema.empty_table().to_pandas(types_mapper=bigquery_types_mapper)
+
+  def _upload_dataframe(self, dataframe: pd.core.frame.DataFrame, write_disposition: str, table_name: str) -> None:
+    """Loads a dataframe to BigQuery through a parquet file, creating the table even if it has no rows."""
+    output_path = self._new_path("output", ".parquet")
+    self._write_parquet(None, output_path, dataframe, allow_empty=True).close()
+    self.bq.upload_parquet_file_to_big_query(output_path, write_disposition, table_name)
+
+  def _scatter_to_buckets(self, chunk_paths: List[str], buckets: int) -> List[str]:
+    """
+    Sends every row of the chunk files to a random bucket file and deletes the chunks.
+    """
+    bucket_paths = [self._new_path("bucket") for _ in range(buckets)]
+    writers = [None] * buckets
+    random_generator = np.random.default_rng()
+    for chunk_path in chunk_paths:
+      with pa.memory_map(chunk_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        assignments = random_generator.integers(0, buckets, size=table.num_rows)
+        for bucket in range(buckets):
+          rows = table.take(pa.array(np.flatnonzero(assignments == bucket)))
+          if writers[bucket] is None:
+            writers[bucket] = pa.ipc.new_file(bucket_paths[bucket], table.schema)
+          writers[bucket].write_table(rows)
+      os.remove(chunk_path)
+    for writer in writers:
+      if writer is not None:
+        writer.close()
+    return [path for path, writer in zip(bucket_paths, writers) if writer is not None]
+
+  def _read_file(self, path: str) -> pd.core.frame.DataFrame:
+    """Memory maps an Arrow IPC file and converts it to a dataframe with the dtypes of BigQuery reads."""
+    with pa.memory_map(path, "r") as source:
+      return pa.ipc.open_file(source).read_all().to_pandas(types_mapper=bigquery_types_mapper)
+
+  def _write_parquet(self, writer: Optional[pq.ParquetWriter], path: str,
+    dataframe: pd.core.frame.DataFrame, allow_empty: Optional[bool] = False) -> Optional[pq.ParquetWriter]:
+    """
+    Appends a dataframe to a parquet file, opening it with the schema of the first non empty chunk,
+    or of the first chunk with allow_empty. Later chunks are cast to that schema, so columns that are
+    empty in a chunk keep their type.
+    """
+    if len(dataframe) == 0 and writer is None and not allow_empty:
+      return None
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    if writer is None:
+      schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema])
+      table = table.cast(schema)
+      writer = pq.ParquetWriter(path, schema)
+    else:
+      table = table.cast(writer.schema)
+    writer.write_table(table)
+    return writer
+
+  def _new_path(self, name: str, extension: Optional[str] = ".arrow") -> str:
+    #The file is created here, so no other process can take the same name
+    file_descriptor, path = tempfile.mkstemp(prefix=name + "-", suffix=extension, dir=self.directory)
+    os.close(file_descriptor)
+    return path
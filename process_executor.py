@@ -0,0 +1,250 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+
+SHARED_MEMORY_DIR = "/dev/shm"
+MIN_ROWS_PER_CHUNK = 10000
+RESULT_COLUMN = "result"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_buffer_dir() -> str:
+  """
+  Returns the directory for the Arrow files exchanged with the worker processes.
+  /dev/shm is memory backed, so the files never touch the disk.
+  """
+  if os.path.isdir(SHARED_MEMORY_DIR) and os.access(SHARED_MEMORY_DIR, os.W_OK):
+    return SHARED_MEMORY_DIR
+  return tempfile.gettempdir()
+
+
+def write_arrow_file(dataframe: pd.core.frame.DataFrame, directory: Optional[str] = None) -> str:
+  """
+  Writes a dataframe as an Arrow IPC file and returns its path.
+
+  Args:
+    dataframe: dataframe to write, categorical columns are kept dictionary encoded
+    directory: directory of the file, by default the shared memory directory
+  """
+  path = os.path.join(directory or get_buffer_dir(), "cartesian-" + uuid.uuid4().hex + ".arrow")
+  table = pa.Table.from_pandas(dataframe, preserve_index=False)
+  with pa.OSFile(path, "wb") as sink:
+    with pa.ipc.new_file(sink, table.schema) as writer:
+      writer.write_table(table)
+  return path
+
+
+def read_arrow_file(path: str) -> pd.core.frame.DataFrame:
+  """
+  Memory maps an Arrow IPC file and returns its contents as a dataframe.
+  """
+  with pa.memory_map(path, "r") as source:
+    return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _remove_file(path: str) -> None:
+  """
+  Deletes an exchange file, ignoring files that were already removed.
+  """
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
+
+def _write_result(result):
+  """
+  Stores the result of a chunk where the parent process can read it without unpickling the data.
+  Dataframes, series and lists go to Arrow files and strings to plain files.
+
+  return tuple with the kind of result and its path (or the value itself for other types)
+  """
+  if isinstance(result, pd.DataFrame):
+    return "dataframe", write_arrow_file(result)
+  if isinstance(result, pd.Series):
+    return "series", write_arrow_file(result.to_frame(RESULT_COLUMN))
+  if isinstance(result, list):
+    return "list", write_arrow_file(pd.DataFrame({RESULT_COLUMN: result}))
+  if isinstance(result, str):
+    path = os.path.join(get_buffer_dir(), "cartesian-" + uuid.uuid4().hex + ".txt")
+    with open(path, "w", encoding="utf-8") as output_file:
+      output_file.write(result)
+    return "str", path
+  return "object", result
+
+
+def _read_result(kind: str, value):
+  """
+  Reads a result stored by _write_result and deletes its file.
+  """
+  if kind == "object":
+    return value
+  try:
+    if kind == "str":
+      with open(value, "r", encoding="utf-8") as input_file:
+        return input_file.read()
+    dataframe = read_arrow_file(value)
+    if kind == "series":
+      return dataframe[RESULT_COLUMN]
+    if kind == "list":
+      return dataframe[RESULT_COLUMN].tolist()
+    return dataframe
+  finally:
+    _remove_file(value)
+
+
+def _run_chunk(function, input_path: str, args: tuple):
+  """
+  Entry point in the worker process: reads the chunk, runs the function and stores the result.
+  """
+  return _write_result(function(read_arrow_file(input_path), *args))
+
+
+class _ChunkResult:
+  """
+  Future-like wrapper that decodes the result of a chunk and removes its input file.
+  """
+
+  def __init__(self, future: Future, input_path: Optional[str] = None):
+    self._future = future
+    self._input_path = input_path
+
+  def result(self):
+    try:
+      kind, value = self._future.result()
+      return _read_result(kind, value)
+    finally:
+      if self._input_path:
+        _remove_file(self._input_path)
+
+
+class ProcessExecutor:
+  """
+  Runs CPU bound dataframe functions in a pool of processes, so they don't hold the GIL of the
+  process serving requests. Dataframes move between processes as memory mapped Arrow files in
+  shared memory instead of being pickled.
+
+  Functions must be defined at module level and receive the dataframe as their first parameter.
+  With max_workers 0, the default, the functions run in the calling thread.
+
+  Runs hold the executor they use with acquire and release, a retired executor keeps its pool until
+  the last of them releases it.
+  """
+
+  def __init__(self, max_workers: Optional[int] = 0):
+    self.max_workers = max_workers or 0
+    self._pool = None
+    self._users = 0
+    self._retired = False
+    self._users_lock = threading.Lock()
+    if self.max_workers > 0:
+      #spawn avoids forking a process that has threads running (gunicorn threads, client pools)
+      self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+  def submit(self, function, dataframe: pd.core.frame.DataFrame, *args):
+    """
+    Runs function(dataframe, *args) in a worker process.
+
+    return object with a result() method that waits for the function result
+    """
+    if self._pool is None:
+      future = Future()
+      future.set_result(("object", function(dataframe, *args)))
+      return _ChunkResult(future)
+    input_path = write_arrow_file(dataframe)
+    return _ChunkResult(self._pool.submit(_run_chunk, function, input_path, args), input_path)
+
+  def map_dataframe(self, function, dataframe: pd.core.frame.DataFrame, *args, chunk_multiple: Optional[int] = 1) -> list:
+    """
+    Splits a dataframe in one chunk per worker, runs function(chunk, *args) on each of them in parallel
+    and returns the results in order.
+
+    Args:
+      function: module level function that receives the chunk and args
+      dataframe: dataframe to split
+      chunk_multiple: the size of every chunk but the last is a multiple of this number
+    """
+    workers = max(self.max_workers, 1)
+    chunk_size = max(math.ceil(len(dataframe) / workers), MIN_ROWS_PER_CHUNK)
+    chunk_size = math.ceil(chunk_size / chunk_multiple) * chunk_multiple
+    if len(dataframe) <= chunk_size:
+      return [self.submit(function, dataframe, *args).result()]
+    results = [
+      self.submit(function, dataframe.iloc[start:start + chunk_size], *args)
+      for start in range(0, len(dataframe), chunk_size)
+    ]
+    return [result.result() for result in results]
+
+  def acquire(self) -> "ProcessExecutor":
+    """
+    Holds the executor for a run, its pool isn't shut down until the run calls release.
+    """
+    with self._users_lock:
+      self._users += 1
+    return self
+
+  def release(self) -> None:
+    with self._users_lock:
+      self._users -= 1
+      idle = self._retired and self._users == 0
+    if idle:
+      self.shutdown()
+
+  def retire(self) -> None:
+    """
+    Shuts down the pool once no run holds the executor, right away if none does.
+    """
+    with self._users_lock:
+      self._retired = True
+      idle = self._users == 0
+    if idle:
+      self.shutdown()
+
+  def shutdown(self) -> None:
+    if self._pool is not None:
+      self._pool.shutdown()
+
+
+def get_executor(max_workers: Optional[int] = None, acquire: Optional[bool] = False) -> ProcessExecutor:
+  """
+  Returns the process executor shared by every run in this instance, creating it on first use.
+  A different amount of workers replaces the shared executor, runs that hold the previous one keep
+  using it until they finish.
+
+  Args:
+    max_workers: amount of worker processes, 0 runs everything inline. None keeps the current executor,
+      or runs inline if there is none yet.
+    acquire: hold the executor for a run, see ProcessExecutor.acquire
+  """
+  global _executor
+  with _executor_lock:
+    if _executor is None or (max_workers is not None and _executor.max_workers != max_workers):
+      if _executor is not None:
+        _executor.retire()
+      _executor = ProcessExecutor(max_workers)
+    #Acquired under the lock, so a concurrent replacement can't shut the pool down before the run holds it
+    return _executor.acquire() if acquire else _executor
@@ -0,0 +1,241 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from google.cloud import bigquery
+from google.cloud import exceptions as cloud_exceptions
+from bigquery_helper import BigqueryHelper
+
+MANIFEST_TABLE_NAME = "cartesianRunManifest"
+MANIFEST_COLUMNS = ["stage", "output_table", "row_count", "output_modified", "input_fingerprint", "completed_at", "run_id",
+  "config_fingerprint"]
+#Entries are partitioned by the day they were recorded and deleted after this many days
+MANIFEST_PARTITION_EXPIRATION_DAYS = 7
+#Runs older than this can't be resumed, their tables have expired
+DEFAULT_RESUMABLE_HOURS = 24
+#Entries recorded when a run starts and when it fails, they don't belong to any stage
+RUN_STARTED_STAGE = "run_started"
+RUN_FAILED_STAGE = "run_failed"
+#A run of another instance that recorded nothing for this long is considered dead and can be resumed
+DEFAULT_ACTIVE_RUN_IDLE_MINUTES = 60
+#Entries still in the streaming buffer don't have a partition yet
+RECENT_PARTITIONS = "(_PARTITIONTIME IS NULL OR _PARTITIONTIME >= TIMESTAMP_TRUNC(TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {} HOUR), DAY))"
+
+#Runs in progress in this instance, a resume never takes over one of them
+_active_runs = set()
+_active_runs_lock = threading.Lock()
+
+
+class RunManifest:
+  """
+  Records the completion of each pipeline stage in a BigQuery table, so a failed run can be resumed
+  from the first stage that didn't finish.
+
+  Each entry stores the output table of the stage, its row count and modification time, and a fingerprint
+  of the stage inputs (metadata of the input tables and the configuration used). A stage is still valid
+  if its latest entry has the same input fingerprint and its output table was not modified since.
+
+  Entries belong to the run set in run_id, the stages of other runs are ignored. Every entry also stores
+  the fingerprint of the configuration of the run, only runs with the same configuration are resumed.
+  The manifest table is partitioned by day and only the partitions of the last resumable_hours are read,
+  older entries expire after MANIFEST_PARTITION_EXPIRATION_DAYS.
+  """
+
+  def __init__(self, bq: BigqueryHelper, run_id: Optional[str] = None, resumable_hours: Optional[float] = DEFAULT_RESUMABLE_HOURS,
+    config_fingerprint: Optional[str] = None, active_run_idle_minutes: Optional[float] = DEFAULT_ACTIVE_RUN_IDLE_MINUTES):
+    self.bq = bq
+    self.run_id = run_id
+    self.resumable_hours = resumable_hours or DEFAULT_RESUMABLE_HOURS
+    self.config_fingerprint = config_fingerprint or ""
+    self.active_run_idle_minutes = active_run_idle_minutes or DEFAULT_ACTIVE_RUN_IDLE_MINUTES
+    self._entries = None
+    self._table_created = False
+
+  def get_fingerprint(self, input_tables: list, stage_config) -> str:
+    """
+    Returns a hash of the input tables metadata and the configuration of a stage.
+
+    Args:
+      input_tables: list of table names read by the stage
+      stage_config: any json serializable value with the configuration that affects the stage output
+
+    return fingerprint string
+    """
+    inputs = []
+    for table_name in input_tables:
+      row_count, modified = self._get_table_state(table_name)
+      inputs.append([table_name, row_count, modified])
+    payload = json.dumps({"inputs": inputs, "config": stage_config}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+  def is_complete(self, stage: str, fingerprint: str, output_table: Optional[str] = None) -> bool:
+    """
+    Returns true if the stage already completed with the same inputs and its output is unchanged.
+
+    Args:
+      stage: name of the stage
+      fingerprint: fingerprint of the current inputs of the stage
+      output_table: table written by the stage, None if the stage doesn't write a table
+    """
+    entry = self._get_entries().get(stage)
+    if not entry or entry["input_fingerprint"] != fingerprint:
+      return False
+    if output_table is None:
+      return True
+    row_count, modified = self._get_table_state(output_table)
+    return str(row_count) == entry["row_count"] and modified == entry["output_modified"]
+
+  def record(self, stage: str, fingerprint: str, output_table: Optional[str] = None) -> None:
+    """
+    Stores the completion of a stage.
+
+    Args:
+      stage: name of the stage
+      fingerprint: fingerprint of the inputs the stage ran with
+      output_table: table written by the stage, None if the stage doesn't write a table
+    """
+    row_count, modified = self._get_table_state(output_table) if output_table else (None, None)
+    self._insert_entry(stage, fingerprint, output_table, row_count, modified)
+    print("Stage {} completed, output {} with {} rows".format(stage, output_table, row_count))
+
+  def start(self, run_id: str) -> bool:
+    """
+    Marks a run as in progress in this instance and records its start, so other instances don't resume it.
+
+    Args:
+      run_id: id of the run to start or resume
+
+    return False if the run is already in progress in this instance
+    """
+    with _active_runs_lock:
+      if run_id in _active_runs:
+        return False
+      _active_runs.add(run_id)
+    self.run_id = run_id
+    self._entries = None
+    self._insert_entry(RUN_STARTED_STAGE, "")
+    return True
+
+  def finish(self, failed: bool) -> None:
+    """
+    Marks the run as no longer in progress. A failed run is recorded as such, so it can be resumed right away.
+
+    Args:
+      failed: True if the run stopped with an error
+    """
+    try:
+      if failed:
+        self._insert_entry(RUN_FAILED_STAGE, "")
+    finally:
+      with _active_runs_lock:
+        _active_runs.discard(self.run_id)
+
+  def get_resumable_run_id(self, final_stage: str) -> Optional[str]:
+    """
+    Returns the id of the latest run with the same configuration that didn't complete its final stage and
+    is not in progress, None if there is none or a later run with the same configuration completed.
+
+    A run is in progress if it runs in this instance, or if it didn't fail and recorded an entry in the
+    last active_run_idle_minutes.
+
+    Args:
+      final_stage: name of the last stage of a run
+    """
+    runs = {}
+    for entry in self._read_rows("run_id != '' AND config_fingerprint = @config_fingerprint",
+      [bigquery.ScalarQueryParameter("config_fingerprint", "STRING", self.config_fingerprint)]):
+      latest = runs.get(entry["run_id"])
+      if latest is None or entry["completed_at"] > latest["completed_at"]:
+        runs[entry["run_id"]] = entry
+    idle_since = (datetime.now(timezone.utc) - timedelta(minutes=self.active_run_idle_minutes)).isoformat()
+    with _active_runs_lock:
+      active_runs = set(_active_runs)
+    for run_id, latest in sorted(runs.items(), key=lambda item: item[1]["completed_at"], reverse=True):
+      if latest["stage"] == final_stage:
+        return None
+      if run_id not in active_runs and (latest["stage"] == RUN_FAILED_STAGE or latest["completed_at"] < idle_since):
+        return run_id
+    return None
+
+  def _insert_entry(self, stage: str, fingerprint: str, output_table: Optional[str] = None, row_count=None, modified=None) -> None:
+    """
+    Inserts an entry of the run in the manifest table.
+    """
+    entry = {
+      "stage": stage,
+      "output_table": output_table or "",
+      "row_count": str(row_count),
+      "output_modified": str(modified),
+      "input_fingerprint": fingerprint,
+      "completed_at": datetime.now(timezone.utc).isoformat(),
+      "run_id": self.run_id or "",
+      "config_fingerprint": self.config_fingerprint
+    }
+    self._create_table()
+    self.bq.insert_single_record(MANIFEST_TABLE_NAME, entry)
+    self._get_entries()[stage] = entry
+
+  def _create_table(self) -> None:
+    """
+    Creates the partitioned manifest table if it doesn't exist.
+    """
+    if self._table_created:
+      return
+    try:
+      self.bq.get_bq_table(MANIFEST_TABLE_NAME)
+    except cloud_exceptions.NotFound:
+      #Another run may create it meanwhile, the existing table is kept
+      self.bq.create_table(MANIFEST_TABLE_NAME, MANIFEST_COLUMNS, update_if_exist=True, mode="NULLABLE",
+        partition_expiration_days=MANIFEST_PARTITION_EXPIRATION_DAYS)
+    self._table_created = True
+
+  def _read_rows(self, where: str, query_parameters: Optional[list] = None) -> list:
+    """
+    Reads the entries of the manifest table recorded in the last resumable_hours that match a condition.
+    """
+    try:
+      rows = self.bq.read_from_table(MANIFEST_TABLE_NAME,
+        where=RECENT_PARTITIONS.format(int(self.resumable_hours) + 1) + " AND " + where, query_parameters=query_parameters)
+    except cloud_exceptions.NotFound:
+      return []
+    return [dict(row.items()) for row in rows]
+
+  def _get_entries(self) -> dict:
+    """
+    Reads the latest entry of every stage of the run from the manifest table.
+    """
+    if self._entries is None:
+      self._entries = {}
+      if not self.run_id:
+        return self._entries
+      for entry in self._read_rows("run_id = @run_id", [bigquery.ScalarQueryParameter("run_id", "STRING", self.run_id)]):
+        latest = self._entries.get(entry["stage"])
+        if latest is None or entry["completed_at"] > latest["completed_at"]:
+          self._entries[entry["stage"]] = entry
+    return self._entries
+
+  def _get_table_state(self, table_name: str):
+    """
+    Returns the row count and modification time of a table from its metadata, or None values if it doesn't exist.
+    """
+    try:
+      table = self.bq.get_bq_table(table_name)
+    except cloud_exceptions.NotFound:
+      return None, None
+    return table.num_rows, table.modified.isoformat() if table.modified else None
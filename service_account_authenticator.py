@@ -13,27 +13,26 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import base64, requests, sys
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from typing import Optional
 from utilities import Utilities
 
 
-
-params = Utilities.load_config('config.json')
-json_name=str(params["service_account_credentials_path"])
-
+def get_credentials_path() -> str:
+  """Reads the path of the service account key file from the configuration when it's needed."""
+  params = Utilities.load_config('config.json')
+  return str(params["service_account_credentials_path"])
 
 
 class Service_Account_Authenticator:
 
-  def __init__(self,scope:list):
+  def __init__(self,scope:list, credentials_json: Optional[str] = None):
     
-    self.credentials_json=json_name
+    self.credentials_json=credentials_json or get_credentials_path()
     self.scope=scope
     self.service_account_credentials=self.authenticate()
 
   def authenticate(self):
+    from oauth2client.service_account import ServiceAccountCredentials
     credentials = ServiceAccountCredentials.from_json_keyfile_name(self.credentials_json, self.scope)
     return credentials
   def get_service_account_credentials(self):
@@ -0,0 +1,120 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF_SECONDS = 5
+STATUS_PUBLISHED = "published"
+STATUS_FAILED = "failed"
+
+
+class ShardPublisher:
+  """
+  Publishes a list of shard tables as independent feeds, running the publish function of several
+  shards at the same time.
+
+  At most max_concurrency shards run at once, and shards start at most requests_per_minute times per
+  minute, which keeps the Sheets and BigQuery quotas of the project. When a round finishes, only the
+  shards that failed are retried, after a backoff that doubles on every round.
+
+  Usage:
+    publisher = ShardPublisher(lambda shard: publish(shard), max_concurrency=4, requests_per_minute=30)
+    report = publisher.publish(["brand_a", "brand_b"])
+  """
+
+  def __init__(self, publish_shard, max_concurrency: Optional[int] = DEFAULT_MAX_CONCURRENCY,
+    requests_per_minute: Optional[float] = None, max_attempts: Optional[int] = DEFAULT_MAX_ATTEMPTS,
+    retry_backoff_seconds: Optional[float] = DEFAULT_RETRY_BACKOFF_SECONDS):
+    """
+    Args:
+      publish_shard: function that receives a shard table name and publishes it, failures must raise an exception
+      max_concurrency: maximum amount of shards published at the same time
+      requests_per_minute: maximum amount of shards started per minute, None for no limit
+      max_attempts: attempts per shard, including the first one
+      retry_backoff_seconds: wait before the first retry round
+    """
+    self.publish_shard = publish_shard
+    self.max_concurrency = max(1, max_concurrency or 1)
+    self.min_start_interval = 60.0 / requests_per_minute if requests_per_minute else 0
+    self.max_attempts = max(1, max_attempts or 1)
+    self.retry_backoff_seconds = retry_backoff_seconds
+    self._next_start = 0.0
+    self._start_lock = threading.Lock()
+
+  def publish(self, shards: List[str]) -> dict:
+    """
+    Publishes every shard, retrying the failed ones.
+
+    return dictionary with an entry per shard containing its status, attempts, seconds of the last
+    attempt and the error of the last failure; plus the totals of published and failed shards
+    """
+    results = {shard: {"status": None, "attempts": 0, "seconds": None, "error": None} for shard in shards}
+    pending = list(shards)
+    backoff = self.retry_backoff_seconds
+    for attempt in range(1, self.max_attempts + 1):
+      if not pending:
+        break
+      if attempt > 1:
+        print("Retrying {} failed shards in {} seconds".format(len(pending), backoff))
+        time.sleep(backoff)
+        backoff *= 2
+      with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(pending))) as executor:
+        outcomes = list(executor.map(self._publish_one, pending))
+      failed = []
+      for shard, (seconds, error) in zip(pending, outcomes):
+        results[shard].update(attempts=attempt, seconds=round(seconds, 3), error=error,
+          status=STATUS_FAILED if error else STATUS_PUBLISHED)
+        if error:
+          failed.append(shard)
+      pending = failed
+
+    published = sum(result["status"] == STATUS_PUBLISHED for result in results.values())
+    print("Published {} shards, {} failed".format(published, len(shards) - published))
+    return {"shards": results, "published": published, "failed": len(shards) - published}
+
+  def _publish_one(self, shard: str):
+    """
+    Publishes a shard once, returning the seconds it took and the error message if it failed.
+    """
+    self._wait_for_start()
+    start = time.perf_counter()
+    try:
+      self.publish_shard(shard)
+      error = None
+    except Exception as exception:
+      traceback.print_exc()
+      error = "{}: {}".format(type(exception).__name__, exception)
+    seconds = time.perf_counter() - start
+    print("Shard {} {} in {:.1f} seconds".format(shard, "failed" if error else "published", seconds))
+    return seconds, error
+
+  def _wait_for_start(self) -> None:
+    """
+    Blocks until the rate limit allows another shard to start.
+    """
+    if not self.min_start_interval:
+      return
+    with self._start_lock:
+      now = time.monotonic()
+      start_at = max(now, self._next_start)
+      self._next_start = start_at + self.min_start_interval
+    if start_at > now:
+      time.sleep(start_at - now)
@@ -0,0 +1,226 @@
+"""
+Copyright 2022 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import random
+import threading
+import time
+from typing import List, Optional
+import google.auth
+import gspread
+import requests
+
+GOOGLE_SHEETS_AUTH_SCOPES=["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',"https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+#Default per user quota of the Sheets API, Drive calls made by gspread are counted in the same budget
+SHEETS_REQUESTS_PER_MINUTE = 60
+SHEETS_MAX_ATTEMPTS = 6
+SHEETS_BACKOFF_SECONDS = 1
+SHEETS_MAX_BACKOFF_SECONDS = 64
+SHEETS_RETRY_STATUS = [429, 500, 502, 503, 504]
+#A 429 means the request was rejected before running, a server error or a lost connection may come after
+#it ran, so those are only retried for methods that can be replayed without creating anything twice
+SHEETS_REJECTED_STATUS = [429]
+SHEETS_IDEMPOTENT_METHODS = ["get", "head", "put", "delete", "options"]
+
+_sheets_client = None
+_sheets_client_lock = threading.Lock()
+
+
+class TokenBucket:
+  """
+  Allows at most requests_per_window calls in any window of window_seconds, with bursts of at most
+  burst calls. The bucket refills at the rate left after the burst, so a burst followed by a window
+  of steady calls stays within the quota. Thread safe, every thread of the process shares the same budget.
+  """
+
+  def __init__(self, requests_per_window: float, window_seconds: Optional[float] = 60, burst: Optional[int] = None):
+    self.requests_per_window = requests_per_window
+    self.capacity = max(1, burst or int(requests_per_window / 10))
+    self.rate = max(requests_per_window - self.capacity, 1) / window_seconds
+    self._tokens = float(self.capacity)
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self) -> float:
+    """
+    Takes a token, waiting until one is available.
+
+    return seconds waited
+    """
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      #The token is taken right away, later callers queue behind the debt
+      self._tokens -= 1
+      wait = -self._tokens / self.rate if self._tokens < 0 else 0
+    if wait:
+      time.sleep(wait)
+    return wait
+
+
+class RateLimitedClient(gspread.Client):
+  """
+  gspread client whose HTTP requests all go through a token bucket, and are retried with jittered
+  exponential backoff when the API answers with a quota error. Server and connection errors are only
+  retried for idempotent methods, a POST such as create or batchUpdate may have run already.
+  """
+
+  def __init__(self, auth, session=None, bucket: Optional[TokenBucket] = None,
+    max_attempts: Optional[int] = SHEETS_MAX_ATTEMPTS, backoff_seconds: Optional[float] = SHEETS_BACKOFF_SECONDS):
+    super().__init__(auth, session)
+    self.bucket = bucket or TokenBucket(SHEETS_REQUESTS_PER_MINUTE)
+    self.max_attempts = max(1, max_attempts or 1)
+    self.backoff_seconds = backoff_seconds
+    self.retries = 0
+
+  def request(self, method, *args, **kwargs):
+    idempotent = method.lower() in SHEETS_IDEMPOTENT_METHODS
+    for attempt in range(1, self.max_attempts + 1):
+      self.bucket.acquire()
+      try:
+        return super().request(method, *args, **kwargs)
+      except gspread.exceptions.APIError as error:
+        status_code = error.response.status_code
+        if status_code not in (SHEETS_RETRY_STATUS if idempotent else SHEETS_REJECTED_STATUS) or attempt == self.max_attempts:
+          raise
+        retry_after = error.response.headers.get("Retry-After")
+      except requests.exceptions.ConnectTimeout:
+        #The connection was never established, the request didn't reach the API
+        if attempt == self.max_attempts:
+          raise
+        retry_after = None
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        if not idempotent or attempt == self.max_attempts:
+          raise
+        retry_after = None
+      #Full jitter, so the threads that hit the quota together don't retry together
+      delay = random.uniform(0, min(SHEETS_MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** (attempt - 1)))
+      if retry_after and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+      self.retries += 1
+      print("Sheets request failed, retry {} in {:.1f} seconds".format(attempt, delay))
+      time.sleep(delay)
+
+
+class SheetsClient:
+  """
+  Google Sheets operations of the pipeline on a single authorized client, shared by every run and
+  thread of the process, see get_sheets_client.
+
+  Spreadsheets are looked up by name once and kept, and a spreadsheet is only shared once with each
+  user, so an export of an existing sheet is a single upload request.
+
+  Usage:
+    sheets = get_sheets_client()
+    sheets.export_csv("feed", csv_text, "user@example.com")
+  """
+
+  def __init__(self, client: gspread.Client):
+    self.client = client
+    self._spreadsheets = {}
+    self._shared = set()
+    self._lock = threading.Lock()
+    #Concurrent exports of a new sheet must not create it twice
+    self._name_locks = {}
+
+  def open(self, name: str, create: Optional[bool] = False) -> gspread.Spreadsheet:
+    """
+    Returns a spreadsheet by name.
+
+    Args:
+      name: name of the spreadsheet
+      create: create the spreadsheet if it doesn't exist, otherwise gspread.exceptions.SpreadsheetNotFound is raised
+    """
+    with self._name_lock(name):
+      spreadsheet = self._spreadsheets.get(name)
+      if spreadsheet is not None:
+        return spreadsheet
+      try:
+        spreadsheet = self.client.open(name)
+      except gspread.exceptions.SpreadsheetNotFound:
+        if not create:
+          raise
+        print("This sheet doesn't exist. Creating one...")
+        spreadsheet = self.client.create(name)
+      self._spreadsheets[name] = spreadsheet
+      return spreadsheet
+
+  def clear(self, name: str, ranges: List[str]) -> None:
+    """
+    Clears ranges of the first worksheet of a spreadsheet in a single request.
+    """
+    self.open(name).values_batch_clear(body={"ranges": ranges})
+
+  def read_first_worksheet(self, name: str) -> list:
+    """
+    Returns every value of the first worksheet of a spreadsheet as a list of rows.
+    """
+    return self.open(name).get_worksheet(0).get_all_values()
+
+  def export_csv(self, name: str, data: bytes, share_with: Optional[str] = None) -> str:
+    """
+    Replaces the contents of a spreadsheet with csv data, creating the spreadsheet if it doesn't exist,
+    and shares it with a user as writer. The import replaces the whole first worksheet, so the sheet
+    doesn't need to be cleared before.
+
+    Args:
+      name: name of the spreadsheet
+      data: csv contents, utf-8 encoded
+      share_with: email of the user that can edit the spreadsheet
+
+    return id of the spreadsheet
+    """
+    spreadsheet = self.open(name, create=True)
+    try:
+      self.client.import_csv(spreadsheet.id, data=data)
+    except gspread.exceptions.APIError as error:
+      if error.response.status_code != 404:
+        raise
+      #The spreadsheet was deleted since it was looked up
+      self.forget(name)
+      spreadsheet = self.open(name, create=True)
+      self.client.import_csv(spreadsheet.id, data=data)
+    with self._name_lock(name):
+      if share_with and (spreadsheet.id, share_with) not in self._shared:
+        spreadsheet.share(share_with, perm_type='user', role='writer')
+        self._shared.add((spreadsheet.id, share_with))
+    return spreadsheet.id
+
+  def forget(self, name: str) -> None:
+    """Drops a spreadsheet looked up before, so it's searched again on next use."""
+    with self._name_lock(name):
+      self._spreadsheets.pop(name, None)
+
+  def _name_lock(self, name: str) -> threading.Lock:
+    with self._lock:
+      return self._name_locks.setdefault(name, threading.Lock())
+
+
+def get_sheets_client(requests_per_minute: Optional[float] = None) -> SheetsClient:
+  """
+  Returns the Sheets client shared by the process, authorizing it with the default credentials on first use.
+
+  Args:
+    requests_per_minute: requests allowed per minute, by default SHEETS_REQUESTS_PER_MINUTE. A different
+      value replaces the shared client.
+  """
+  global _sheets_client
+  with _sheets_client_lock:
+    if _sheets_client is None or (requests_per_minute is not None and
+      _sheets_client.client.bucket.requests_per_window != requests_per_minute):
+      credentials, project_id = google.auth.default(scopes=GOOGLE_SHEETS_AUTH_SCOPES)
+      bucket = TokenBucket(requests_per_minute or SHEETS_REQUESTS_PER_MINUTE)
+      _sheets_client = SheetsClient(RateLimitedClient(credentials, bucket=bucket))
+    return _sheets_client